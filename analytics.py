@@ -0,0 +1,196 @@
+from datetime import datetime, timedelta
+import numpy as np
+from models import *
+from helpers import *
+
+
+UTILIZATION_BUCKETS = [0.25, 0.5, 0.75, 1.0]
+UTILIZATION_LABELS = ["0-25%", "25-50%", "50-75%", "75-100%", "Over 100%"]
+
+
+def fetch_sessions(table, since):
+    """
+    Fetches the sessions of a session table since a date as NumPy columns.
+
+    Every session is returned with the ID of the athlete, the Monday of its week and the
+    training plan of the athlete. The whole range is read with a single query.
+
+    Parameters:
+        table (str): Either "training_sessions" or "coaching_sessions".
+        since (str): The first date to include, in the format "YYYY-MM-DD".
+
+    Returns:
+        dict: A dictionary of NumPy arrays with the keys "athlete_id", "week" (datetime64[D]),
+              "plan_id" and "fees". The fees are the tuition fees of coaching sessions and 0 for
+              training sessions.
+    """
+
+    with db.read_engine.connect() as conn:
+        rows = run_query(conn, "%s_since" % table, {"since": since},
+                         **{table: sessions_table(conn, table, since)}).fetchall()
+
+    columns = list(zip(*rows)) if rows else [(), (), (), ()]
+    return {
+        "athlete_id": np.array(columns[0], dtype=np.int64),
+        "week": np.array(columns[1], dtype="datetime64[D]"),
+        "plan_id": np.array(columns[2], dtype=np.int64),
+        "fees": np.array(columns[3], dtype=np.float64)
+    }
+
+
+def athlete_weeks(sessions):
+    """
+    Groups sessions by athlete and week.
+
+    Parameters:
+        sessions (dict): The session columns returned by `fetch_sessions`.
+
+    Returns:
+        tuple: The week, plan ID and number of sessions of every athlete-week, as NumPy arrays.
+    """
+
+    keys = sessions["athlete_id"] * (1 << 20) + sessions["week"].astype(np.int64)
+    _, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    return sessions["week"][first], sessions["plan_id"][first], counts
+
+
+def plan_positions(plans, plan_ids):
+    """
+    Maps training plan IDs to the position of their plan in the chart series.
+
+    Parameters:
+        plans (list): The TrainingPlan objects, ordered by ID.
+        plan_ids (numpy.ndarray): The plan IDs to map.
+
+    Returns:
+        tuple: The positions, and a mask of the IDs that belong to one of the plans.
+    """
+
+    ids = np.array([plan.id for plan in plans], dtype=np.int64)
+    if len(ids) == 0:
+        return np.zeros(len(plan_ids), dtype=np.int64), np.zeros(len(plan_ids), dtype=bool)
+
+    positions = np.clip(np.searchsorted(ids, plan_ids), 0, len(ids) - 1)
+    return positions, ids[positions] == plan_ids
+
+
+def utilization_summary(sessions, plans, weeks, quota_column):
+    """
+    Computes how much of their weekly quota athletes used.
+
+    Utilization is the number of sessions of an athlete in a week divided by the weekly quota of
+    the athlete's training plan. Only weeks in which the athlete had at least one session count.
+
+    Parameters:
+        sessions (dict): The session columns returned by `fetch_sessions`.
+        plans (list): The TrainingPlan objects, ordered by ID.
+        weeks (list): The Mondays of the weeks shown, in the format "YYYY-MM-DD".
+        quota_column (str): The TrainingPlan attribute holding the weekly quota.
+
+    Returns:
+        dict: A dictionary with two Chartist data sets:
+            - histogram: The number of athlete-weeks per utilization bucket, one series per plan.
+            - by_week: The average utilization in percent per week, one series per plan.
+    """
+
+    week, plan_id, counts = athlete_weeks(sessions)
+    quotas = np.array([getattr(plan, quota_column) or 0 for plan in plans], dtype=np.float64)
+
+    plan_index, known = plan_positions(plans, plan_id)
+    week_index = (week - np.datetime64(weeks[0])).astype(np.int64) // 7
+    known &= (week_index >= 0) & (week_index < len(weeks))
+    known &= quotas[plan_index] > 0 if len(plans) else known
+
+    plan_index, week_index, counts = plan_index[known], week_index[known], counts[known]
+    utilization = counts / quotas[plan_index]
+    bucket = np.digitize(utilization, UTILIZATION_BUCKETS, right=True)
+
+    histogram = np.zeros((len(plans), len(UTILIZATION_LABELS)), dtype=np.int64)
+    np.add.at(histogram, (plan_index, bucket), 1)
+
+    cells = plan_index * len(weeks) + week_index
+    size = len(plans) * len(weeks)
+    totals = np.bincount(cells, weights=utilization, minlength=size)
+    numbers = np.bincount(cells, minlength=size)
+    average = np.divide(totals, numbers, out=np.zeros(size), where=numbers > 0) * 100
+
+    return {
+        "histogram": {
+            "labels": UTILIZATION_LABELS,
+            "series": histogram.tolist()
+        },
+        "by_week": {
+            "labels": weeks,
+            "series": np.round(average.reshape(len(plans), len(weeks)), 1).tolist()
+        }
+    }
+
+
+def revenue_by_plan(training, coaching, plans):
+    """
+    Computes the revenue of each training plan.
+
+    The revenue of a plan is its price for every athlete-week with training sessions, plus the
+    tuition fees of the private coaching sessions of the athletes on the plan.
+
+    Parameters:
+        training (dict): The training session columns returned by `fetch_sessions`.
+        coaching (dict): The coaching session columns returned by `fetch_sessions`.
+        plans (list): The TrainingPlan objects, ordered by ID.
+
+    Returns:
+        dict: A Chartist data set with one label per plan and the training and coaching revenue series.
+    """
+
+    prices = np.array([plan.price or 0 for plan in plans], dtype=np.float64)
+
+    _, week_plans, _ = athlete_weeks(training)
+    index, known = plan_positions(plans, week_plans)
+    training_revenue = np.bincount(index[known], minlength=len(plans)) * prices
+
+    index, known = plan_positions(plans, coaching["plan_id"])
+    coaching_revenue = np.bincount(index[known], weights=coaching["fees"][known], minlength=len(plans))
+
+    return {
+        "labels": [plan.name.capitalize() for plan in plans],
+        "series": [training_revenue.tolist(), coaching_revenue.tolist()]
+    }
+
+
+def get_utilization_analytics(num_of_weeks=12):
+    """
+    Computes plan utilization and revenue analytics for the last weeks.
+
+    The training and coaching sessions of the period are each fetched with one query and all
+    groupings are done with vectorized NumPy operations. The result is shaped for Chartist:
+    every chart has "labels" and one "series" per plan.
+
+    Parameters:
+        num_of_weeks (int): The number of weeks to include, ending with the current week.
+
+    Returns:
+        dict: A dictionary with the following keys:
+            - plans (list): The names of the training plans, in series order.
+            - weeks (list): The Mondays of the weeks included.
+            - training (dict): The training quota utilization, see `utilization_summary`.
+            - coaching (dict): The private coaching quota utilization, see `utilization_summary`.
+            - revenue (dict): The revenue per plan, see `revenue_by_plan`.
+    """
+
+    plans = TrainingPlan.query.order_by(TrainingPlan.id).all()
+
+    this_week, _ = get_week_start_end_dates()
+    last_monday = datetime.strptime(this_week, "%Y-%m-%d")
+    weeks = [(last_monday - timedelta(weeks=n)).strftime("%Y-%m-%d")
+             for n in range(num_of_weeks - 1, -1, -1)]
+
+    training = fetch_sessions("training_sessions", weeks[0])
+    coaching = fetch_sessions("coaching_sessions", weeks[0])
+
+    return {
+        "plans": [plan.name.capitalize() for plan in plans],
+        "weeks": weeks,
+        "training": utilization_summary(training, plans, weeks, "num_of_sessions"),
+        "coaching": utilization_summary(coaching, plans, weeks, "private_coaching_max_sessions"),
+        "revenue": revenue_by_plan(training, coaching, plans)
+    }
@@ -0,0 +1,223 @@
+from datetime import date
+from werkzeug.datastructures import MultiDict
+from models import *
+from helpers import *
+
+
+API_MAX_IDS = 500
+API_PAGE_SIZE = 100
+
+# The fields and filters of every resource. Its query, in `QUERIES`, maps them to the columns.
+API_RESOURCES = {
+    "athletes": {
+        "query": "api_athletes",
+        "key": "id",
+        "fields": ["id", "fullname", "gender", "age", "weight", "training_plan", "training_plan_name"],
+        "filters": ["training_plan"]
+    },
+    "training-sessions": {
+        "query": "api_training_sessions",
+        "sessions": "training_sessions",
+        "key": "id",
+        "fields": ["id", "athlete_id", "date"],
+        "filters": ["athlete_id"],
+        "dated": True
+    },
+    "coaching-sessions": {
+        "query": "api_coaching_sessions",
+        "sessions": "coaching_sessions",
+        "key": "id",
+        "fields": ["id", "athlete_id", "date", "tuition_fees"],
+        "filters": ["athlete_id"],
+        "dated": True
+    },
+    "competitions": {
+        "query": "api_competitions",
+        "key": "id",
+        "fields": ["id", "name", "date", "entry_fee", "participants"],
+        "filters": [],
+        "dated": True
+    },
+    "payments": {
+        "query": "api_payments",
+        "key": "athlete_id",
+        "ids_required": True,
+        "fields": ["athlete_id", "week_start", "week_end", "training_sessions", "plan_fee", "coaching_sessions",
+                   "coaching_fees", "competitions", "competition_fees"],
+        "filters": [],
+        "dated": True
+    }
+}
+
+
+class ApiError(Exception):
+    """
+    An error in an API request, reported to the client as a JSON error with an HTTP status.
+
+    Attributes:
+        message (str): The description of the error.
+        status (int): The HTTP status code.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def parse_id_list(value, name="ids"):
+    """
+    Parses a comma separated list of IDs from a query parameter.
+
+    Parameters:
+        value (str): The value of the query parameter.
+        name (str): The name of the parameter, used in error messages.
+
+    Returns:
+        list: The IDs as integers, without duplicates, in the order given.
+    """
+
+    try:
+        ids = list(dict.fromkeys(int(item) for item in value.split(",") if item.strip()))
+    except ValueError:
+        raise ApiError("%s must be a comma separated list of integers" % name)
+
+    if len(ids) > API_MAX_IDS:
+        raise ApiError("at most %d %s can be requested at once" % (API_MAX_IDS, name))
+    return ids
+
+
+def parse_fields(resource, value):
+    """
+    Parses the sparse field selection of a request.
+
+    Parameters:
+        resource (dict): The definition of the resource.
+        value (str): The value of the "fields" query parameter, or None for all fields.
+
+    Returns:
+        list: The names of the selected fields, in the order given.
+    """
+
+    if not value:
+        return list(resource["fields"])
+
+    fields = list(dict.fromkeys(field.strip() for field in value.split(",") if field.strip()))
+    unknown = [field for field in fields if field not in resource["fields"]]
+    if unknown:
+        raise ApiError("unknown fields: %s. Available fields: %s" % (
+            ", ".join(unknown), ", ".join(resource["fields"])))
+    return fields
+
+
+def fetch_resource(name, args):
+    """
+    Reads records of an API resource with a single query.
+
+    Supported query parameters:
+        fields: Comma separated names of the fields to return. Defaults to all fields.
+        ids: Comma separated IDs of the records to return, fetched together in one query.
+             For payments these are athlete IDs, and they are required.
+        athlete_id, training_plan: Comma separated values to filter on, where the resource supports it.
+        since, until: The first and last date to include, in the format "YYYY-MM-DD".
+        after, limit: Keyset pagination when no IDs are given: the records with a key above `after`,
+                      at most `limit` of them.
+
+    Parameters:
+        name (str): The name of the resource.
+        args (MultiDict): The query parameters of the request.
+
+    Returns:
+        dict: A dictionary with the records under "data", and under "next" the value of `after` for
+              the next page, or None when there are no more records.
+    """
+
+    resource = API_RESOURCES.get(name)
+    if resource is None:
+        raise ApiError("unknown resource: %s" % name, 404)
+
+    fields = parse_fields(resource, args.get("fields"))
+    key_field = resource["key"]
+    # The columns are selected in the order of the resource, so the statement of a set of fields
+    # is built once whatever order they are asked in.
+    columns = tuple(field for field in resource["fields"] if field in fields or field == key_field)
+
+    filters, params = [], {}
+
+    ids = parse_id_list(args["ids"]) if args.get("ids") else None
+    if ids is not None:
+        filters.append("ids")
+        params["ids"] = ids
+    elif resource.get("ids_required"):
+        raise ApiError("ids is required for %s" % name)
+
+    for filter_name in resource["filters"]:
+        if args.get(filter_name):
+            filters.append(filter_name)
+            params[filter_name] = parse_id_list(args[filter_name], filter_name)
+
+    for param in ("since", "until"):
+        if args.get(param):
+            if not resource.get("dated"):
+                raise ApiError("%s cannot be filtered by date" % name)
+            filters.append(param)
+            params[param] = args[param]
+
+    limit = None
+    if ids is None:
+        limit = args.get("limit", API_PAGE_SIZE, type=int)
+        if limit < 1:
+            raise ApiError("limit must be at least 1")
+        limit = min(limit, API_PAGE_SIZE * 10)
+        after = args.get("after", 0, type=int)
+        if after < 0:
+            raise ApiError("after cannot be negative")
+        filters.append("after")
+        params["after"] = after
+        params["limit"] = limit + 1
+
+    if name == "payments":
+        refresh_charge_snapshots()
+
+    with db.read_engine.connect() as conn:
+        sources = {}
+        if "sessions" in resource:
+            sources[resource["sessions"]] = sessions_table(conn, resource["sessions"], args.get("since"))
+
+        result = run_query(conn, resource["query"], params, fields=columns, filters=tuple(filters),
+                           paged=limit is not None, **sources)
+        # Database servers return dates as date objects; they are sent in the same "YYYY-MM-DD"
+        # format as the text dates of SQLite.
+        rows = [{column: value.isoformat() if isinstance(value, date) else value for column, value in row._mapping.items()}
+                for row in result]
+
+    next_after = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_after = rows[-1][key_field]
+
+    return {
+        "data": [{field: row[field] for field in fields} for row in rows],
+        "next": next_after
+    }
+
+
+def fetch_resource_item(name, item_id, args):
+    """
+    Reads a single record of an API resource.
+
+    Parameters:
+        name (str): The name of the resource.
+        item_id (int): The ID of the record.
+        args (MultiDict): The query parameters of the request. Only "fields" is used.
+
+    Returns:
+        dict: A dictionary with the record under "data". For payments, the list of weekly charges of the athlete.
+    """
+
+    result = fetch_resource(name, MultiDict({"ids": str(item_id), "fields": args.get("fields")}))
+    if name == "payments":
+        return {"data": result["data"]}
+    if not result["data"]:
+        raise ApiError("%s %d not found" % (name, item_id), 404)
+    return {"data": result["data"][0]}
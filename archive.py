@@ -0,0 +1,276 @@
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import MetaData, create_engine, event, select, text, union_all
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.engine import Engine
+from models import *
+from queries import run_query
+
+
+ARCHIVED_TABLES = {
+    "training_sessions": TrainingSession,
+    "coaching_sessions": CoachingSession
+}
+
+_archived_sources = {}
+
+
+def get_archive_path(database_path):
+    """
+    Returns the path of the archive database that belongs to a database file.
+
+    The archive sits next to the database, for example "instance/database-archive.db"
+    for "instance/database.db".
+
+    Parameters:
+        database_path (str): The path of the main database file.
+
+    Returns:
+        str: The path of the archive database file.
+    """
+
+    root, ext = os.path.splitext(database_path)
+    return "%s-archive%s" % (root, ext or ".db")
+
+
+def get_main_database_path(dbapi_connection):
+    """
+    Returns the file of the main database of a SQLite connection.
+
+    Parameters:
+        dbapi_connection: A sqlite3 connection.
+
+    Returns:
+        str or None: The path of the main database, or None for an in-memory database.
+    """
+
+    for _, name, path in dbapi_connection.execute("pragma database_list").fetchall():
+        if name == "main":
+            return path or None
+    return None
+
+
+def attach_archive(dbapi_connection):
+    """
+    Attaches the archive database to a SQLite connection as the "archive" schema, if it exists.
+
+    Parameters:
+        dbapi_connection: A sqlite3 connection.
+
+    Returns:
+        bool: True if the archive is attached to the connection.
+    """
+
+    databases = dbapi_connection.execute("pragma database_list").fetchall()
+    if any(name == "archive" for _, name, _ in databases):
+        return True
+
+    main = get_main_database_path(dbapi_connection)
+    if not main or not os.path.exists(get_archive_path(main)):
+        return False
+
+    dbapi_connection.execute("attach database ? as archive", (get_archive_path(main),))
+    return True
+
+
+@event.listens_for(Engine, "connect")
+def attach_archive_on_connect(dbapi_connection, connection_record):
+    """
+    Attaches the archive to every new SQLite connection whose database has one.
+    """
+
+    if hasattr(dbapi_connection, "create_function"):
+        attach_archive(dbapi_connection)
+
+
+def reads_archive(conn, table, since=None):
+    """
+    Checks whether a read of a session table since a date has to include the archive.
+
+    The archive is only needed when the requested range starts before the archive horizon of the
+    table. In that case it is attached to the connection if necessary. Only SQLite databases have
+    an archive.
+
+    Parameters:
+        conn (Connection): The connection the query will run on.
+        table (str): Either "training_sessions" or "coaching_sessions".
+        since (str, optional): The first date the query reads, in the format "YYYY-MM-DD".
+                               Defaults to the whole history.
+
+    Returns:
+        bool: True if the query must read the archived rows too.
+    """
+
+    if conn.dialect.name != "sqlite":
+        return False
+
+    ensure_tables(ArchiveState)
+    archived_before = run_query(conn, "archive_horizon", {"table_name": table}).scalar()
+
+    if archived_before is None or (since is not None and str(since) >= archived_before):
+        return False
+
+    return attach_archive(conn.connection.dbapi_connection)
+
+
+def sessions_table(conn, table, since=None):
+    """
+    Returns the selectable to read a session table from, including the archive only when needed.
+
+    When the requested range starts before the archive horizon of the table, the result is a
+    subquery that unions the main and archived rows. Otherwise the result is the table itself, so
+    queries on recent data only read the small main table. The subquery is built once per table,
+    so the statements built from it are cached like those of the plain table.
+
+    Parameters:
+        conn (Connection): The connection the query will run on.
+        table (str): Either "training_sessions" or "coaching_sessions".
+        since (str, optional): The first date the query reads, in the format "YYYY-MM-DD".
+                               Defaults to the whole history.
+
+    Returns:
+        FromClause: The table or the union subquery.
+    """
+
+    main = ARCHIVED_TABLES[table].__table__
+    if not reads_archive(conn, table, since):
+        return main
+
+    if table not in _archived_sources:
+        archived = main.to_metadata(MetaData(), schema="archive")
+        _archived_sources[table] = union_all(select(main), select(archived)).subquery(table)
+    return _archived_sources[table]
+
+
+def count_archived_rows(table):
+    """
+    Returns the number of rows of a session table that were moved to the archive.
+
+    Parameters:
+        table (str): Either "training_sessions" or "coaching_sessions".
+
+    Returns:
+        int: The number of archived rows.
+    """
+
+    ensure_tables(ArchiveState)
+    state = db.session.get(ArchiveState, table)
+    return state.rows if state else 0
+
+
+def enable_autoincrement(conn, table):
+    """
+    Makes sure a session table of the main database never hands out an ID again.
+
+    Without AUTOINCREMENT, SQLite gives a new row the highest ID in the table plus one, so once the
+    latest sessions are archived their IDs are reused and the union with the archive returns two
+    sessions with the same ID. Tables created before the models declared AUTOINCREMENT are rebuilt
+    with it, in one transaction. The sequence is then moved past the highest archived ID.
+
+    The archive must be attached to the connection.
+
+    Parameters:
+        conn (Connection): A connection to the main database.
+        table (str): Either "training_sessions" or "coaching_sessions".
+
+    Returns:
+        bool: True if the table was rebuilt.
+    """
+
+    definition = conn.execute(text("""
+    select sql from main.sqlite_master where type = 'table' and name = :table_name
+    """), {"table_name": table}).scalar()
+
+    rebuilt = "autoincrement" not in definition.lower()
+    if rebuilt:
+        model_table = ARCHIVED_TABLES[table].__table__
+        columns = ", ".join(column.name for column in model_table.columns)
+        conn.execute(text("drop table if exists main.%s_rebuilt" % table))
+        conn.execute(CreateTable(model_table.to_metadata(MetaData(), name=table + "_rebuilt")))
+        conn.execute(text("insert into main.%s_rebuilt (%s) select %s from main.%s" % (table, columns, columns, table)))
+        conn.execute(text("drop table main.%s" % table))
+        conn.execute(text("alter table main.%s_rebuilt rename to %s" % (table, table)))
+        for index in model_table.indexes:
+            index.create(conn)
+
+    archived = conn.execute(text("select max(id) from archive.%s" % table)).scalar()
+    if archived is not None:
+        updated = conn.execute(text("""
+        update main.sqlite_sequence set seq = max(seq, :archived) where name = :table_name
+        """), {"table_name": table, "archived": archived}).rowcount
+        if not updated:
+            conn.execute(text("""
+            insert into main.sqlite_sequence (name, seq) values (:table_name, :archived)
+            """), {"table_name": table, "archived": archived})
+
+    conn.commit()
+    return rebuilt
+
+
+def archive_sessions(before):
+    """
+    Moves the training and coaching sessions dated before a date to the archive database.
+
+    The archive tables are created on first use with an index on athlete and date. For each
+    table, copying the rows to the archive, deleting them from the main table and advancing the
+    archive horizon happen in one transaction. Beforehand, the table is made to never reuse the IDs
+    of the archived rows, see `enable_autoincrement`.
+
+    Parameters:
+        before (str): The archive horizon in the format "YYYY-MM-DD".
+
+    Returns:
+        dict: A dictionary mapping each table name to the number of rows moved.
+    """
+
+    ensure_tables(ArchiveState)
+    engine = db.engine
+    main = engine.url.database
+    if engine.dialect.name != "sqlite" or not main or main == ":memory:":
+        raise ValueError("Only file based SQLite databases can be archived.")
+
+    archive_engine = create_engine("sqlite:///" + get_archive_path(main))
+    for model in ARCHIVED_TABLES.values():
+        model.__table__.create(archive_engine, checkfirst=True)
+    with archive_engine.begin() as conn:
+        for table in ARCHIVED_TABLES:
+            conn.execute(text("create index if not exists ix_%s_athlete_date on %s (athlete_id, date)" % (table, table)))
+    archive_engine.dispose()
+
+    moved = {}
+    with engine.connect() as conn:
+        attach_archive(conn.connection.dbapi_connection)
+
+        for table in ARCHIVED_TABLES:
+            enable_autoincrement(conn, table)
+            conn.execute(text("""
+            insert into archive.%s select * from main.%s where date < :before
+            """ % (table, table)), {"before": before})
+            rows = conn.execute(text("""
+            delete from main.%s where date < :before
+            """ % table), {"before": before}).rowcount
+
+            conn.execute(text("""
+            insert into archive_state (table_name, archived_before, rows) values (:table_name, :before, :rows)
+                on conflict (table_name) do update set
+                archived_before = max(archived_before, excluded.archived_before),
+                rows = rows + excluded.rows
+            """), {"table_name": table, "before": before, "rows": rows})
+            conn.commit()
+            moved[table] = rows
+
+    return moved
+
+
+def get_archive_horizon(days):
+    """
+    Returns the archive horizon for a number of days of history kept in the main database.
+
+    Parameters:
+        days (int): The number of days of sessions to keep in the main database.
+
+    Returns:
+        str: The first date kept in the main database, in the format "YYYY-MM-DD".
+    """
+
+    return (datetime.today().date() - timedelta(days=days)).strftime("%Y-%m-%d")
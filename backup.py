@@ -0,0 +1,442 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime
+from flask import current_app, g
+from models import *
+from archive import get_archive_path
+
+
+class BackupRestarted(Exception):
+    """
+    Raised from the progress callback to stop a backup that keeps restarting, see `copy_database`.
+    """
+
+
+def get_backup_folder(schema="main"):
+    """
+    Returns the folder of the backups of a database of the current branch, creating it if needed.
+
+    Backups are kept under `BACKUP_FOLDER`, by default "backups" in the instance folder, with one
+    subfolder per branch and per database, for example "backups/main/archive" for the archive of
+    the main database.
+
+    Parameters:
+        schema (str): Either "main" for the database or "archive" for its archive.
+
+    Returns:
+        str: The path of the folder.
+    """
+
+    root = current_app.config.get("BACKUP_FOLDER") or os.path.join(current_app.instance_path, "backups")
+    folder = os.path.join(root, g.get("branch") or "main", schema)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def get_database_files():
+    """
+    Returns the SQLite files of the current branch: the database and, if it exists, its archive.
+
+    Returns:
+        dict: The paths of the files by schema, "main" and "archive".
+
+    Raises:
+        ValueError: If the database is not a SQLite file.
+    """
+
+    url = db.engine.url
+    if not url.drivername.startswith("sqlite") or url.database in (None, "", ":memory:"):
+        raise ValueError("Online backups need a SQLite database file, not %s." % url.drivername)
+
+    path = url.database[len("file:"):] if url.database.startswith("file:") else url.database
+    files = {"main": path}
+    if os.path.exists(get_archive_path(path)):
+        files["archive"] = get_archive_path(path)
+    return files
+
+
+def copy_database(source, target, pages=100, sleep=0.01, max_restarts=3, probe=False):
+    """
+    Copies a live SQLite database with the online backup API, a few pages at a time.
+
+    The source is read `pages` pages per step, with a pause of `sleep` seconds between steps.
+    A step only holds a read lock for the pages it copies, so in between the application's
+    writers run as usual. When a writer changes the source during the copy, SQLite starts the
+    copy again. After `max_restarts` restarts the rest is copied in one step, so a busy database
+    is still backed up, at the cost of one longer read lock.
+
+    With `probe`, a second connection takes the write lock of the source every `sleep` seconds
+    while the copy runs, and measures how long it had to wait for it. That is how long a writer
+    committing at the same moment would have been stalled by the backup. In WAL mode readers
+    never block writers, and the stalls stay near zero. The probe competes with the application
+    for the write lock, so it is only meant for benchmarking a backup, not for nightly runs.
+
+    Parameters:
+        source (str): The path of the database to copy.
+        target (str): The path of the copy. It is overwritten.
+        pages (int): The number of pages copied per step.
+        sleep (float): The pause between steps, in seconds.
+        max_restarts (int): The number of restarts after which the rest is copied in one step.
+        probe (bool): Whether to measure how long writers are stalled by the copy.
+
+    Returns:
+        dict: A dictionary with the following keys:
+            - steps (int): The number of steps.
+            - restarts (int): The number of times the copy started again.
+            - seconds (float): How long the copy took.
+            - lock_seconds (float): The total time the steps held the read lock.
+        With `probe`, also:
+            - max_stall_ms (float): The longest wait of the write-lock probe.
+            - total_stall_ms (float): The total wait of the write-lock probe.
+            - probes (int): The number of times the probe took the write lock.
+    """
+
+    result = {"steps": 0, "restarts": 0, "lock_seconds": 0.0}
+    if probe:
+        result.update(max_stall_ms=0.0, total_stall_ms=0.0, probes=0)
+    done = threading.Event()
+
+    def measure_stalls():
+        conn = sqlite3.connect(source, timeout=60, isolation_level=None)
+        try:
+            while not done.wait(sleep):
+                started = time.perf_counter()
+                conn.execute("begin exclusive")
+                conn.execute("rollback")
+                stall = (time.perf_counter() - started) * 1000
+                result["probes"] += 1
+                result["total_stall_ms"] += stall
+                result["max_stall_ms"] = max(result["max_stall_ms"], stall)
+        finally:
+            conn.close()
+
+    state = {"remaining": None, "step_started": time.perf_counter(), "single_step": False}
+
+    def progress(status, remaining, total):
+        result["steps"] += 1
+        result["lock_seconds"] += time.perf_counter() - state["step_started"]
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            result["restarts"] += 1
+            if result["restarts"] > max_restarts and not state["single_step"]:
+                raise BackupRestarted()
+        state["remaining"] = remaining
+        if remaining:
+            time.sleep(sleep)
+        state["step_started"] = time.perf_counter()
+
+    started = time.perf_counter()
+    prober = threading.Thread(target=measure_stalls, name="backup-stall-probe", daemon=True) if probe else None
+    if prober is not None:
+        prober.start()
+
+    src = sqlite3.connect(source, timeout=60)
+    try:
+        dst = sqlite3.connect(target)
+        try:
+            try:
+                src.backup(dst, pages=pages, progress=progress, sleep=sleep)
+            except BackupRestarted:
+                state["single_step"] = True
+                state["step_started"] = time.perf_counter()
+                src.backup(dst, pages=-1, progress=progress)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+        done.set()
+        if prober is not None:
+            prober.join()
+
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def hash_pages(path):
+    """
+    Reads a database file page by page and returns the SHA-1 digest of every page.
+
+    Parameters:
+        path (str): The path of the database file.
+
+    Returns:
+        tuple: The page size and the list of the page digests.
+    """
+
+    with open(path, "rb") as f:
+        header = f.read(100)
+        page_size = struct.unpack(">H", header[16:18])[0]
+        page_size = 65536 if page_size == 1 else page_size
+        f.seek(0)
+        digests = []
+        while True:
+            page = f.read(page_size)
+            if not page:
+                break
+            digests.append(hashlib.sha1(page).digest())
+    return page_size, digests
+
+
+def count_rows(path):
+    """
+    Counts the rows of every table of a database file.
+
+    Parameters:
+        path (str): The path of the database file.
+
+    Returns:
+        dict: The number of rows by table name.
+    """
+
+    conn = sqlite3.connect(path)
+    try:
+        tables = [row[0] for row in conn.execute("select name from sqlite_master where type = 'table'")]
+        return {table: conn.execute('select count(*) from "%s"' % table.replace('"', '""')).fetchone()[0]
+                for table in tables}
+    finally:
+        conn.close()
+
+
+def list_snapshots(folder):
+    """
+    Returns the snapshots kept in a backup folder, oldest first.
+
+    Parameters:
+        folder (str): The backup folder, see `get_backup_folder`.
+
+    Returns:
+        list: The manifests of the snapshots, see `backup_database`.
+    """
+
+    snapshots = []
+    for name in os.listdir(folder):
+        if name.endswith(".json"):
+            with open(os.path.join(folder, name)) as f:
+                snapshots.append(json.load(f))
+    return sorted(snapshots, key=lambda snapshot: snapshot["name"])
+
+
+def read_digests(folder, name):
+    """
+    Returns the page digests recorded with a snapshot.
+
+    Parameters:
+        folder (str): The backup folder.
+        name (str): The name of the snapshot.
+
+    Returns:
+        list: The SHA-1 digest of every page.
+    """
+
+    with open(os.path.join(folder, name + ".hashes"), "rb") as f:
+        data = f.read()
+    return [data[i:i + 20] for i in range(0, len(data), 20)]
+
+
+def backup_database(schema="main", full=False, pages=100, sleep=0.01, full_every=7, keep=4, probe=False):
+    """
+    Takes an online snapshot of a database of the current branch.
+
+    The database is copied with `copy_database` into a temporary file, without stopping the
+    application. The copy then becomes one of two kinds of snapshot:
+        - full: the whole copy is kept as "<name>.db", a database that can be opened as it is.
+        - incremental: only the pages that changed since the previous snapshot are kept, in
+          "<name>.delta". Pages are compared with the SHA-1 digests recorded with every snapshot.
+    A full snapshot starts a chain, followed by up to `full_every - 1` incremental snapshots.
+    Only the last `keep` chains are kept; older ones are deleted after a new full snapshot.
+
+    Every snapshot has a manifest, "<name>.json", with its kind, its chain, the page size and
+    count, the row count of every table and the timings of the copy.
+
+    Parameters:
+        schema (str): Either "main" for the database or "archive" for its archive.
+        full (bool): Whether to take a full snapshot even if the chain is not complete.
+        pages (int): The number of pages copied per step, see `copy_database`.
+        sleep (float): The pause between steps, in seconds.
+        full_every (int): The number of snapshots per chain, including the full one.
+        keep (int): The number of chains to keep.
+        probe (bool): Whether to measure how long writers are stalled by the copy, see `copy_database`.
+
+    Returns:
+        dict: The manifest of the snapshot.
+    """
+
+    source = get_database_files()[schema]
+    folder = get_backup_folder(schema)
+    name = datetime.now().strftime("%Y%m%d-%H%M%S")
+    while os.path.exists(os.path.join(folder, name + ".json")):
+        name = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+
+    snapshots = list_snapshots(folder)
+    previous = snapshots[-1] if snapshots else None
+    chain = [snapshot for snapshot in snapshots if previous and snapshot["base"] == previous["base"]]
+
+    fd, copy = tempfile.mkstemp(suffix=".db", dir=folder)
+    os.close(fd)
+    try:
+        timings = copy_database(source, copy, pages, sleep, probe=probe)
+        page_size, digests = hash_pages(copy)
+        manifest = {
+            "name": name,
+            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "source": source,
+            "page_size": page_size,
+            "page_count": len(digests),
+            "tables": count_rows(copy),
+            **timings
+        }
+
+        incremental = (not full and previous is not None and len(chain) < full_every
+                       and previous["page_size"] == page_size)
+        if incremental:
+            previous_digests = read_digests(folder, previous["name"])
+            changed = [number for number, digest in enumerate(digests)
+                       if number >= len(previous_digests) or previous_digests[number] != digest]
+            with open(copy, "rb") as f, gzip.open(os.path.join(folder, name + ".delta"), "wb") as delta:
+                for number in changed:
+                    f.seek(number * page_size)
+                    delta.write(struct.pack(">I", number) + f.read(page_size))
+            manifest.update(kind="incremental", base=previous["base"], parent=previous["name"], changed_pages=len(changed))
+            manifest["bytes"] = os.path.getsize(os.path.join(folder, name + ".delta"))
+        else:
+            os.replace(copy, os.path.join(folder, name + ".db"))
+            manifest.update(kind="full", base=name, parent=None, changed_pages=len(digests))
+            manifest["bytes"] = os.path.getsize(os.path.join(folder, name + ".db"))
+    finally:
+        if os.path.exists(copy):
+            os.remove(copy)
+
+    with open(os.path.join(folder, name + ".hashes"), "wb") as f:
+        f.write(b"".join(digests))
+    with open(os.path.join(folder, name + ".json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    manifest["deleted"] = prune_backups(folder, keep)
+    return manifest
+
+
+def prune_backups(folder, keep=4):
+    """
+    Deletes the chains of snapshots older than the last `keep` chains.
+
+    Parameters:
+        folder (str): The backup folder.
+        keep (int): The number of chains to keep.
+
+    Returns:
+        list: The names of the deleted snapshots.
+    """
+
+    snapshots = list_snapshots(folder)
+    bases = sorted({snapshot["base"] for snapshot in snapshots})
+    expired = set(bases[:-keep]) if keep > 0 else set()
+
+    deleted = []
+    for snapshot in snapshots:
+        if snapshot["base"] in expired:
+            for ext in (".db", ".delta", ".hashes", ".json"):
+                path = os.path.join(folder, snapshot["name"] + ext)
+                if os.path.exists(path):
+                    os.remove(path)
+            deleted.append(snapshot["name"])
+    return deleted
+
+
+def restore_snapshot(folder, name, target):
+    """
+    Rebuilds the database of a snapshot into a file.
+
+    The full snapshot of the chain is copied, then the pages of every incremental snapshot up to
+    `name` are written over it in order, and the file is cut to the page count of the snapshot.
+
+    Parameters:
+        folder (str): The backup folder.
+        name (str): The name of the snapshot.
+        target (str): The path of the rebuilt database. It is overwritten.
+
+    Returns:
+        dict: The manifest of the snapshot.
+
+    Raises:
+        ValueError: If the snapshot or one of its chain is missing.
+    """
+
+    snapshots = {snapshot["name"]: snapshot for snapshot in list_snapshots(folder)}
+    if name not in snapshots:
+        raise ValueError("There is no snapshot %s in %s." % (name, folder))
+
+    chain = [snapshots[name]]
+    while chain[-1]["parent"]:
+        if chain[-1]["parent"] not in snapshots:
+            raise ValueError("Snapshot %s is missing from the chain of %s." % (chain[-1]["parent"], name))
+        chain.append(snapshots[chain[-1]["parent"]])
+    chain.reverse()
+
+    shutil.copyfile(os.path.join(folder, chain[0]["name"] + ".db"), target)
+    page_size = chain[0]["page_size"]
+    with open(target, "r+b") as f:
+        for snapshot in chain[1:]:
+            with gzip.open(os.path.join(folder, snapshot["name"] + ".delta"), "rb") as delta:
+                while True:
+                    number = delta.read(4)
+                    if not number:
+                        break
+                    f.seek(struct.unpack(">I", number)[0] * page_size)
+                    f.write(delta.read(page_size))
+        f.truncate(snapshots[name]["page_count"] * page_size)
+
+    return snapshots[name]
+
+
+def verify_snapshot(folder, name):
+    """
+    Checks that a snapshot can be restored.
+
+    The snapshot is rebuilt into a temporary file with `restore_snapshot`. The restore is good
+    when every page matches the digest recorded at backup time, SQLite's `integrity_check`
+    passes and every table has the number of rows recorded in the manifest.
+
+    Parameters:
+        folder (str): The backup folder.
+        name (str): The name of the snapshot.
+
+    Returns:
+        list: The problems found, empty if the snapshot restores correctly.
+    """
+
+    fd, target = tempfile.mkstemp(suffix=".db", dir=folder)
+    os.close(fd)
+    try:
+        manifest = restore_snapshot(folder, name, target)
+        problems = []
+
+        _, digests = hash_pages(target)
+        mismatched = sum(1 for a, b in zip(digests, read_digests(folder, name)) if a != b)
+        if len(digests) != manifest["page_count"] or mismatched:
+            problems.append("%d of %d pages differ from the backup" % (
+                mismatched + abs(len(digests) - manifest["page_count"]), manifest["page_count"]))
+
+        conn = sqlite3.connect(target)
+        try:
+            integrity = [row[0] for row in conn.execute("pragma integrity_check")]
+        finally:
+            conn.close()
+        if integrity != ["ok"]:
+            problems.append("integrity check: %s" % "; ".join(integrity[:5]))
+
+        for table, count in count_rows(target).items():
+            if manifest["tables"].get(table) != count:
+                problems.append("%s has %d rows instead of %s" % (table, count, manifest["tables"].get(table)))
+
+        return problems
+    finally:
+        for path in (target, target + "-wal", target + "-shm", target + "-journal"):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,173 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, g, request, session
+from models import *
+from helpers import *
+
+
+def parse_branches(spec):
+    """
+    Parses the branch configuration string into a mapping of branch names to database URIs.
+
+    The configuration is a comma separated list of branches. Each entry is either a bare branch
+    name, which gets its own SQLite file named after the branch in the instance folder, or a
+    "name=uri" pair to point the branch at any database URI.
+
+    Example:
+        "downtown,marina=sqlite:///marina.db"
+
+    Parameters:
+        spec (str): The branch configuration string. May be empty or None.
+
+    Returns:
+        dict: A dictionary mapping each branch name to its database URI.
+    """
+
+    branches = {}
+    if not spec:
+        return branches
+
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, uri = entry.partition("=")
+        name = name.strip()
+        branches[name] = uri.strip() or "sqlite:///branch-%s.db" % name
+
+    return branches
+
+
+def configure_branches(app, spec=None):
+    """
+    Registers one database bind per branch on the Flask application.
+
+    Must be called before `db.init_app(app)` so Flask-SQLAlchemy creates an engine for every
+    branch. The branch names are stored in `app.config["BRANCHES"]` in configuration order.
+
+    Parameters:
+        app (Flask): The Flask application.
+        spec (str, optional): The branch configuration string, see `parse_branches`.
+
+    Returns:
+        None
+    """
+
+    branches = parse_branches(spec)
+    binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+    for name, uri in branches.items():
+        binds[BRANCH_BIND_PREFIX + name] = uri
+
+    app.config["BRANCHES"] = list(branches)
+    app.config.setdefault("BRANCH_WORKERS", max(len(branches), 1))
+
+
+def get_branches():
+    """
+    Returns the names of the configured branches.
+
+    Returns:
+        list: The branch names, or an empty list when the app runs on a single database.
+    """
+
+    return current_app.config.get("BRANCHES", [])
+
+
+def select_branch():
+    """
+    Selects the branch database for the current request.
+
+    The branch is taken from the "branch" query parameter when present, otherwise from the
+    branch chosen at login. Unknown branch names are ignored. When branches are configured
+    and none was chosen, the first configured branch is used. Requests from users who are
+    not logged in, such as the login page and database creation, use the main database.
+
+    Returns:
+        None
+    """
+
+    branches = get_branches()
+    if not branches or not session.get("logged_in"):
+        return
+
+    branch = request.args.get("branch") or session.get("branch")
+    g.branch = branch if branch in branches else branches[0]
+
+
+def run_on_branches(func, *args, **kwargs):
+    """
+    Runs a function against every branch database in a thread pool and collects the results.
+
+    Each call runs in its own application context with the branch selected, so the function
+    can use the models, `db.session` and `db.engine` exactly as a request for that branch would.
+
+    Parameters:
+        func (callable): The function to run for each branch.
+        *args, **kwargs: Arguments passed to every call of the function.
+
+    Returns:
+        dict: A dictionary mapping each branch name to the result of the function for that branch.
+    """
+
+    app = current_app._get_current_object()
+    branches = get_branches()
+
+    def run(branch):
+        with app.app_context():
+            g.branch = branch
+            return func(*args, **kwargs)
+
+    if not branches:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=app.config["BRANCH_WORKERS"]) as executor:
+        results = executor.map(run, branches)
+        return dict(zip(branches, results))
+
+
+def get_hq_summary():
+    """
+    Collects the dashboard counts, payments and competitions of every branch and merges them.
+
+    The per-branch queries are run in parallel by `run_on_branches`. The totals add up the
+    counts and fees of all branches, and the competitions of all branches are merged into
+    one list sorted by date, each tagged with the branch it belongs to.
+
+    Returns:
+        dict: A dictionary with the following keys:
+            - branches (list): One dictionary per branch with its name, counts and payments.
+            - totals (dict): The dashboard counts and payments summed over all branches.
+            - competitions (list): The competitions of all branches.
+    """
+
+    def branch_summary():
+        return {
+            "counts": get_dashboard_counts(),
+            "payments": get_payments_summary(),
+            "competitions": get_competitions_list()
+        }
+
+    results = run_on_branches(branch_summary)
+
+    totals = {"counts": {}, "payments": {}}
+    branches = []
+    competitions = []
+
+    for branch, result in results.items():
+        branches.append({
+            "name": branch,
+            "counts": result["counts"],
+            "payments": result["payments"]
+        })
+        for section in ("counts", "payments"):
+            for key, value in result[section].items():
+                totals[section][key] = totals[section].get(key, 0) + value
+        for comp in result["competitions"]:
+            competitions.append(dict(comp._mapping, branch=branch))
+
+    competitions.sort(key=lambda comp: comp["date"])
+
+    return {
+        "branches": branches,
+        "totals": totals,
+        "competitions": competitions
+    }
@@ -0,0 +1,255 @@
+import gzip
+import time
+import zlib
+from flask import current_app, g, request
+from models import *
+from queries import run_query
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_MIMETYPES = {
+    "text/html",
+    "text/plain",
+    "text/csv",
+    "text/css",
+    "text/event-stream",
+    "application/json",
+    "application/javascript"
+}
+
+COMPRESSION_BENCHMARK_PAGES = [
+    "/dashboard",
+    "/list-athletes",
+    "/list-training-sessions",
+    "/list-private-coaching",
+    "/list-competitions",
+    "/view-athlete/{athlete_id}?tab=profile",
+    "/view-athlete/{athlete_id}?tab=training-sessions",
+    "/view-athlete/{athlete_id}?tab=private-coaching",
+    "/view-athlete/{athlete_id}?tab=payments",
+    "/view-athlete/{athlete_id}?tab=competitions",
+    "/view-competition/{competition_id}",
+    "/api/v1/athletes?limit=500"
+]
+
+
+def get_encodings():
+    """
+    Returns the content encodings the application can produce, in order of preference.
+
+    Brotli is only offered when the `brotli` package is installed.
+
+    Returns:
+        list: The names of the encodings, for example ["br", "gzip"].
+    """
+
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def choose_encoding(accept_encodings):
+    """
+    Chooses the encoding of a response from the `Accept-Encoding` header of the request.
+
+    Parameters:
+        accept_encodings (Accept): The parsed `Accept-Encoding` header, see `request.accept_encodings`.
+
+    Returns:
+        str or None: The encoding with the highest quality for the client, preferring brotli on
+                     a tie, or None if the client accepts none of them.
+    """
+
+    return accept_encodings.best_match(get_encodings())
+
+
+def compress_data(data, encoding, level):
+    """
+    Compresses a complete response body.
+
+    Parameters:
+        data (bytes): The body.
+        encoding (str): Either "br" or "gzip".
+        level (int): The compression level, 1 to 9 for gzip and 0 to 11 for brotli.
+
+    Returns:
+        bytes: The compressed body.
+    """
+
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    Compresses a streamed response body chunk by chunk.
+
+    The compressor is flushed after every chunk, so each chunk reaches the browser as soon as
+    it is produced. That matters for the live dashboard, whose events would otherwise wait in
+    the compressor's buffer.
+
+    Parameters:
+        chunks (iterable): The chunks of the body, as bytes or str.
+        encoding (str): Either "br" or "gzip".
+        level (int): The compression level.
+
+    Yields:
+        bytes: The compressed chunks.
+    """
+
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        compress, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            yield compress(chunk) + flush()
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response):
+    """
+    Compresses a dynamic response with gzip or brotli when the client accepts it.
+
+    Only responses with a compressible mimetype (see `COMPRESSIBLE_MIMETYPES`) are compressed.
+    Responses that are already encoded, files sent with `send_file`, empty statuses and bodies
+    smaller than `COMPRESSION_MIN_SIZE` bytes are sent as they are. Streamed responses are
+    compressed chunk by chunk, see `compress_stream`. The compression levels are set with
+    `COMPRESSION_GZIP_LEVEL` and `COMPRESSION_BROTLI_LEVEL`.
+
+    Parameters:
+        response (Response): The response of the current request.
+
+    Returns:
+        Response: The response, compressed if worthwhile.
+    """
+
+    config = current_app.config
+    if not config["COMPRESSION"] or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 304) or request.method == "HEAD":
+        return response
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    level = config["COMPRESSION_BROTLI_LEVEL"] if encoding == "br" else config["COMPRESSION_GZIP_LEVEL"]
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config["COMPRESSION_MIN_SIZE"]:
+            return response
+        compressed = compress_data(data, encoding, level)
+        if len(compressed) >= len(data):
+            return response
+        response.set_data(compressed)
+
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app):
+    """
+    Compresses the dynamic responses of an application.
+
+    Flask runs the `after_request` functions in the reverse order of registration, so call this
+    before registering the other ones; the response is then compressed after they ran.
+
+    Parameters:
+        app (Flask): The application.
+
+    Returns:
+        None
+    """
+
+    app.config.setdefault("COMPRESSION", True)
+    app.config.setdefault("COMPRESSION_MIN_SIZE", 1024)
+    app.config.setdefault("COMPRESSION_GZIP_LEVEL", 6)
+    app.config.setdefault("COMPRESSION_BROTLI_LEVEL", 4)
+    app.after_request(compress_response)
+
+
+def run_compression_benchmark(app, branch=None, gzip_levels=(1, 6, 9), brotli_levels=(1, 4, 11), repeat=5):
+    """
+    Measures the CPU cost and the bytes saved by compressing the main pages.
+
+    Every page of `COMPRESSION_BENCHMARK_PAGES` is rendered once, uncompressed, with the IDs of
+    the first athlete and competition of the database. Its body is then compressed `repeat` times
+    at every level, keeping the fastest time, so the result is the cost of the compression alone.
+    Brotli levels are skipped when the `brotli` package is not installed.
+
+    Parameters:
+        app (Flask): The application.
+        branch (str, optional): The branch whose pages are rendered.
+        gzip_levels (iterable): The gzip levels to measure.
+        brotli_levels (iterable): The brotli levels to measure.
+        repeat (int): The number of times each body is compressed at each level.
+
+    Returns:
+        list: One dictionary per page with the "page", its uncompressed "bytes" and a list of
+              "results", one per encoding and level, with the "encoding", "level", compressed
+              "bytes", "saved" ratio and "milliseconds" of CPU time.
+    """
+
+    with app.app_context():
+        g.branch = branch
+        athlete_id = run_query(db.session, "athlete_id_range").first()[0]
+        competition_id = run_query(db.session, "first_competition_id").scalar()
+        db.session.rollback()
+    if athlete_id is None or competition_id is None:
+        raise ValueError("The database has no athletes or competitions. Seed it with `flask load-test-seed` first.")
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["logged_in"] = True
+        session["user"] = "admin"
+        session["branch"] = branch
+
+    settings = [("gzip", level) for level in gzip_levels]
+    if brotli is not None:
+        settings += [("br", level) for level in brotli_levels]
+
+    pages = []
+    for page in COMPRESSION_BENCHMARK_PAGES:
+        url = page.format(athlete_id=athlete_id, competition_id=competition_id)
+        response = client.get(url)
+        if response.status_code >= 400:
+            raise ValueError("%s returned %d" % (url, response.status_code))
+        data = response.get_data()
+
+        results = []
+        for encoding, level in settings:
+            best = None
+            for _ in range(repeat):
+                started = time.process_time()
+                compressed = compress_data(data, encoding, level)
+                elapsed = time.process_time() - started
+                best = elapsed if best is None else min(best, elapsed)
+            results.append({
+                "encoding": encoding,
+                "level": level,
+                "bytes": len(compressed),
+                "saved": 1 - len(compressed) / len(data) if data else 0,
+                "milliseconds": best * 1000
+            })
+
+        pages.append({"page": page, "bytes": len(data), "results": results})
+
+    return pages
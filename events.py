@@ -0,0 +1,265 @@
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from flask import current_app, g
+from models import *
+from queries import *
+
+
+def record_change_event(kind, counts=None, **details):
+    """
+    Appends an event to the change-event outbox.
+
+    The event is added to the current database session, so it is committed together with the
+    change it describes. The caller commits the transaction.
+
+    Parameters:
+        kind (str): The kind of change, for example "athlete" or "training_session".
+        counts (dict, optional): The change of each dashboard counter, for example {"athletes": 1}.
+        **details: The details of the change, sent to the dashboards as they are.
+
+    Returns:
+        None
+    """
+
+    ensure_tables(ChangeEvent, conn=db.session.connection())
+    run_query(db.session, "record_change_event", {
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "kind": kind,
+        "payload": json.dumps(dict(details, counts=counts or {}))
+    })
+
+
+def get_change_events(conn, after_id, limit=500):
+    """
+    Reads the events following a position of the outbox.
+
+    Parameters:
+        conn (Connection): The connection to read with.
+        after_id (int): The ID of the last event already seen.
+        limit (int): The largest number of events to return.
+
+    Returns:
+        list: Dictionaries with the "id", "created_at" and "kind" of each event and the fields
+              of its payload, in the order of the outbox.
+    """
+
+    result = run_query(conn, "change_events_after", {"after_id": after_id, "limit": limit})
+
+    return [dict(json.loads(row.payload), id=row.id, created_at=row.created_at, kind=row.kind) for row in result]
+
+
+def get_delivery_position(events, position, gap_seconds):
+    """
+    Returns how far the events read from the outbox can be delivered without skipping one.
+
+    On database servers the ID of an event is allocated before its transaction commits, so event
+    N can become visible after event N + 1 was read. Delivering N + 1 would then lose N, as the
+    subscribers only ask for the events after the last one they saw. A missing ID is therefore
+    waited for while the event after it is younger than `gap_seconds`; an older gap is a
+    transaction that was rolled back, and is skipped. On SQLite, writes are serialized and the
+    IDs never have gaps.
+
+    Parameters:
+        events (list): The events after `position`, in the order of the outbox.
+        position (int): The ID of the last event delivered.
+        gap_seconds (float): How long a missing ID is waited for.
+
+    Returns:
+        int: The ID of the last event that can be delivered.
+    """
+
+    waited_since = (datetime.now() - timedelta(seconds=gap_seconds)).strftime("%Y-%m-%d %H:%M:%S")
+    for event in events:
+        if event["id"] != position + 1 and event["created_at"] >= waited_since:
+            break
+        position = event["id"]
+    return position
+
+
+class ChangeEventTail:
+    """
+    Follows the change-event outbox of one database and hands new events to its subscribers.
+
+    A background thread polls the outbox every `poll_interval` seconds and keeps the latest
+    `buffer_size` events in memory. Every open dashboard waits on the tail instead of querying
+    the database itself, so any number of screens costs a single query per poll. Old events are
+    pruned from the outbox every `prune_interval` seconds, keeping the latest `retention` events.
+    Events are handed out in the order of their IDs, holding back behind a missing ID for up to
+    `gap_seconds`, see `get_delivery_position`.
+
+    Attributes:
+        app (Flask): The application the tail reads in.
+        branch (str): The branch whose outbox is followed, or None for the main database.
+        poll_interval (float): The seconds between two reads of the outbox.
+        buffer_size (int): The number of recent events kept in memory.
+        retention (int): The number of events kept in the outbox when pruning.
+        prune_interval (float): The seconds between two prunes of the outbox.
+        gap_seconds (float): How long the tail waits for a missing ID before skipping it.
+    """
+
+    def __init__(self, app, branch=None, poll_interval=0.5, buffer_size=1000, retention=10000, prune_interval=600,
+                 gap_seconds=10):
+        self.app = app
+        self.branch = branch
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.gap_seconds = gap_seconds
+        self.events = deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+
+        with app.app_context():
+            g.branch = branch
+            ensure_tables(ChangeEvent)
+            with db.read_engine.connect() as conn:
+                start = max(run_query(conn, "last_change_event_id").scalar() - buffer_size, 0)
+                recent = get_change_events(conn, start, buffer_size)
+
+        last_id = get_delivery_position(recent, start, gap_seconds)
+        recent = [event for event in recent if event["id"] <= last_id]
+        self.events.extend(recent)
+        self.last_id = last_id
+        self.floor = recent[0]["id"] - 1 if recent else last_id
+        self.thread = threading.Thread(target=self.run, name="change-events-%s" % (branch or "main"), daemon=True)
+        self.thread.start()
+
+    def wait(self, after_id, timeout):
+        """
+        Waits until there are events after a position, or until the timeout.
+
+        Parameters:
+            after_id (int): The ID of the last event the subscriber has seen.
+            timeout (float): The longest time in seconds to wait.
+
+        Returns:
+            list or None: The buffered events after `after_id`, empty if none arrived in time, or
+                          None if some of them are no longer buffered and the subscriber must reload.
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.last_id > after_id, timeout)
+            if after_id < self.floor:
+                return None
+            return [event for event in self.events if event["id"] > after_id]
+
+    def poll(self):
+        """
+        Reads the new events of the outbox and wakes up the subscribers.
+
+        Returns:
+            None
+        """
+
+        with self.app.app_context():
+            g.branch = self.branch
+            with db.read_engine.connect() as conn:
+                events = get_change_events(conn, self.last_id)
+
+        position = get_delivery_position(events, self.last_id, self.gap_seconds)
+        events = [event for event in events if event["id"] <= position]
+        if not events:
+            return
+
+        with self.condition:
+            for event in events:
+                if len(self.events) == self.events.maxlen:
+                    self.floor = self.events[0]["id"]
+                self.events.append(event)
+            self.last_id = events[-1]["id"]
+            self.condition.notify_all()
+
+    def prune(self):
+        """
+        Deletes all but the latest `retention` events from the outbox.
+
+        Returns:
+            None
+        """
+
+        with self.app.app_context():
+            g.branch = self.branch
+            with db.engine.begin() as conn:
+                run_query(conn, "prune_change_events", {"last_id": self.last_id - self.retention})
+
+    def run(self):
+        """
+        Polls the outbox until the process exits.
+        """
+
+        next_prune = time.monotonic() + self.prune_interval
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+                if time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + self.prune_interval
+                    self.prune()
+            except Exception:
+                self.app.logger.exception("Reading the change events of %s failed", self.branch or "main")
+
+
+_tails = {}
+_tails_lock = threading.Lock()
+
+
+def get_change_event_tail():
+    """
+    Returns the outbox tail of the branch selected for the current request, starting it if needed.
+
+    Returns:
+        ChangeEventTail: The tail of the current branch.
+    """
+
+    app = current_app._get_current_object()
+    key = (id(app), g.get("branch"))
+
+    with _tails_lock:
+        if key not in _tails:
+            _tails[key] = ChangeEventTail(
+                app,
+                branch=g.get("branch"),
+                poll_interval=app.config["CHANGE_EVENTS_POLL_SECONDS"],
+                buffer_size=app.config["CHANGE_EVENTS_BUFFER"],
+                retention=app.config["CHANGE_EVENTS_RETENTION"],
+                gap_seconds=app.config["CHANGE_EVENTS_GAP_SECONDS"]
+            )
+        return _tails[key]
+
+
+def stream_change_events(tail, after_id, keep_alive=15, duration=300):
+    """
+    Generates the Server-Sent Events stream of an outbox after a position.
+
+    Every event is sent as a "change" event with its outbox ID, so a reconnecting browser resumes
+    with the `Last-Event-ID` header. A comment is sent when nothing happened for `keep_alive`
+    seconds, to keep the connection open. When the position is no longer buffered, a "reset"
+    event tells the page to reload. The stream ends after `duration` seconds so the worker is
+    freed; the browser reconnects by itself.
+
+    Parameters:
+        tail (ChangeEventTail): The tail of the outbox to follow.
+        after_id (int): The ID of the last event the page has seen.
+        keep_alive (float): The longest time in seconds without sending anything.
+        duration (float): The time in seconds after which the stream ends.
+
+    Yields:
+        str: The chunks of the stream.
+    """
+
+    deadline = time.monotonic() + duration
+
+    yield "retry: 3000\n\n"
+    while time.monotonic() < deadline:
+        events = tail.wait(after_id, min(keep_alive, max(deadline - time.monotonic(), 0)))
+        if events is None:
+            yield "event: reset\ndata: {}\n\n"
+            return
+        if not events:
+            yield ": keep-alive\n\n"
+            continue
+        for event in events:
+            yield "id: %d\nevent: change\ndata: %s\n\n" % (event["id"], json.dumps(event))
+        after_id = events[-1]["id"]
@@ -0,0 +1,268 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from flask import current_app, g
+from models import *
+
+
+class GroupCommitter:
+    """
+    Collects writes from many requests and commits them together in one transaction.
+
+    Requests hand their write to the committer and wait. A background thread takes the first
+    waiting write, keeps collecting writes until the batch is full or the maximum delay has
+    passed, runs them all in one transaction and commits once. Every request is answered
+    only after that commit returned, so an acknowledged write is durable.
+
+    If a write in the batch raises, the batch is rolled back and its writes are run again
+    one transaction each, so a single bad write does not fail the others. Any other error of the
+    thread fails the writes of the batch it was working on, and the thread carries on.
+
+    Attributes:
+        app (Flask): The application the writes run in.
+        branch (str): The branch whose database the writes go to, or None for the main database.
+        max_batch (int): The largest number of writes committed together.
+        max_delay (float): The longest time in seconds a write waits for others to join its batch.
+        timeout (float): The longest time in seconds a request waits for its write to be committed.
+    """
+
+    def __init__(self, app, branch=None, max_batch=32, max_delay=0.005, timeout=30):
+        self.app = app
+        self.branch = branch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.commits = 0
+        self.writes = 0
+        self.recent_commits = deque()
+        self.thread = threading.Thread(target=self.run, name="group-commit-%s" % (branch or "main"), daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues a write and waits until it has been committed.
+
+        If the committer thread is no longer running, the write is committed in the request's own
+        transaction instead, as without group commit.
+
+        Parameters:
+            func (callable): The function doing the write with `db.session`. It must not commit.
+            *args, **kwargs: The arguments of the function.
+
+        Returns:
+            The return value of the function.
+
+        Raises:
+            TimeoutError: The write was still queued after `timeout` seconds. It is cancelled and
+                          never runs. A write whose batch is already running is waited for until
+                          the batch ends, so a write is never reported as failed once committed.
+        """
+
+        if not self.thread.is_alive():
+            result = func(*args, **kwargs)
+            db.session.commit()
+            return result
+
+        future = Future()
+        self.queue.put((future, func, args, kwargs))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            if not future.cancel():
+                return future.result()
+            raise TimeoutError("The write was not committed within %s seconds." % self.timeout)
+
+    def collect(self, batch):
+        """
+        Waits for the next write and collects the writes arriving shortly after it.
+
+        The writes are added to `batch` as they are taken from the queue, so the caller can fail
+        them if collecting raises.
+
+        Parameters:
+            batch (list): The list to add the writes to.
+
+        Returns:
+            list: The writes of the batch.
+        """
+
+        batch.append(self.queue.get())
+        deadline = time.perf_counter() + self.max_delay
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def commit(self, batch):
+        """
+        Runs a batch of writes in one transaction and commits it.
+
+        Parameters:
+            batch (list): The writes to run.
+
+        Returns:
+            list: The return values of the writes.
+        """
+
+        results = [func(*args, **kwargs) for _, func, args, kwargs in batch]
+        db.session.commit()
+
+        with self.lock:
+            now = time.perf_counter()
+            self.commits += 1
+            self.writes += len(batch)
+            self.recent_commits.append((now, len(batch)))
+            while self.recent_commits and self.recent_commits[0][0] < now - 60:
+                self.recent_commits.popleft()
+
+        return results
+
+    def run(self):
+        """
+        Commits batches of writes until the process exits.
+        """
+
+        while True:
+            batch = []
+            try:
+                # Writes whose request gave up waiting were cancelled and are left out.
+                batch = [write for write in self.collect(batch) if write[0].set_running_or_notify_cancel()]
+                if not batch:
+                    continue
+
+                with self.app.app_context():
+                    g.branch = self.branch
+                    try:
+                        results = self.commit(batch)
+                    except Exception:
+                        db.session.rollback()
+                        for write in batch:
+                            self.retry(write)
+                        continue
+
+                for (future, _, _, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                self.app.logger.exception("The group commit of %s failed", self.branch or "main")
+                for future, _, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def retry(self, write):
+        """
+        Runs and commits a single write of a failed batch on its own.
+
+        Parameters:
+            write (tuple): The write to run.
+
+        Returns:
+            None
+        """
+
+        future = write[0]
+        try:
+            result = self.commit([write])[0]
+        except Exception as e:
+            db.session.rollback()
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def get_stats(self):
+        """
+        Returns the commit statistics of the committer.
+
+        Returns:
+            dict: The total number of commits and writes, the average batch size, and the
+                  commits and writes per second over the last minute.
+        """
+
+        with self.lock:
+            now = time.perf_counter()
+            recent = [(at, size) for at, size in self.recent_commits if at >= now - 60]
+            return {
+                "commits": self.commits,
+                "writes": self.writes,
+                "average_batch_size": self.writes / self.commits if self.commits else 0,
+                "commits_per_second": len(recent) / 60,
+                "writes_per_second": sum(size for _, size in recent) / 60,
+                "queued": self.queue.qsize()
+            }
+
+
+_committers = {}
+_committers_lock = threading.Lock()
+
+
+def get_group_committer():
+    """
+    Returns the group committer of the branch selected for the current request, starting it if needed.
+
+    Returns:
+        GroupCommitter: The committer of the current branch.
+    """
+
+    app = current_app._get_current_object()
+    key = (id(app), g.get("branch"))
+
+    with _committers_lock:
+        if key not in _committers:
+            _committers[key] = GroupCommitter(
+                app,
+                branch=g.get("branch"),
+                max_batch=app.config["GROUP_COMMIT_MAX_BATCH"],
+                max_delay=app.config["GROUP_COMMIT_MAX_DELAY_MS"] / 1000,
+                timeout=app.config["GROUP_COMMIT_TIMEOUT_SECONDS"]
+            )
+        return _committers[key]
+
+
+def commit_write(func, *args, **kwargs):
+    """
+    Runs a write and commits it, through the group committer when group commit is enabled.
+
+    Without group commit the write runs in the request's own transaction, which is committed
+    right away. With group commit the write is handed to the committer of the current branch
+    and the call returns once the shared transaction has been committed.
+
+    Parameters:
+        func (callable): The function doing the write with `db.session`. It must not commit.
+        *args, **kwargs: The arguments of the function.
+
+    Returns:
+        The return value of the function.
+    """
+
+    if not current_app.config.get("GROUP_COMMIT"):
+        result = func(*args, **kwargs)
+        db.session.commit()
+        return result
+
+    return get_group_committer().submit(func, *args, **kwargs)
+
+
+def get_group_commit_stats():
+    """
+    Returns the statistics of all group committers of the current application.
+
+    Returns:
+        dict: A dictionary mapping each branch name ("main" for the main database) to the
+              statistics of its committer.
+    """
+
+    app = current_app._get_current_object()
+    with _committers_lock:
+        committers = [committer for (app_id, _), committer in _committers.items() if app_id == id(app)]
+
+    return {committer.branch or "main": committer.get_stats() for committer in committers}
@@ -1,8 +1,13 @@
 import calendar
 from datetime import datetime, timedelta
-from sqlalchemy import text
+from flask import current_app
+from sqlalchemy import text, inspect, select
 from models import *
 from fixtures import *
+from archive import *
+from metrics import record_cache_lookup
+from events import *
+from queries import *
 
 
 def create_database_schema():
@@ -18,11 +23,18 @@ def create_database_schema():
         - Training plans with details such as name, price, number of sessions, and permissions.
         - Weight categories with details such as name, minimum weight, and maximum weight.
 
+    The schema is created on `db.engine`, so when a branch is selected the tables are created
+    in that branch's database. New SQLite databases use incremental auto-vacuum, so
+    `flask db-maintain` can release free pages without rewriting the file.
+
     Returns:
         None
     """
 
-    db.create_all()
+    if db.engine.dialect.name == "sqlite":
+        with db.engine.connect() as conn:
+            conn.execute(text("pragma auto_vacuum = incremental"))
+    db.metadata.create_all(bind=db.engine)
     for plan, details in training_plans.items():
         training_plan = TrainingPlan(
             name=plan,
@@ -42,6 +54,23 @@ def create_database_schema():
     db.session.commit()
 
 
+def create_missing_database_schema():
+    """
+    Creates the database schema with `create_database_schema`, unless the database already has it.
+
+    Used for the branch databases, so creating them again does not add the initial data twice.
+
+    Returns:
+        bool: True if the schema was created.
+    """
+
+    if inspect(db.engine).has_table(Athlete.__tablename__):
+        return False
+
+    create_database_schema()
+    return True
+
+
 def get_week_start_end_dates(dt=None):
     """
     Calculates the start and end dates of the week containing the given date.
@@ -151,10 +180,9 @@ def can_athlete_register_training_session(athlete_id, dt=None):
 
     week_start, week_end = get_week_start_end_dates(dt)
 
-    sessions = TrainingSession.query.filter_by(
-        athlete_id=athlete_id).filter(TrainingSession.date.between(week_start, week_end)).all()
+    sessions = count_athlete_sessions("training_sessions", athlete_id, week_start, week_end)
 
-    return len(sessions) < training_plan.num_of_sessions
+    return sessions < training_plan.num_of_sessions
 
 
 def can_athlete_register_coaching_session(athlete_id, dt=None):
@@ -179,11 +207,10 @@ def can_athlete_register_coaching_session(athlete_id, dt=None):
 
     week_start, week_end = get_week_start_end_dates(dt)
 
-    sessions = CoachingSession.query.filter_by(
-        athlete_id=athlete_id).filter(CoachingSession.date.between(week_start, week_end)).all()
+    sessions = count_athlete_sessions("coaching_sessions", athlete_id, week_start, week_end)
 
     if training_plan.can_attend_private_coaching:
-        return len(sessions) < training_plan.private_coaching_max_sessions
+        return sessions < training_plan.private_coaching_max_sessions
     else:
         return False
 
@@ -228,14 +255,8 @@ def get_competitions_summary(athlete_id):
             - participants_count (int): The number of participants registered for the competition.
     """
 
-    with db.engine.connect() as conn:
-        query = """
-            select cp.name, cp.date, cp.entry_fee from competition_registrations as cr
-                join competitions as cp on cp.id = cr.competition_id
-                where cr.athlete_id = %d
-            """ % athlete_id
-
-        raw = conn.execute(text(query))
+    with db.read_engine.connect() as conn:
+        raw = run_query(conn, "athlete_competitions", {"athlete_id": athlete_id})
         competitions = raw.fetchall()
 
     return competitions
@@ -257,14 +278,8 @@ def calculate_competition_fees(athlete_id):
         float: The total competition fees for the athlete within the specified date range.
     """
 
-    with db.engine.connect() as conn:
-        query = """
-        select sum(cp.entry_fee) from competition_registrations as cr
-	        join competitions as cp on cp.id = cr.competition_id
-	        where cr.athlete_id = %d
-        """ % athlete_id
-
-        raw = conn.execute(text(query))
+    with db.read_engine.connect() as conn:
+        raw = run_query(conn, "athlete_competition_fees", {"athlete_id": athlete_id})
         competitions = raw.fetchall()
 
     return competitions[0][0] if competitions[0][0] else 0
@@ -287,16 +302,9 @@ def training_sessions_per_week(athlete_id):
               and the number of training sessions attended in that week.
     """
 
-    with db.engine.connect() as conn:
-        query = """
-        select strftime('%%W', date) WeekNumber,
-            max(date(date, 'weekday 0', '-7 day')) WeekStart, max(date(date, 'weekday 0', '-1 day')) WeekEnd,
-            count(*) as NumSessions
-            from training_sessions
-            where athlete_id = %d group by WeekNumber
-        """ % athlete_id
-
-        raw = conn.execute(text(query))
+    with db.read_engine.connect() as conn:
+        raw = run_query(conn, "training_sessions_per_week", {"athlete_id": athlete_id},
+                        training_sessions=sessions_table(conn, "training_sessions"))
         training_sessions = raw.fetchall()
 
         return training_sessions
@@ -304,26 +312,19 @@ def training_sessions_per_week(athlete_id):
 
 def calculate_training_fees(athlete_id):
     """
-    Calculates the total training fees for an athlete within a specified date range.
+    Calculates the total training fees for an athlete.
 
-    This function queries the database to sum up the fees for all training sessions
-    and private coaching sessions attended by the athlete between the given start and end dates.
+    The fees are the sum of the training plan fees stored in the athlete's weekly charge
+    snapshots. Weeks marked as dirty are recomputed first.
 
     Parameters:
         athlete_id (int): The ID of the athlete.
-        start_date (datetime.date): The start date of the period for which to calculate the fees.
-        end_date (datetime.date): The end date of the period for which to calculate the fees.
 
     Returns:
-        float: The total training fees for the athlete within the specified date range.
+        float: The total training fees for the athlete.
     """
-    training_sessions = training_sessions_per_week(athlete_id)
-    num_of_weeks = len(training_sessions)
-    athlete_plan_fee = get_training_plan(
-        get_athelete_training_plan(athlete_id)).price
-    total_fee = num_of_weeks * athlete_plan_fee
 
-    return total_fee
+    return sum([week.plan_fee for week in get_weekly_charges(athlete_id)])
 
 
 def coaching_sessions_per_week(athlete_id):
@@ -341,16 +342,503 @@ def coaching_sessions_per_week(athlete_id):
         int: The number of private coaching sessions the athlete has in the specified week.
     """
 
-    with db.engine.connect() as conn:
-        query = """
-        select strftime('%%W', date) WeekNumber,
-            max(date(date, 'weekday 0', '-7 day')) WeekStart, max(date(date, 'weekday 0', '-1 day')) WeekEnd,
-            count(*) as NumSessions, sum(tuition_fees) as 'total_fees'
-            from coaching_sessions
-            where athlete_id = %d group by WeekNumber
-        """ % athlete_id
-
-        raw = conn.execute(text(query))
+    with db.read_engine.connect() as conn:
+        raw = run_query(conn, "coaching_sessions_per_week", {"athlete_id": athlete_id},
+                        coaching_sessions=sessions_table(conn, "coaching_sessions"))
         coaching_sessions = raw.fetchall()
 
         return coaching_sessions
+
+
+def get_dashboard_counts():
+    """
+    Retrieves the number of athletes, competitions, training sessions and coaching sessions.
+
+    Archived sessions are counted from the archive state, without reading the archive.
+
+    Returns:
+        dict: A dictionary with the keys "athletes", "competitions", "training_sessions" and "coaching_sessions".
+    """
+
+    return {
+        "athletes": Athlete.query.count(),
+        "competitions": Competition.query.count(),
+        "training_sessions": TrainingSession.query.count() + count_archived_rows("training_sessions"),
+        "coaching_sessions": CoachingSession.query.count() + count_archived_rows("coaching_sessions")
+    }
+
+
+def get_dashboard_snapshot():
+    """
+    Retrieves the dashboard counts together with the position of the change-event outbox they include.
+
+    The counts and the ID of the latest change event are read with a single statement, so they
+    describe the same moment. A live dashboard applies the events after that ID on top of the
+    counts without counting a change twice or missing one.
+
+    On database servers, an event with a lower ID may still be committing, see
+    `get_delivery_position`. The position is then moved back before the missing ID, and the
+    changes of the events after it are taken out of the counts, as the dashboard will receive them.
+
+    Returns:
+        dict: The dashboard counts, see `get_dashboard_counts`, and the position of the change
+              events they include under "last_event_id".
+    """
+
+    ensure_tables(ChangeEvent)
+    with db.read_engine.connect() as conn:
+        if conn.dialect.name == "sqlite":
+            snapshot = dict(run_query(conn, "dashboard_snapshot").one()._mapping)
+        else:
+            # The counts and the recent events are read from the same snapshot of the database.
+            conn.execution_options(isolation_level="REPEATABLE READ")
+            snapshot = dict(run_query(conn, "dashboard_snapshot").one()._mapping)
+            start = max(snapshot["last_event_id"] - current_app.config["CHANGE_EVENTS_BUFFER"], 0)
+            recent = get_change_events(conn, start, current_app.config["CHANGE_EVENTS_BUFFER"])
+            position = get_delivery_position(recent, start, current_app.config["CHANGE_EVENTS_GAP_SECONDS"])
+            for event in recent:
+                if event["id"] > position:
+                    for counter, change in event["counts"].items():
+                        snapshot[counter] -= change
+            snapshot["last_event_id"] = position
+
+    snapshot["training_sessions"] += count_archived_rows("training_sessions")
+    snapshot["coaching_sessions"] += count_archived_rows("coaching_sessions")
+    return snapshot
+
+
+def get_competitions_list():
+    """
+    Retrieves all competitions with their weight category and number of participants.
+
+    Returns:
+        list: A list of rows with the keys id, competition_name, date, entry_fee,
+              participants_count and weight_category.
+    """
+
+    with db.read_engine.connect() as conn:
+        result = run_query(conn, "list_competitions")
+        competitions = result.fetchall()
+
+    return competitions
+
+
+def get_payments_summary():
+    """
+    Calculates the training, coaching and competition fees due from all athletes.
+
+    Uses the same rules as the per-athlete payments tab: the totals are summed from the weekly
+    charge snapshots of all athletes, after recomputing every dirty week.
+
+    Returns:
+        dict: A dictionary with the keys "training_fees", "coaching_fees", "competition_fees" and "total".
+    """
+
+    refresh_charge_snapshots()
+
+    with db.read_engine.connect() as conn:
+        training_fees, coaching_fees, competition_fees = run_query(conn, "payments_summary").one()
+
+    summary = {
+        "training_fees": training_fees or 0,
+        "coaching_fees": coaching_fees or 0,
+        "competition_fees": competition_fees or 0
+    }
+    summary["total"] = sum(summary.values())
+    return summary
+
+
+def dispose_inherited_connections():
+    """
+    Drops the database connections a worker process inherited from its parent.
+
+    Worker processes started with fork share the parent's pooled connections. The pools are
+    replaced without closing those connections, so the parent can keep using them.
+
+    Returns:
+        None
+    """
+
+    for engine in db.engines.values():
+        engine.dispose(close=False)
+
+
+def ensure_charge_snapshots(conn=None):
+    """
+    Creates the charge snapshots table in the current database if it does not exist yet.
+
+    When the table is created, every week in which an athlete already has training sessions,
+    private coaching sessions or competitions is added as a dirty snapshot, so existing
+    history is computed the first time it is read.
+
+    Parameters:
+        conn (Connection, optional): The connection of an open transaction to create the table in.
+                                     Defaults to a new transaction.
+
+    Returns:
+        None
+    """
+
+    ensure_tables(ChargeSnapshot, conn=conn, populate=lambda conn: run_query(
+        conn, "backfill_charge_snapshots",
+        training_sessions=sessions_table(conn, "training_sessions"),
+        coaching_sessions=sessions_table(conn, "coaching_sessions")))
+
+
+def mark_charge_week_dirty(athlete_id, dt):
+    """
+    Marks the week containing a date as dirty in the charge snapshots of an athlete.
+
+    The change is added to the current database session, so it is committed together with the
+    session or registration that caused it.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+        dt (str): A date in the week, in the format "YYYY-MM-DD".
+
+    Returns:
+        None
+    """
+
+    ensure_charge_snapshots(db.session.connection())
+    week_start, week_end = get_week_start_end_dates(dt)
+
+    run_query(db.session, "mark_charge_week_dirty",
+              {"athlete_id": athlete_id, "week_start": week_start, "week_end": week_end})
+
+
+def mark_athlete_charges_dirty(athlete_id):
+    """
+    Marks all weeks of an athlete as dirty in the charge snapshots.
+
+    Used when the training plan of the athlete changes, as the plan fee of every week is charged
+    at the price of the current plan. The change is added to the current database session.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+
+    Returns:
+        None
+    """
+
+    ensure_charge_snapshots(db.session.connection())
+    run_query(db.session, "mark_athlete_charges_dirty", {"athlete": athlete_id})
+
+
+def refresh_charge_snapshots(athlete_id=None):
+    """
+    Recomputes the charges of all dirty weeks of an athlete, or of all athletes.
+
+    All dirty weeks are recomputed from the raw sessions with a single statement. The training
+    plan fee is charged for every week with at least one training session, at the price of the
+    athlete's current plan. The archive is only read when a dirty week is older than its horizon.
+
+    Parameters:
+        athlete_id (int, optional): The ID of the athlete. Defaults to all athletes.
+
+    Returns:
+        None
+    """
+
+    ensure_charge_snapshots()
+    params = {"athlete": athlete_id}
+    suffix = "_athlete" if athlete_id is not None else ""
+
+    with db.engine.begin() as conn:
+        since = run_query(conn, "first_dirty%s_charge_week" % suffix, params).scalar()
+        record_cache_lookup("charge_snapshots", since is None)
+        if since is None:
+            return
+
+        run_query(conn, "refresh%s_charge_snapshots" % suffix, params,
+                  training_sessions=sessions_table(conn, "training_sessions", since),
+                  coaching_sessions=sessions_table(conn, "coaching_sessions", since))
+
+
+def get_weekly_charges(athlete_id):
+    """
+    Retrieves the weekly charge snapshots of an athlete, recomputing dirty weeks first.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+
+    Returns:
+        list: The ChargeSnapshot objects of the athlete, ordered by week.
+    """
+
+    refresh_charge_snapshots(athlete_id)
+    return ChargeSnapshot.query.filter_by(athlete_id=athlete_id).order_by(ChargeSnapshot.week_start).all()
+
+
+def rebuild_athlete_summary(athlete_id):
+    """
+    Recomputes the summary of an athlete from the sessions, registrations and training plan.
+
+    Used when an athlete is added and when the training plan changes, as the training fees of
+    all weeks are charged at the price of the current plan. The summary is written in the
+    current database session; the caller commits it.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+
+    Returns:
+        None
+    """
+
+    ensure_tables(AthleteSummary, conn=db.session.connection())
+    week_start, week_end = get_week_start_end_dates()
+    conn = db.session.connection()
+
+    run_query(db.session, "rebuild_athlete_summary",
+              {"athlete_id": athlete_id, "week_start": week_start, "week_end": week_end},
+              training_sessions=sessions_table(conn, "training_sessions"),
+              coaching_sessions=sessions_table(conn, "coaching_sessions"))
+
+
+def update_athlete_summary(athlete_id, dt, training_sessions=0, coaching_sessions=0, fees=0):
+    """
+    Applies a change of the sessions or fees of an athlete to the athlete's summary.
+
+    The weekly counts only change when the summary is for the week of `dt`; a summary of a past
+    week is rebuilt from the sessions anyway when the roster is next read. Adding the first
+    training session of a week charges the plan fee of the week, and removing the last one
+    refunds it, with the same rules as the charge snapshots. The change is made in the current
+    database session, so it is committed together with the session or registration that caused
+    it. The caller commits the transaction.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+        dt (str): The date of the session or competition in the format "YYYY-MM-DD".
+        training_sessions (int): The number of training sessions added, or removed if negative.
+        coaching_sessions (int): The number of private coaching sessions added.
+        fees (float): The coaching or competition fees added to the balance.
+
+    Returns:
+        None
+    """
+
+    ensure_tables(AthleteSummary, conn=db.session.connection())
+    week_start, week_end = get_week_start_end_dates(dt)
+
+    training_weeks = 0
+    if training_sessions:
+        sessions = run_query(db.session, "count_athlete_sessions",
+                             {"athlete_id": athlete_id, "start": week_start, "end": week_end},
+                             sessions=sessions_table(db.session.connection(), "training_sessions", week_start)).scalar()
+        if sessions == max(training_sessions, 0):
+            training_weeks = 1 if training_sessions > 0 else -1
+
+    run_query(db.session, "update_athlete_summary", {
+        "athlete": athlete_id,
+        "current_week": week_start,
+        "training_delta": training_sessions,
+        "coaching_delta": coaching_sessions,
+        "fees": fees,
+        "training_weeks": training_weeks
+    })
+
+
+def refresh_athlete_summaries():
+    """
+    Rebuilds the summaries that are missing or belong to a past week.
+
+    This is the lazy weekly reset: the first roster read of a week recomputes every summary for
+    the new week, and later reads only check that there is nothing to rebuild. Athletes added
+    without a summary, for example by `flask load-test-seed`, are picked up the same way.
+
+    Returns:
+        None
+    """
+
+    ensure_tables(AthleteSummary)
+    week_start, week_end = get_week_start_end_dates()
+    params = {"week_start": week_start, "week_end": week_end}
+
+    with db.read_engine.connect() as conn:
+        stale = run_query(conn, "stale_athlete_summaries", params).scalar()
+    record_cache_lookup("athlete_summaries", not stale)
+    if not stale:
+        return
+
+    with db.engine.begin() as conn:
+        run_query(conn, "rebuild_stale_athlete_summaries", params,
+                  training_sessions=sessions_table(conn, "training_sessions"),
+                  coaching_sessions=sessions_table(conn, "coaching_sessions"))
+
+
+def get_athlete_roster():
+    """
+    Retrieves the athletes with their training plan and the figures of their summary.
+
+    Returns:
+        list: One row per athlete with the keys id, fullname, gender, age, weight, training_plan,
+              can_attend_competitions, training_sessions and coaching_sessions (this week),
+              remaining_sessions (the training sessions left in this week's quota) and balance.
+    """
+
+    refresh_athlete_summaries()
+
+    with db.read_engine.connect() as conn:
+        return run_query(conn, "list_athletes").fetchall()
+
+
+def count_athlete_sessions(table, athlete_id, start, end):
+    """
+    Counts the sessions of an athlete between two dates, including archived sessions if needed.
+
+    Parameters:
+        table (str): Either "training_sessions" or "coaching_sessions".
+        athlete_id (int): The ID of the athlete.
+        start (str): The first date in the format "YYYY-MM-DD".
+        end (str): The last date in the format "YYYY-MM-DD".
+
+    Returns:
+        int: The number of sessions.
+    """
+
+    with db.read_engine.connect() as conn:
+        return run_query(conn, "count_athlete_sessions", {"athlete_id": athlete_id, "start": start, "end": end},
+                         sessions=sessions_table(conn, table, start)).scalar()
+
+
+def get_athlete_sessions(table, athlete_id):
+    """
+    Retrieves the full session history of an athlete, including archived sessions.
+
+    Parameters:
+        table (str): Either "training_sessions" or "coaching_sessions".
+        athlete_id (int): The ID of the athlete.
+
+    Returns:
+        list: The sessions of the athlete ordered by date, as rows with the columns of the table.
+    """
+
+    with db.read_engine.connect() as conn:
+        return run_query(conn, "athlete_sessions", {"athlete_id": athlete_id},
+                         sessions=sessions_table(conn, table)).fetchall()
+
+
+def lock_athlete(athlete_id):
+    """
+    Locks the row of an athlete until the end of the current transaction.
+
+    On database servers this serializes concurrent check-ins of the same athlete without
+    blocking other athletes. SQLite has no row locks and ignores the lock; there, the
+    conditional insert of `register_training_session` and `register_coaching_session` runs
+    under the database write lock from the start of the statement.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+
+    Returns:
+        None
+    """
+
+    db.session.execute(select(Athlete.id).where(Athlete.id == athlete_id).with_for_update())
+
+
+def register_training_session(athlete_id, dt):
+    """
+    Adds a training session for an athlete if the weekly limit of the athlete's plan allows it.
+
+    The limit check and the insert are a single conditional insert statement, so two concurrent
+    check-ins of the same athlete cannot both pass the check. The session is added to the
+    current transaction; the caller commits it.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+        dt (str): The date of the session in the format "YYYY-MM-DD".
+
+    Returns:
+        bool: True if the session was added, False if the athlete reached the weekly limit.
+    """
+
+    week_start, week_end = get_week_start_end_dates(dt)
+    lock_athlete(athlete_id)
+
+    result = run_query(db.session, "register_training_session", {
+        "athlete_id": athlete_id,
+        "date": dt,
+        "week_start": week_start,
+        "week_end": week_end
+    }, training_sessions=sessions_table(db.session.connection(), "training_sessions", week_start))
+    return result.rowcount == 1
+
+
+def register_coaching_session(athlete_id, dt, tuition_fees):
+    """
+    Adds a private coaching session for an athlete if the athlete's plan allows it.
+
+    The plan must allow private coaching and the athlete must be below the plan's weekly
+    maximum. As with `register_training_session`, the check and the insert are one statement
+    and the caller commits the transaction.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+        dt (str): The date of the session in the format "YYYY-MM-DD".
+        tuition_fees (float): The tuition fees of the session.
+
+    Returns:
+        bool: True if the session was added, False otherwise.
+    """
+
+    week_start, week_end = get_week_start_end_dates(dt)
+    lock_athlete(athlete_id)
+
+    result = run_query(db.session, "register_coaching_session", {
+        "athlete_id": athlete_id,
+        "date": dt,
+        "tuition_fees": tuition_fees,
+        "week_start": week_start,
+        "week_end": week_end
+    }, coaching_sessions=sessions_table(db.session.connection(), "coaching_sessions", week_start))
+    return result.rowcount == 1
+
+
+def check_in_training_session(athlete_id, dt):
+    """
+    Adds a training session for an athlete and marks the week of the session as dirty in the charge snapshots.
+
+    This is the complete write of a training check-in, including the athlete's roster summary and
+    its change event for the live dashboards. It does not commit, so it can share a transaction
+    with other check-ins; see `commit_write`.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+        dt (str): The date of the session in the format "YYYY-MM-DD".
+
+    Returns:
+        bool: True if the session was added, False if the athlete reached the weekly limit.
+    """
+
+    if not register_training_session(athlete_id, dt):
+        return False
+
+    mark_charge_week_dirty(athlete_id, dt)
+    update_athlete_summary(athlete_id, dt, training_sessions=1)
+    record_change_event("training_session", {"training_sessions": 1}, athlete_id=int(athlete_id), date=dt)
+    return True
+
+
+def check_in_coaching_session(athlete_id, dt, tuition_fees):
+    """
+    Adds a private coaching session for an athlete and marks the week of the session as dirty in the charge snapshots.
+
+    Like `check_in_training_session`, it does not commit.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+        dt (str): The date of the session in the format "YYYY-MM-DD".
+        tuition_fees (float): The tuition fees of the session.
+
+    Returns:
+        bool: True if the session was added, False otherwise.
+    """
+
+    if not register_coaching_session(athlete_id, dt, tuition_fees):
+        return False
+
+    mark_charge_week_dirty(athlete_id, dt)
+    update_athlete_summary(athlete_id, dt, coaching_sessions=1, fees=float(tuition_fees))
+    record_change_event("coaching_session", {"coaching_sessions": 1}, athlete_id=int(athlete_id), date=dt)
+    return True
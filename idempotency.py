@@ -0,0 +1,177 @@
+import hashlib
+import json
+import uuid
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import Response, abort, current_app, make_response, request
+from models import *
+from queries import *
+from metrics import record_cache_lookup
+
+
+def new_idempotency_key():
+    """
+    Returns a new idempotency key, for the hidden `idempotency_key` field of a form.
+
+    The key is drawn when the form is rendered, so every submission of the same form, including
+    the retries of a tablet that lost the response, carries the same key.
+
+    Returns:
+        str: A random UUID.
+    """
+
+    return str(uuid.uuid4())
+
+
+def get_request_fingerprint():
+    """
+    Returns a hash of the route and the form of the current request, without its idempotency key.
+
+    Returns:
+        str: The SHA-256 hash, in hexadecimal.
+    """
+
+    form = sorted((name, value) for name, value in request.form.items(multi=True) if name != "idempotency_key")
+    payload = json.dumps([request.endpoint, request.view_args, form], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def claim_idempotency_key(key, fingerprint):
+    """
+    Claims an idempotency key for the current request, or returns the response it was given.
+
+    A key that was never seen is claimed. A key claimed by a request that is still running is
+    refused, unless the claim is older than `IDEMPOTENCY_PENDING_SECONDS`: its request is then
+    assumed to have died and the claim is taken over.
+
+    Parameters:
+        key (str): The idempotency key.
+        fingerprint (str): The fingerprint of the request, see `get_request_fingerprint`.
+
+    Returns:
+        tuple: (claimed, row), where claimed (bool) is whether the current request holds the key and
+               row is the stored key, or None if it was never seen.
+    """
+
+    ensure_tables(IdempotencyKey)
+    now = datetime.now()
+    claimed_at = now.strftime("%Y-%m-%d %H:%M:%S")
+
+    with db.engine.begin() as conn:
+        row = run_query(conn, "idempotency_key", {"idempotency_key": key}).fetchone()
+        if row is None:
+            result = run_query(conn, "claim_idempotency_key", {
+                "idempotency_key": key, "fingerprint": fingerprint, "claimed_at": claimed_at
+            })
+            return result.rowcount == 1, None
+        if row.status is not None or row.fingerprint != fingerprint:
+            return False, row
+
+        stale_before = now - timedelta(seconds=current_app.config["IDEMPOTENCY_PENDING_SECONDS"])
+        result = run_query(conn, "take_over_idempotency_key", {
+            "idempotency_key": key, "stale_before": stale_before.strftime("%Y-%m-%d %H:%M:%S"),
+            "claimed_at": claimed_at
+        })
+        return result.rowcount == 1, row
+
+
+def store_idempotent_response(key, response):
+    """
+    Stores the response given to the request holding an idempotency key, and prunes the old keys.
+
+    Keys older than `IDEMPOTENCY_KEY_SECONDS` are deleted, and only the latest `IDEMPOTENCY_MAX_KEYS`
+    are kept, so the table stays small however many forms are submitted.
+
+    Parameters:
+        key (str): The idempotency key.
+        response (Response): The response of the view, before compression.
+
+    Returns:
+        None
+    """
+
+    expired_before = datetime.now() - timedelta(seconds=current_app.config["IDEMPOTENCY_KEY_SECONDS"])
+    with db.engine.begin() as conn:
+        run_query(conn, "store_idempotent_response", {
+            "idempotency_key": key,
+            "response_status": response.status_code,
+            "response_location": response.headers.get("Location"),
+            "response_content_type": response.content_type,
+            "response_body": response.get_data()
+        })
+        run_query(conn, "prune_idempotency_keys", {
+            "expired_before": expired_before.strftime("%Y-%m-%d %H:%M:%S"),
+            "max_keys": current_app.config["IDEMPOTENCY_MAX_KEYS"]
+        })
+
+
+def release_idempotency_key(key):
+    """
+    Releases the claim of the current request on an idempotency key, so the request can be retried.
+
+    Parameters:
+        key (str): The idempotency key.
+
+    Returns:
+        None
+    """
+
+    with db.engine.begin() as conn:
+        run_query(conn, "release_idempotency_key", {"idempotency_key": key})
+
+
+def idempotent(f):
+    """
+    A decorator that makes the retries of a form submission return the response of the first one.
+
+    The key is read from the `Idempotency-Key` header, or from the hidden `idempotency_key` field
+    the forms render with `new_idempotency_key`. The first request with a key runs the route and
+    its response is stored with the key, unless it is a server error. A retry with the same key and
+    the same form gets the stored response back, with the `Idempotent-Replayed: true` header, without
+    running the route: no quota query, no duplicate session and no weekly slot used twice.
+
+    A retry arriving while the first request is still running gets a 409 error, and a key reused
+    with another form or route gets a 422 error. Requests without a key run as usual.
+
+    Must be applied after `read_your_writes`.
+
+    Parameters:
+        f (callable): The route function.
+
+    Returns:
+        callable: The decorated route function.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key") or request.form.get("idempotency_key")
+        if request.method in ("GET", "HEAD") or not key:
+            return f(*args, **kwargs)
+
+        fingerprint = get_request_fingerprint()
+        claimed, row = claim_idempotency_key(key, fingerprint)
+        if not claimed:
+            if row is not None and row.fingerprint != fingerprint:
+                abort(422)
+            if row is None or row.status is None:
+                abort(409)
+            record_cache_lookup("idempotency", True)
+            response = Response(row.body, status=row.status, content_type=row.content_type)
+            if row.location:
+                response.headers["Location"] = row.location
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        record_cache_lookup("idempotency", False)
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            release_idempotency_key(key)
+            raise
+
+        if response.status_code >= 500:
+            release_idempotency_key(key)
+        else:
+            store_idempotent_response(key, response)
+        return response
+    return decorated_function
@@ -0,0 +1,238 @@
+import calendar
+import time
+import multiprocessing
+from datetime import datetime, timedelta
+from flask import g
+from models import *
+from helpers import *
+
+
+def get_period_dates(period):
+    """
+    Returns the first and last day of an invoicing period.
+
+    Parameters:
+        period (str): The month in the format "YYYY-MM".
+
+    Returns:
+        tuple: The first and last day of the month as "YYYY-MM-DD" strings.
+    """
+
+    start = datetime.strptime(period, "%Y-%m").date()
+    end = start.replace(day=calendar.monthrange(start.year, start.month)[1])
+    return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+
+def plan_invoice_run(period, partitions):
+    """
+    Splits the athletes into ID ranges for an invoice run, or returns the ranges of an interrupted run.
+
+    When the period already has partitions, they are reused so the run resumes where it stopped.
+    Athletes added since then get a new partition after the last existing range.
+
+    Parameters:
+        period (str): The month to invoice in the format "YYYY-MM".
+        partitions (int): The number of ID ranges to create for a new run.
+
+    Returns:
+        list: The IDs of the partitions that are not finished yet.
+    """
+
+    first_id, last_id = run_query(db.session, "athlete_id_range").one()
+    if first_id is None:
+        return []
+
+    existing = InvoiceRunPartition.query.filter_by(period=period).order_by(InvoiceRunPartition.first_id).all()
+
+    if not existing:
+        size = max((last_id - first_id + 1) // partitions + 1, 1)
+        for start in range(first_id, last_id + 1, size):
+            db.session.add(InvoiceRunPartition(
+                period=period,
+                first_id=start,
+                last_id=min(start + size - 1, last_id),
+                last_athlete_id=start - 1,
+                athletes=0,
+                finished=False
+            ))
+    elif existing[-1].last_id < last_id:
+        start = existing[-1].last_id + 1
+        db.session.add(InvoiceRunPartition(
+            period=period,
+            first_id=start,
+            last_id=last_id,
+            last_athlete_id=start - 1,
+            athletes=0,
+            finished=False
+        ))
+
+    db.session.commit()
+
+    pending = InvoiceRunPartition.query.filter_by(period=period, finished=False).all()
+    return [partition.id for partition in pending]
+
+
+def compute_invoices(period, first_id, last_id):
+    """
+    Computes the invoices of a range of athletes for a month with one query per fee type.
+
+    A training week is invoiced in the month its Monday falls in, at the price of the athlete's
+    training plan. Private coaching sessions and competitions are invoiced in the month of their date.
+
+    Parameters:
+        period (str): The month to invoice in the format "YYYY-MM".
+        first_id (int): The first athlete ID of the range.
+        last_id (int): The last athlete ID of the range.
+
+    Returns:
+        dict: A dictionary mapping athlete IDs to dictionaries with the invoice amounts.
+              Athletes with nothing to pay are left out.
+    """
+
+    month_start, month_end = get_period_dates(period)
+    weeks_end = (datetime.strptime(month_end, "%Y-%m-%d") + timedelta(days=6)).strftime("%Y-%m-%d")
+    params = {
+        "first_id": first_id,
+        "last_id": last_id,
+        "period": period,
+        "month_start": month_start,
+        "month_end": month_end,
+        "weeks_end": weeks_end
+    }
+
+    invoices = {}
+
+    def invoice(athlete_id):
+        return invoices.setdefault(athlete_id, {
+            "training_weeks": 0,
+            "training_fees": 0,
+            "coaching_fees": 0,
+            "competition_fees": 0
+        })
+
+    with db.engine.connect() as conn:
+        training_sessions = sessions_table(conn, "training_sessions", month_start)
+        for row in run_query(conn, "invoice_training_fees", params, training_sessions=training_sessions):
+            invoice(row.athlete_id)["training_weeks"] = row.weeks
+            invoice(row.athlete_id)["training_fees"] = row.weeks * row.price
+
+        coaching_sessions = sessions_table(conn, "coaching_sessions", month_start)
+        for row in run_query(conn, "invoice_coaching_fees", params, coaching_sessions=coaching_sessions):
+            invoice(row.athlete_id)["coaching_fees"] = row.fees or 0
+
+        for row in run_query(conn, "invoice_competition_fees", params):
+            invoice(row.athlete_id)["competition_fees"] = row.fees or 0
+
+    for amounts in invoices.values():
+        amounts["total"] = amounts["training_fees"] + amounts["coaching_fees"] + amounts["competition_fees"]
+
+    return invoices
+
+
+def run_partition(partition_id, batch_size=500):
+    """
+    Invoices the athletes of one partition, resuming after its last checkpoint.
+
+    Athletes are processed in batches in ID order. The invoices of a batch are written by first
+    deleting any invoices of the same athletes and period, so re-running a batch never creates
+    duplicates. The partition checkpoint is advanced in the same transaction.
+
+    Parameters:
+        partition_id (int): The ID of the partition.
+        batch_size (int): The number of athletes invoiced per transaction.
+
+    Returns:
+        int: The number of athletes invoiced by this call.
+    """
+
+    partition = db.session.get(InvoiceRunPartition, partition_id)
+    period = partition.period
+    processed = 0
+
+    while True:
+        athlete_ids = run_query(db.session, "invoice_batch_athlete_ids", {
+            "last_athlete_id": partition.last_athlete_id,
+            "last_id": partition.last_id,
+            "batch_size": batch_size
+        }).scalars().all()
+
+        if not athlete_ids:
+            partition.finished = True
+            db.session.commit()
+            return processed
+
+        first_id, last_id = athlete_ids[0], athlete_ids[-1]
+        invoices = compute_invoices(period, first_id, last_id)
+        now = datetime.now()
+
+        Invoice.query.filter(Invoice.period == period,
+                             Invoice.athlete_id.between(first_id, last_id)).delete()
+        db.session.add_all([Invoice(athlete_id=athlete_id, period=period, created_at=now, **amounts)
+                            for athlete_id, amounts in invoices.items()])
+
+        partition.last_athlete_id = last_id
+        partition.athletes += len(athlete_ids)
+        db.session.commit()
+        processed += len(athlete_ids)
+
+
+def run_partition_worker(args):
+    """
+    Runs one partition of an invoice run in a worker process.
+
+    Parameters:
+        args (tuple): The branch, the partition ID and the batch size.
+
+    Returns:
+        int: The number of athletes invoiced.
+    """
+
+    from trainingtally import app
+
+    branch, partition_id, batch_size = args
+    with app.app_context():
+        dispose_inherited_connections()
+        g.branch = branch
+        return run_partition(partition_id, batch_size)
+
+
+def run_invoices(period, processes=4, batch_size=500, restart=False):
+    """
+    Runs the month-end invoicing of all athletes of the current branch over a pool of processes.
+
+    The athletes are split into ID ranges, several per process so that fast ranges do not leave
+    processes idle. An interrupted run is resumed from the checkpoints of its partitions unless
+    `restart` is set.
+
+    Parameters:
+        period (str): The month to invoice in the format "YYYY-MM".
+        processes (int): The number of worker processes.
+        batch_size (int): The number of athletes invoiced per transaction.
+        restart (bool): Discard the checkpoints of a previous run of the same period.
+
+    Returns:
+        dict: A dictionary with the number of "athletes" invoiced, the "seconds" the run took
+              and the "throughput" in athletes per second.
+    """
+
+    ensure_tables(Invoice, InvoiceRunPartition)
+    if restart:
+        InvoiceRunPartition.query.filter_by(period=period).delete()
+        db.session.commit()
+
+    started = time.perf_counter()
+    partitions = plan_invoice_run(period, processes * 4)
+    work = [(g.get("branch"), partition_id, batch_size) for partition_id in partitions]
+
+    athletes = 0
+    if work:
+        with multiprocessing.Pool(min(processes, len(work))) as pool:
+            for processed in pool.imap_unordered(run_partition_worker, work):
+                athletes += processed
+
+    seconds = time.perf_counter() - started
+    return {
+        "athletes": athletes,
+        "seconds": seconds,
+        "throughput": athletes / seconds if seconds else 0
+    }
@@ -0,0 +1,320 @@
+import csv
+import json
+import os
+import time
+import multiprocessing
+from datetime import datetime, timedelta
+from flask import current_app, g
+from models import *
+from helpers import *
+
+
+JOB_HANDLERS = {}
+
+
+def job_handler(kind):
+    """
+    A decorator that registers a function as the handler of a job kind.
+
+    The handler is called with the job parameters as keyword arguments, plus `path`, the file
+    the handler writes its result to, and `progress`, a callable taking (done, total) that
+    records the progress of the job.
+
+    Parameters:
+        kind (str): The name of the job kind.
+
+    Returns:
+        decorator: A decorator that registers the function and returns it unchanged.
+    """
+
+    def decorator(f):
+        JOB_HANDLERS[kind] = f
+        return f
+    return decorator
+
+
+def get_reports_folder():
+    """
+    Returns the folder where job results are written, creating it if needed.
+
+    Returns:
+        str: The path of the "reports" folder inside the instance folder.
+    """
+
+    folder = os.path.join(current_app.instance_path, "reports")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def enqueue_job(kind, **params):
+    """
+    Adds a job to the queue and returns immediately.
+
+    The job runs against the branch selected for the current request.
+
+    Parameters:
+        kind (str): The name of the job kind.
+        **params: The parameters of the job. Must be JSON serializable.
+
+    Returns:
+        Job: The queued job.
+    """
+
+    if kind not in JOB_HANDLERS:
+        raise ValueError("Unknown job kind: %s" % kind)
+
+    ensure_tables(Job)
+    job = Job(
+        kind=kind,
+        params=json.dumps(params),
+        branch=g.get("branch"),
+        status="queued",
+        progress=0,
+        created_at=datetime.now()
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def get_job_status(job):
+    """
+    Returns the status of a job in a JSON serializable form.
+
+    Parameters:
+        job (Job): The job.
+
+    Returns:
+        dict: A dictionary with the id, kind, status, progress, error and download URL of the job.
+              The download URL is None until the job is done.
+    """
+
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": job.progress,
+        "error": job.error,
+        "download_url": "/jobs/%d/download" % job.id if job.status == "done" else None
+    }
+
+
+def fail_stale_jobs(timeout):
+    """
+    Marks as failed the jobs that have been running for longer than a timeout.
+
+    A job stays "running" for good when its worker is killed while running it, and its status
+    page would poll forever. Such jobs are failed so the user can queue the report again.
+
+    Parameters:
+        timeout (float): The longest time in seconds a job may run.
+
+    Returns:
+        int: The number of jobs marked as failed.
+    """
+
+    started_before = datetime.now() - timedelta(seconds=timeout)
+    stale = Job.query.filter(Job.status == "running", Job.started_at < started_before).update(
+        {"status": "failed", "error": "The worker running the job stopped.", "finished_at": datetime.now()})
+    db.session.commit()
+    return stale
+
+
+def claim_next_job():
+    """
+    Takes the oldest queued job off the queue.
+
+    The job is marked as running with a conditional update, so when several workers poll the
+    queue at the same time only one of them gets each job. Jobs running for longer than
+    `JOB_TIMEOUT_SECONDS` are failed first, see `fail_stale_jobs`.
+
+    Returns:
+        Job or None: The claimed job, or None if the queue is empty.
+    """
+
+    fail_stale_jobs(current_app.config["JOB_TIMEOUT_SECONDS"])
+    while True:
+        job = Job.query.filter_by(status="queued").order_by(Job.id).first()
+        if job is None:
+            return None
+
+        claimed = Job.query.filter_by(id=job.id, status="queued").update(
+            {"status": "running", "started_at": datetime.now()})
+        db.session.commit()
+
+        if claimed:
+            return db.session.get(Job, job.id)
+
+
+def run_job(job):
+    """
+    Runs a claimed job and records its result.
+
+    The handler runs against the branch the job was queued from. On success the job is marked
+    as done with the path of its result; if the handler raises, the job is marked as failed
+    with the error message. A job whose worker is interrupted, for example with Ctrl+C, is
+    marked as failed before the interruption is passed on.
+
+    Parameters:
+        job (Job): The claimed job.
+
+    Returns:
+        None
+    """
+
+    job_id = job.id
+    path = os.path.join(get_reports_folder(), "job-%d.csv" % job_id)
+
+    def progress(done, total):
+        percent = int(done * 100 / total) if total else 100
+        Job.query.filter_by(id=job_id).update({"progress": percent})
+        db.session.commit()
+
+    g.branch = job.branch
+    try:
+        JOB_HANDLERS[job.kind](path=path, progress=progress, **json.loads(job.params))
+    except Exception as e:
+        db.session.rollback()
+        Job.query.filter_by(id=job_id).update(
+            {"status": "failed", "error": str(e), "finished_at": datetime.now()})
+    except BaseException:
+        db.session.rollback()
+        Job.query.filter_by(id=job_id).update(
+            {"status": "failed", "error": "The worker was stopped.", "finished_at": datetime.now()})
+        db.session.commit()
+        raise
+    else:
+        Job.query.filter_by(id=job_id).update(
+            {"status": "done", "progress": 100, "result_path": path, "finished_at": datetime.now()})
+    finally:
+        g.pop("branch", None)
+    db.session.commit()
+
+
+def work(poll_interval=1.0, once=False):
+    """
+    Runs jobs from the queue until stopped.
+
+    Parameters:
+        poll_interval (float): Seconds to wait before polling again when the queue is empty.
+        once (bool): Stop as soon as the queue is empty instead of waiting for new jobs.
+
+    Returns:
+        None
+    """
+
+    from trainingtally import app
+
+    with app.app_context():
+        dispose_inherited_connections()
+        ensure_tables(Job)
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            with app.app_context():
+                run_job(db.session.get(Job, job.id))
+
+
+def start_workers(processes=2, poll_interval=1.0, once=False):
+    """
+    Starts a pool of worker processes that run jobs from the queue.
+
+    Parameters:
+        processes (int): The number of worker processes.
+        poll_interval (float): Seconds a worker waits before polling again when the queue is empty.
+        once (bool): Stop the workers as soon as the queue is empty.
+
+    Returns:
+        None
+    """
+
+    workers = [multiprocessing.Process(target=work, args=(poll_interval, once))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+@job_handler("athlete-payments")
+def export_athlete_payments(athlete_id, path, progress):
+    """
+    Writes the full payment history of an athlete to a CSV file.
+
+    The report contains the same lines as the payments tab of the athlete page: one line per
+    training week, one per coaching week and one per competition, followed by the total.
+    The weekly lines are read from the athlete's charge snapshots.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+        path (str): The path of the CSV file to write.
+        progress (callable): Records the progress of the job.
+
+    Returns:
+        None
+    """
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Item", "Week start", "Week end", "Sessions", "Amount"])
+
+        weekly_charges = get_weekly_charges(athlete_id)
+        for week in weekly_charges:
+            if week.training_sessions:
+                writer.writerow(["Training plan", week.week_start, week.week_end,
+                                 week.training_sessions, week.plan_fee])
+        progress(1, 3)
+
+        for week in weekly_charges:
+            if week.coaching_sessions:
+                writer.writerow(["Private coaching", week.week_start, week.week_end,
+                                 week.coaching_sessions, week.coaching_fees])
+        progress(2, 3)
+
+        competitions = get_competitions_summary(athlete_id)
+        for comp in competitions:
+            writer.writerow(["Competition: %s" % comp.name, comp.date, comp.date, "", comp.entry_fee])
+
+        total = sum([week.plan_fee + week.coaching_fees + week.competition_fees for week in weekly_charges])
+        writer.writerow(["Total", "", "", "", total])
+        progress(3, 3)
+
+
+@job_handler("roster")
+def export_roster(path, progress, batch_size=500):
+    """
+    Writes the list of athletes with their training plan to a CSV file.
+
+    Athletes are read in batches ordered by ID so progress can be reported while the export runs.
+
+    Parameters:
+        path (str): The path of the CSV file to write.
+        progress (callable): Records the progress of the job.
+        batch_size (int): The number of athletes read per query.
+
+    Returns:
+        None
+    """
+
+    total = Athlete.query.count()
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ID", "Name", "Gender", "Age", "Weight", "Training Plan"])
+
+        done = 0
+        last_id = 0
+        with db.engine.connect() as conn:
+            while True:
+                rows = run_query(conn, "export_athletes", {"last_id": last_id, "batch_size": batch_size}).fetchall()
+                if not rows:
+                    break
+                writer.writerows(rows)
+                done += len(rows)
+                last_id = rows[-1].id
+                progress(done, total)
@@ -0,0 +1,591 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import urllib.error
+import urllib.request
+from datetime import datetime
+from flask import current_app
+from models import *
+from helpers import *
+from api import ApiError
+
+
+KIOSK_MAX_BATCH = 500
+
+KIOSK_ERRORS = {
+    "not-loaded": "The kiosk has not loaded the athletes from the central server yet.",
+    "unknown-athlete": "The athlete is not known to the central server.",
+    "no-coaching": "The athlete's training plan does not include private coaching.",
+    "limit": "Athlete has reached the maximum number of sessions for the week.",
+    "invalid": "The check-in is not valid."
+}
+
+
+class KioskSyncError(Exception):
+    """
+    The central server could not be reached, or refused a request of the kiosk.
+    """
+
+
+# Central server
+
+def get_kiosk_snapshot():
+    """
+    Returns what a kiosk needs to check athletes in on its own.
+
+    The session counts of the week are read from the athlete summaries of the roster, so the
+    snapshot costs one query however many sessions the athletes have.
+
+    Returns:
+        dict: A dictionary with the following keys:
+            - week_start, week_end (str): The current week.
+            - training_plans (list): The plans, with their weekly limits.
+            - athletes (list): The athletes with their plan and their training and coaching
+                               sessions of the current week.
+    """
+
+    refresh_athlete_summaries()
+    week_start, week_end = get_week_start_end_dates()
+
+    with db.read_engine.connect() as conn:
+        athletes = run_query(conn, "kiosk_athletes", {"week_start": week_start}).fetchall()
+
+    return {
+        "week_start": week_start,
+        "week_end": week_end,
+        "training_plans": [{
+            "id": plan.id,
+            "name": plan.name,
+            "num_of_sessions": plan.num_of_sessions,
+            "can_attend_private_coaching": bool(plan.can_attend_private_coaching),
+            "private_coaching_max_sessions": plan.private_coaching_max_sessions or 0
+        } for plan in TrainingPlan.query.all()],
+        "athletes": [dict(athlete._mapping) for athlete in athletes]
+    }
+
+
+def apply_kiosk_check_ins(kiosk, check_ins):
+    """
+    Applies a batch of check-ins queued by a kiosk.
+
+    Every check-in goes through `check_in_training_session` or `check_in_coaching_session`, so
+    the weekly limits are enforced against all check-ins of the branch, including those made
+    online or at another kiosk while this one was offline. A check-in the limits no longer allow
+    is rejected and reported back to the kiosk. Check-ins already received are answered with
+    their first outcome and not applied again; the primary key of `KioskCheckIn` also rolls back a
+    batch that races with a copy of itself. The caller commits the transaction.
+
+    Parameters:
+        kiosk (str): The name of the kiosk.
+        check_ins (list): The check-ins, as dictionaries with the keys "id", "kind" ("training" or
+                          "coaching"), "athlete_id", "date" and, for coaching, "tuition_fees".
+
+    Returns:
+        list: One dictionary per check-in with its "id", "status" ("accepted" or "rejected")
+              and, when rejected, the "reason", see `KIOSK_ERRORS`.
+    """
+
+    if not isinstance(check_ins, list) or len(check_ins) > KIOSK_MAX_BATCH:
+        raise ApiError("check_ins must be a list of at most %d check-ins" % KIOSK_MAX_BATCH)
+    if any(not isinstance(check_in, dict) or not check_in.get("id") for check_in in check_ins):
+        raise ApiError("every check-in needs an id")
+
+    ensure_tables(KioskCheckIn, conn=db.session.connection())
+    received = {row.id: row for row in KioskCheckIn.query.filter(
+        KioskCheckIn.id.in_([str(check_in["id"]) for check_in in check_ins])).all()}
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    results = []
+    for check_in in check_ins:
+        check_in_id = str(check_in["id"])
+        if check_in_id not in received:
+            status, reason = apply_kiosk_check_in(check_in)
+            received[check_in_id] = KioskCheckIn(
+                id=check_in_id,
+                kiosk=kiosk,
+                kind=check_in.get("kind"),
+                athlete_id=check_in.get("athlete_id") if isinstance(check_in.get("athlete_id"), int) else None,
+                date=check_in.get("date"),
+                status=status,
+                reason=reason,
+                received_at=now
+            )
+            db.session.add(received[check_in_id])
+
+        row = received[check_in_id]
+        results.append({"id": check_in_id, "status": row.status, "reason": row.reason})
+
+    return results
+
+
+def apply_kiosk_check_in(check_in):
+    """
+    Applies one check-in of a kiosk, see `apply_kiosk_check_ins`.
+
+    Parameters:
+        check_in (dict): The check-in.
+
+    Returns:
+        tuple: The status, "accepted" or "rejected", and the reason of a rejection or None.
+    """
+
+    kind, athlete_id, dt = check_in.get("kind"), check_in.get("athlete_id"), check_in.get("date")
+    try:
+        datetime.strptime(dt, "%Y-%m-%d")
+        tuition_fees = float(check_in.get("tuition_fees") or 0)
+    except (TypeError, ValueError):
+        return "rejected", "invalid"
+    if kind not in ("training", "coaching") or not isinstance(athlete_id, int):
+        return "rejected", "invalid"
+    athlete = db.session.get(Athlete, athlete_id)
+    if athlete is None:
+        return "rejected", "unknown-athlete"
+
+    if kind == "training":
+        accepted = check_in_training_session(athlete_id, dt)
+    elif not get_training_plan(athlete.training_plan).can_attend_private_coaching:
+        return "rejected", "no-coaching"
+    else:
+        accepted = check_in_coaching_session(athlete_id, dt, tuition_fees)
+    return ("accepted", None) if accepted else ("rejected", "limit")
+
+
+# Kiosk
+
+def get_kiosk_store_path(app):
+    """
+    Returns the path of the local store of a kiosk.
+
+    Parameters:
+        app (Flask): The application.
+
+    Returns:
+        str: `KIOSK_DATABASE`, by default `kiosk.db` in the instance folder.
+    """
+
+    return app.config.get("KIOSK_DATABASE") or os.path.join(app.instance_path, "kiosk.db")
+
+
+def connect_kiosk_store(path):
+    """
+    Opens the local store of a kiosk, creating it if needed.
+
+    The store is a SQLite database of its own, independent of the application database, holding
+    the copy of the athletes, plans and weekly counts loaded from the central server and the
+    queue of check-ins. It is written with `synchronous = full`, so a queued check-in survives a
+    power cut as soon as it is confirmed.
+
+    Parameters:
+        path (str): The path of the store.
+
+    Returns:
+        sqlite3.Connection: The connection, in autocommit mode; transactions are started explicitly.
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("pragma journal_mode = wal")
+    conn.execute("pragma synchronous = full")
+    conn.executescript("""
+    create table if not exists kiosk_state (key text primary key, value text);
+    create table if not exists training_plans (
+        id integer primary key,
+        name text,
+        num_of_sessions integer,
+        can_attend_private_coaching integer,
+        private_coaching_max_sessions integer
+    );
+    create table if not exists athletes (
+        id integer primary key,
+        fullname text,
+        training_plan integer,
+        training_sessions integer,
+        coaching_sessions integer
+    );
+    create table if not exists check_ins (
+        id text primary key,
+        kind text not null,
+        athlete_id integer not null,
+        date text not null,
+        tuition_fees real not null default 0,
+        created_at real not null,
+        status text not null default 'pending',
+        reason text,
+        synced_at real
+    );
+    create index if not exists ix_check_ins_status on check_ins (status, created_at);
+    create index if not exists ix_check_ins_athlete_date on check_ins (athlete_id, date);
+    """)
+    return conn
+
+
+def get_kiosk_state(conn):
+    """
+    Returns the state of a kiosk: the week of its copy and the times of the last load and sync.
+
+    Parameters:
+        conn (sqlite3.Connection): The connection to the store.
+
+    Returns:
+        dict: The state values by key.
+    """
+
+    return {row["key"]: row["value"] for row in conn.execute("select key, value from kiosk_state")}
+
+
+def set_kiosk_state(conn, **values):
+    """
+    Stores values of the state of a kiosk.
+
+    Parameters:
+        conn (sqlite3.Connection): The connection to the store.
+        **values: The values to store by key; None deletes a value.
+
+    Returns:
+        None
+    """
+
+    for key, value in values.items():
+        if value is None:
+            conn.execute("delete from kiosk_state where key = ?", (key,))
+        else:
+            conn.execute("""
+            insert into kiosk_state (key, value) values (?, ?)
+                on conflict (key) do update set value = excluded.value
+            """, (key, str(value)))
+
+
+def load_kiosk_snapshot(conn, snapshot, pulled_at):
+    """
+    Replaces the copy of the athletes, plans and weekly counts of a kiosk.
+
+    Parameters:
+        conn (sqlite3.Connection): The connection to the store.
+        snapshot (dict): The snapshot returned by the central server, see `get_kiosk_snapshot`.
+        pulled_at (float): When the snapshot was requested, as a Unix timestamp. Check-ins synced
+                           after this time are not included in the snapshot's counts yet.
+
+    Returns:
+        None
+    """
+
+    conn.execute("begin immediate")
+    try:
+        conn.execute("delete from training_plans")
+        conn.executemany("""
+        insert into training_plans (id, name, num_of_sessions, can_attend_private_coaching, private_coaching_max_sessions)
+            values (:id, :name, :num_of_sessions, :can_attend_private_coaching, :private_coaching_max_sessions)
+        """, snapshot["training_plans"])
+        conn.execute("delete from athletes")
+        conn.executemany("""
+        insert into athletes (id, fullname, training_plan, training_sessions, coaching_sessions)
+            values (:id, :fullname, :training_plan, :training_sessions, :coaching_sessions)
+        """, snapshot["athletes"])
+        set_kiosk_state(conn, week_start=snapshot["week_start"], pulled_at=pulled_at)
+        conn.execute("commit")
+    except Exception:
+        conn.execute("rollback")
+        raise
+
+
+def check_in_at_kiosk(path, athlete_id, kind, tuition_fees=0, now=None):
+    """
+    Checks an athlete in at the kiosk and queues the check-in for the central server.
+
+    The weekly rules are those of `can_athlete_register_training_session` and
+    `can_athlete_register_coaching_session`. The sessions of the week are the counts of the
+    last snapshot, if it is for the same week, plus the check-ins queued since, so the kiosk
+    keeps enforcing the limits while it is offline. The check and the insert run under the
+    store's write lock, so two check-ins at the same time cannot both pass the check.
+
+    Parameters:
+        path (str): The path of the kiosk store.
+        athlete_id (int): The ID of the athlete.
+        kind (str): Either "training" or "coaching".
+        tuition_fees (float): The tuition fees of a coaching session.
+        now (datetime, optional): The time of the check-in. Defaults to now.
+
+    Returns:
+        str: "queued" on success, otherwise the reason the check-in was refused, see `KIOSK_ERRORS`.
+    """
+
+    now = now or datetime.now()
+    dt = now.strftime("%Y-%m-%d")
+    week_start, week_end = get_week_start_end_dates(dt)
+
+    conn = connect_kiosk_store(path)
+    try:
+        conn.execute("begin immediate")
+        try:
+            state = get_kiosk_state(conn)
+            if "pulled_at" not in state:
+                return "not-loaded"
+
+            athlete = conn.execute("""
+            select a.training_sessions, a.coaching_sessions, tp.num_of_sessions,
+                tp.can_attend_private_coaching, tp.private_coaching_max_sessions
+                from athletes as a join training_plans as tp on tp.id = a.training_plan
+                where a.id = ?
+            """, (athlete_id,)).fetchone()
+            if athlete is None:
+                return "unknown-athlete"
+            if kind == "coaching" and not athlete["can_attend_private_coaching"]:
+                return "no-coaching"
+
+            sessions = athlete["%s_sessions" % kind] if state.get("week_start") == week_start else 0
+            sessions += conn.execute("""
+            select count(*) from check_ins
+                where athlete_id = ? and kind = ? and date between ? and ?
+                and (status = 'pending' or (status = 'accepted' and synced_at >= ?))
+            """, (athlete_id, kind, week_start, week_end, float(state["pulled_at"]))).fetchone()[0]
+            limit = athlete["num_of_sessions"] if kind == "training" else athlete["private_coaching_max_sessions"]
+            if sessions >= limit:
+                return "limit"
+
+            conn.execute("""
+            insert into check_ins (id, kind, athlete_id, date, tuition_fees, created_at) values (?, ?, ?, ?, ?, ?)
+            """, (str(uuid.uuid4()), kind, athlete_id, dt, float(tuition_fees or 0), now.timestamp()))
+        finally:
+            conn.execute("commit")
+    finally:
+        conn.close()
+
+    return "queued"
+
+
+def get_kiosk_status(path):
+    """
+    Returns what the kiosk page shows: the athletes, the queue and the state of the link.
+
+    Parameters:
+        path (str): The path of the kiosk store.
+
+    Returns:
+        dict: A dictionary with the keys "athletes" (ordered by name), "pending" (the number of
+              check-ins not sent yet), "rejected" (the check-ins the central server refused, for
+              the staff to follow up), "synced_at" and "last_error" (the outcome of the last sync).
+    """
+
+    conn = connect_kiosk_store(path)
+    try:
+        state = get_kiosk_state(conn)
+        return {
+            "athletes": conn.execute("select id, fullname from athletes order by fullname").fetchall(),
+            "pending": conn.execute("select count(*) from check_ins where status = 'pending'").fetchone()[0],
+            "rejected": conn.execute("""
+            select q.id, q.kind, q.date, q.reason, a.fullname from check_ins as q
+                left join athletes as a on a.id = q.athlete_id
+                where q.status = 'rejected'
+                order by q.created_at
+            """).fetchall(),
+            "synced_at": datetime.fromtimestamp(float(state["synced_at"])) if "synced_at" in state else None,
+            "last_error": state.get("last_error")
+        }
+    finally:
+        conn.close()
+
+
+def dismiss_kiosk_check_in(path, check_in_id):
+    """
+    Removes a rejected check-in from the list shown on the kiosk, once the staff dealt with it.
+
+    Parameters:
+        path (str): The path of the kiosk store.
+        check_in_id (str): The ID of the check-in.
+
+    Returns:
+        None
+    """
+
+    conn = connect_kiosk_store(path)
+    try:
+        conn.execute("update check_ins set status = 'dismissed' where id = ? and status = 'rejected'", (check_in_id,))
+    finally:
+        conn.close()
+
+
+def kiosk_request(url, token, payload=None, timeout=5):
+    """
+    Sends a request to the API of the central server.
+
+    Parameters:
+        url (str): The URL of the API endpoint.
+        token (str): The API token of the central server.
+        payload (dict, optional): The JSON body of a POST request. Without it, a GET is sent.
+        timeout (float): The longest time in seconds to wait for the server.
+
+    Returns:
+        dict: The JSON answer.
+
+    Raises:
+        KioskSyncError: If the server cannot be reached or answers with an error.
+    """
+
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    request = urllib.request.Request(url, data=data, method="POST" if data is not None else "GET")
+    request.add_header("Accept", "application/json")
+    if data is not None:
+        request.add_header("Content-Type", "application/json")
+    if token:
+        request.add_header("Authorization", "Bearer %s" % token)
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise KioskSyncError("%s returned %d" % (url, e.code))
+    except (OSError, ValueError) as e:
+        raise KioskSyncError("%s could not be reached: %s" % (url, e))
+
+
+def sync_kiosk(path, url, token, kiosk, batch_size=100, timeout=5):
+    """
+    Sends the queued check-ins of a kiosk to the central server and reloads its copy.
+
+    The check-ins are sent in batches in the order they were made. The outcome of every
+    check-in is stored when its batch is answered; rejected ones stay in the store for the staff
+    to follow up, see `get_kiosk_status`. A batch that got no answer is sent again by the next
+    sync, and the central server answers check-ins it already received without applying them
+    twice. Finally the athletes, plans and weekly counts are reloaded, so the kiosk applies the
+    limits with the check-ins made elsewhere.
+
+    Parameters:
+        path (str): The path of the kiosk store.
+        url (str): The base URL of the central server, for example "https://gym.example.com".
+        token (str): The API token of the central server.
+        kiosk (str): The name of the kiosk, recorded with its check-ins.
+        batch_size (int): The number of check-ins sent per request.
+        timeout (float): The longest time in seconds to wait for each request.
+
+    Returns:
+        dict: The numbers of check-ins "sent", "accepted" and "rejected", and of "athletes" loaded.
+
+    Raises:
+        KioskSyncError: If the central server cannot be reached. Unsent check-ins stay queued.
+    """
+
+    url = url.rstrip("/")
+    result = {"sent": 0, "accepted": 0, "rejected": 0, "athletes": 0}
+
+    conn = connect_kiosk_store(path)
+    try:
+        try:
+            while True:
+                batch = conn.execute("""
+                select id, kind, athlete_id, date, tuition_fees from check_ins
+                    where status = 'pending' order by created_at limit ?
+                """, (batch_size,)).fetchall()
+                if not batch:
+                    break
+
+                answer = kiosk_request(url + "/api/v1/kiosk/check-ins", token, {
+                    "kiosk": kiosk,
+                    "check_ins": [dict(check_in) for check_in in batch]
+                }, timeout)
+
+                synced_at = time.time()
+                conn.execute("begin immediate")
+                for outcome in answer["results"]:
+                    conn.execute("""
+                    update check_ins set status = ?, reason = ?, synced_at = ? where id = ? and status = 'pending'
+                    """, (outcome["status"], outcome.get("reason"), synced_at, outcome["id"]))
+                    result[outcome["status"]] = result.get(outcome["status"], 0) + 1
+                conn.execute("commit")
+                result["sent"] += len(batch)
+
+            pulled_at = time.time()
+            snapshot = kiosk_request(url + "/api/v1/kiosk/snapshot", token, timeout=timeout)
+            load_kiosk_snapshot(conn, snapshot, pulled_at)
+            result["athletes"] = len(snapshot["athletes"])
+        except KioskSyncError as e:
+            set_kiosk_state(conn, last_error=str(e))
+            raise
+
+        set_kiosk_state(conn, synced_at=time.time(), last_error=None)
+    finally:
+        conn.close()
+
+    return result
+
+
+class KioskSync:
+    """
+    Keeps a kiosk in sync with the central server in the background.
+
+    A thread syncs the kiosk every `interval` seconds, and right away after each check-in when
+    `wake` is called. While the central server cannot be reached, the check-ins stay queued in the
+    kiosk store and the thread keeps retrying.
+
+    Attributes:
+        app (Flask): The application of the kiosk.
+        interval (float): The seconds between two syncs.
+    """
+
+    def __init__(self, app, interval=10):
+        self.app = app
+        self.interval = interval
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="kiosk-sync", daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        """
+        Syncs the kiosk as soon as possible.
+        """
+
+        self.event.set()
+
+    def sync(self):
+        """
+        Syncs the kiosk once with the settings of the application.
+
+        Syncs started from the kiosk page wait for the one running in the background, so a batch
+        is never sent twice at the same time.
+
+        Returns:
+            dict: The result of `sync_kiosk`.
+        """
+
+        config = self.app.config
+        with self.lock:
+            return sync_kiosk(get_kiosk_store_path(self.app), config["KIOSK_CENTRAL_URL"], config["KIOSK_TOKEN"],
+                              config["KIOSK_NAME"], config["KIOSK_SYNC_BATCH"], config["KIOSK_TIMEOUT_SECONDS"])
+
+    def run(self):
+        """
+        Syncs the kiosk until the process exits.
+        """
+
+        while True:
+            try:
+                self.sync()
+            except KioskSyncError as e:
+                self.app.logger.warning("Kiosk sync failed: %s", e)
+            except Exception:
+                self.app.logger.exception("Kiosk sync failed")
+            self.event.wait(self.interval)
+            self.event.clear()
+
+
+_kiosk_syncs = {}
+_kiosk_syncs_lock = threading.Lock()
+
+
+def get_kiosk_sync():
+    """
+    Returns the background sync of the current application, starting it if needed.
+
+    Returns:
+        KioskSync: The sync.
+    """
+
+    app = current_app._get_current_object()
+    with _kiosk_syncs_lock:
+        if id(app) not in _kiosk_syncs:
+            _kiosk_syncs[id(app)] = KioskSync(app, app.config["KIOSK_SYNC_SECONDS"])
+        return _kiosk_syncs[id(app)]
@@ -0,0 +1,478 @@
+import calendar
+import http.client
+import json
+import math
+import random
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+from sqlalchemy import inspect, text
+from models import *
+from helpers import *
+
+
+LOAD_TEST_TABS = ["profile", "training-sessions", "private-coaching", "payments", "competitions", "weight"]
+
+
+def seed_load_test_data(athletes=2000, weeks=52, seed=0):
+    """
+    Fills an empty database with production-scale data for load testing.
+
+    Creates the schema if needed, then adds `athletes` athletes spread over the training plans and
+    weight categories, close to the weekly number of sessions of their plan in each of the last
+    `weeks` weeks, private coaching for a third of them, a competition on the second Saturday of
+    every month in every weight category, and registrations of the eligible athletes. All charge
+    weeks are marked dirty, as if the sessions had been logged one by one.
+
+    Parameters:
+        athletes (int): The number of athletes.
+        weeks (int): The number of weeks of sessions, ending this week.
+        seed (int): The seed of the random generator, so the same data can be created again.
+
+    Returns:
+        dict: The number of rows added to each table.
+    """
+
+    if not inspect(db.engine).has_table(Athlete.__tablename__):
+        create_database_schema()
+    if Athlete.query.count():
+        raise ValueError("The database already has athletes. Seed an empty database.")
+
+    rng = random.Random(seed)
+    plans = TrainingPlan.query.all()
+    categories = WeightCategory.query.all()
+    this_monday = date.today() - timedelta(days=date.today().weekday())
+    first_monday = this_monday - timedelta(weeks=weeks - 1)
+
+    athlete_rows, training_rows, coaching_rows = [], [], []
+    for athlete_id in range(1, athletes + 1):
+        plan = rng.choice(plans)
+        athlete_rows.append({
+            "id": athlete_id,
+            "fullname": "Load Test Athlete %d" % athlete_id,
+            "gender": rng.choice(["Male", "Female"]),
+            "age": rng.randint(16, 45),
+            "weight": round(rng.uniform(55, 110), 1),
+            "training_plan": plan.id
+        })
+        coached = plan.can_attend_private_coaching and rng.random() < 1 / 3
+
+        for week in range(weeks):
+            monday = first_monday + timedelta(weeks=week)
+            days = rng.sample(range(7), rng.randint(max(plan.num_of_sessions - 1, 0), plan.num_of_sessions))
+            training_rows.extend({"athlete_id": athlete_id, "date": (monday + timedelta(days=day)).isoformat()}
+                                 for day in sorted(days))
+            if coached and rng.random() < 0.5:
+                coaching_rows.append({
+                    "athlete_id": athlete_id,
+                    "date": (monday + timedelta(days=rng.randrange(7))).isoformat(),
+                    "tuition_fees": rng.choice([100, 150, 200])
+                })
+
+    competition_rows = []
+    month = first_monday.replace(day=1)
+    while month <= this_monday:
+        weeks_of_month = calendar.monthcalendar(month.year, month.month)
+        saturday = weeks_of_month[0 if weeks_of_month[0][calendar.SATURDAY] else 1][calendar.SATURDAY] + 7
+        for category in categories:
+            competition_rows.append({
+                "id": len(competition_rows) + 1,
+                "name": "%s Cup %s" % (category.name.title(), month.strftime("%B %Y")),
+                "date": month.replace(day=saturday).isoformat(),
+                "weight_category": category.id,
+                "entry_fee": rng.choice([50, 100, 150])
+            })
+        month = (month + timedelta(days=32)).replace(day=1)
+
+    competing_plans = {plan.id for plan in plans if plan.can_attend_competitions}
+    category_ranges = {category.id: (category.min_weight, category.max_weight) for category in categories}
+    registration_rows = []
+    for competition in competition_rows:
+        low, high = category_ranges[competition["weight_category"]]
+        eligible = [athlete["id"] for athlete in athlete_rows
+                    if athlete["training_plan"] in competing_plans and low <= athlete["weight"] <= high]
+        for athlete_id in rng.sample(eligible, min(len(eligible), rng.randint(5, 20))):
+            registration_rows.append({"competition_id": competition["id"], "athlete_id": athlete_id})
+
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+        insert into athletes (id, fullname, gender, age, weight, training_plan)
+            values (:id, :fullname, :gender, :age, :weight, :training_plan)
+        """), athlete_rows)
+        conn.execute(text("insert into training_sessions (athlete_id, date) values (:athlete_id, :date)"),
+                     training_rows)
+        if coaching_rows:
+            conn.execute(text("""
+            insert into coaching_sessions (athlete_id, date, tuition_fees) values (:athlete_id, :date, :tuition_fees)
+            """), coaching_rows)
+        conn.execute(text("""
+        insert into competitions (id, name, date, weight_category, entry_fee)
+            values (:id, :name, :date, :weight_category, :entry_fee)
+        """), competition_rows)
+        if registration_rows:
+            conn.execute(text("""
+            insert into competition_registrations (competition_id, athlete_id) values (:competition_id, :athlete_id)
+            """), registration_rows)
+        if conn.dialect.name == "postgresql":
+            # The IDs were given explicitly, so move the sequences past them.
+            for table in ("athletes", "competitions"):
+                conn.execute(text("select setval(pg_get_serial_sequence(:table, 'id'), (select max(id) from %s))"
+                                  % table), {"table": table})
+
+    ensure_charge_snapshots()
+    with db.engine.begin() as conn:
+        run_query(conn, "mark_charge_weeks_dirty",
+                  training_sessions=sessions_table(conn, "training_sessions"),
+                  coaching_sessions=sessions_table(conn, "coaching_sessions"))
+
+    return {
+        "athletes": len(athlete_rows),
+        "training_sessions": len(training_rows),
+        "coaching_sessions": len(coaching_rows),
+        "competitions": len(competition_rows),
+        "competition_registrations": len(registration_rows)
+    }
+
+
+class LoadTestClient:
+    """
+    A minimal HTTP client for one simulated front-desk user.
+
+    Keeps its connection open between requests when the server allows it and sends back the
+    cookies it was given, so the user stays logged in. Redirects are not followed: the time of a
+    form post is the time of the post itself.
+
+    Parameters:
+        url (str): The base URL of the application, for example "http://127.0.0.1:5000".
+        timeout (float): The timeout of a request in seconds.
+    """
+
+    def __init__(self, url, timeout=30):
+        parts = urlsplit(url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.connection = connection_class(parts.hostname, parts.port, timeout=timeout)
+        self.prefix = parts.path.rstrip("/")
+        self.cookies = {}
+
+    def request(self, method, path, data=None):
+        """
+        Sends a request and reads the whole response.
+
+        Parameters:
+            method (str): The HTTP method.
+            path (str): The path of the request, with its query string.
+            data (dict, optional): The form fields of a POST request.
+
+        Returns:
+            tuple: The status code, the body as text, and the time the request took in seconds.
+        """
+
+        headers = {}
+        body = None
+        if self.cookies:
+            headers["Cookie"] = "; ".join("%s=%s" % item for item in self.cookies.items())
+        if data is not None:
+            body = urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        started = time.perf_counter()
+        try:
+            self.connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return 0, "", time.perf_counter() - started
+        seconds = time.perf_counter() - started
+
+        for header in response.headers.get_all("Set-Cookie") or []:
+            name, _, value = header.split(";", 1)[0].partition("=")
+            self.cookies[name.strip()] = value.strip()
+
+        return response.status, content.decode("utf-8", "replace"), seconds
+
+    def close(self):
+        """
+        Closes the connection of the client.
+        """
+
+        self.connection.close()
+
+
+def login_load_test_user(client, branch=None):
+    """
+    Logs a simulated user in as the administrator.
+
+    Parameters:
+        client (LoadTestClient): The client of the user.
+        branch (str, optional): The branch to log in to.
+
+    Returns:
+        tuple: The status code and the time the login took in seconds.
+    """
+
+    status, _, seconds = client.request("POST", "/login", {
+        "username": "admin",
+        "password": "admin",
+        "branch": branch or ""
+    })
+    return status, seconds
+
+
+def discover_load_test_targets(url, branch=None):
+    """
+    Finds the athletes and competitions the load test can use, by reading the list pages once.
+
+    Parameters:
+        url (str): The base URL of the application.
+        branch (str, optional): The branch to log in to.
+
+    Returns:
+        dict: The IDs of the athletes under "athletes" and the (competition ID, weight category ID)
+              pairs of the competitions under "competitions".
+    """
+
+    client = LoadTestClient(url)
+    login_load_test_user(client, branch)
+    _, athletes_page, _ = client.request("GET", "/list-athletes")
+    _, competitions_page, _ = client.request("GET", "/list-competitions")
+
+    competitions = []
+    for competition_id in sorted(set(re.findall(r"/view-competition/(\d+)", competitions_page)), key=int)[-20:]:
+        _, page, _ = client.request("GET", "/view-competition/%s" % competition_id)
+        match = re.search(r"/add-competition-participant/(\d+)/(\d+)", page)
+        if match:
+            competitions.append((int(match.group(1)), int(match.group(2))))
+    client.close()
+
+    targets = {
+        "athletes": sorted({int(athlete_id) for athlete_id in re.findall(r"/view-athlete/(\d+)", athletes_page)}),
+        "competitions": competitions
+    }
+    if not targets["athletes"]:
+        raise ValueError("No athletes found at %s. Seed the database with `flask load-test-seed` first." % url)
+    return targets
+
+
+def get_load_test_mix(targets):
+    """
+    Returns the request mix of the load test, modelled on a busy hour at the front desk.
+
+    Parameters:
+        targets (dict): The athletes and competitions to use, see `discover_load_test_targets`.
+
+    Returns:
+        list: Tuples of the route name, its weight in the mix, and a function that takes a random
+              generator and returns the method, path and form data of a request.
+    """
+
+    def athlete(rng):
+        return rng.choice(targets["athletes"])
+
+    def session_date(rng):
+        return (date.today() - timedelta(days=rng.randrange(7))).isoformat()
+
+    mix = [
+        ("dashboard", 20, lambda rng: ("GET", "/dashboard", None)),
+        ("list_athletes", 8, lambda rng: ("GET", "/list-athletes", None)),
+        ("list_training_sessions", 6, lambda rng: ("GET", "/list-training-sessions", None)),
+        ("list_private_coaching", 4, lambda rng: ("GET", "/list-private-coaching", None)),
+        ("list_competitions", 4, lambda rng: ("GET", "/list-competitions", None)),
+        ("log_training_session", 15, lambda rng: ("POST", "/log-training-session", {
+            "athlete_id": athlete(rng), "session_dt": session_date(rng)}))
+    ]
+    for tab in LOAD_TEST_TABS:
+        mix.append(("view_athlete:%s" % tab, 4,
+                    lambda rng, tab=tab: ("GET", "/view-athlete/%d?tab=%s" % (athlete(rng), tab), None)))
+    if targets["competitions"]:
+        mix.append(("add_competition_participant", 3, lambda rng: ("POST", "/add-competition-participant/%d/%d" % (
+            rng.choice(targets["competitions"])), {"athlete_id": athlete(rng)})))
+
+    return mix
+
+
+def percentile(values, p):
+    """
+    Returns a percentile of a list of values, using the nearest-rank method.
+
+    Parameters:
+        values (list): The values, sorted in ascending order.
+        p (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The value at the percentile, or 0 for an empty list.
+    """
+
+    if not values:
+        return 0
+    return values[min(max(math.ceil(p / 100 * len(values)), 1), len(values)) - 1]
+
+
+def summarize_latencies(samples, seconds):
+    """
+    Summarizes the requests of a route.
+
+    Parameters:
+        samples (list): Tuples of the status code and time in seconds of each request.
+        seconds (float): The length of the test in seconds.
+
+    Returns:
+        dict: The number of requests and errors, the requests per second, and the p50, p95 and p99
+              latencies in milliseconds.
+    """
+
+    latencies = sorted(latency * 1000 for _, latency in samples)
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for status, _ in samples if not status or status >= 400),
+        "throughput": len(samples) / seconds if seconds else 0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99)
+    }
+
+
+def run_load_test(url, concurrency=16, duration=60, branch=None, seed=0):
+    """
+    Replays a realistic mix of front-desk traffic against a running instance.
+
+    Each of the `concurrency` simulated users logs in, then sends requests back to back, picking
+    each one at random from the mix of `get_load_test_mix`, until `duration` seconds have passed.
+    Logins are measured as a route of their own.
+
+    Parameters:
+        url (str): The base URL of the application, for example "http://127.0.0.1:5000".
+        concurrency (int): The number of simultaneous users.
+        duration (float): The length of the test in seconds.
+        branch (str, optional): The branch to log in to.
+        seed (int): The seed of the random generators, so the same sequence of requests can be replayed.
+
+    Returns:
+        dict: The results of the test, with the settings, the totals, and the summary of every
+              route under "routes", see `summarize_latencies`.
+    """
+
+    targets = discover_load_test_targets(url, branch)
+    mix = get_load_test_mix(targets)
+    names = [name for name, _, _ in mix]
+    weights = [weight for _, weight, _ in mix]
+    builders = {name: build for name, _, build in mix}
+
+    samples = {name: [] for name in ["login"] + names}
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency)
+
+    def user(n):
+        rng = random.Random(seed * 10000 + n)
+        client = LoadTestClient(url)
+        barrier.wait()
+        deadline = time.perf_counter() + duration
+
+        recorded = {name: [] for name in samples}
+        recorded["login"].append(login_load_test_user(client, branch))
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            method, path, data = builders[name](rng)
+            status, _, seconds = client.request(method, path, data)
+            recorded[name].append((status, seconds))
+        client.close()
+
+        with lock:
+            for name, values in recorded.items():
+                samples[name].extend(values)
+
+    started_at = datetime.now()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    all_samples = [sample for values in samples.values() for sample in values]
+    return {
+        "url": url,
+        "started_at": started_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "concurrency": concurrency,
+        "duration": duration,
+        "seed": seed,
+        "athletes": len(targets["athletes"]),
+        "total": summarize_latencies(all_samples, seconds),
+        "routes": {name: summarize_latencies(values, seconds) for name, values in samples.items() if values}
+    }
+
+
+def compare_with_baseline(result, baseline, tolerance=0.2, min_requests=20):
+    """
+    Compares the results of a load test with a saved baseline.
+
+    A route regressed when its p50, p95 or p99 latency grew, or its throughput fell, by more than
+    `tolerance`, or when it had errors the baseline did not have. Routes with fewer than
+    `min_requests` requests in either run are skipped, as their percentiles are not reliable.
+
+    Parameters:
+        result (dict): The results of the new run, see `run_load_test`.
+        baseline (dict): The results of the baseline run.
+        tolerance (float): The allowed relative change, for example 0.2 for 20%.
+        min_requests (int): The smallest number of requests of a route to compare it.
+
+    Returns:
+        list: One dictionary per regression with the "route", "metric", "baseline" and "current"
+              values and the relative "change".
+    """
+
+    regressions = []
+    for name, current in dict(result["routes"], total=result["total"]).items():
+        previous = baseline["total"] if name == "total" else baseline["routes"].get(name)
+        if not previous or min(current["requests"], previous["requests"]) < min_requests:
+            continue
+
+        checks = [(metric, current[metric] > previous[metric] * (1 + tolerance)) for metric in ("p50", "p95", "p99")]
+        checks.append(("throughput", current["throughput"] < previous["throughput"] * (1 - tolerance)))
+        checks.append(("errors", current["errors"] > 0 and previous["errors"] == 0))
+
+        for metric, regressed in checks:
+            if regressed:
+                regressions.append({
+                    "route": name,
+                    "metric": metric,
+                    "baseline": previous[metric],
+                    "current": current[metric],
+                    "change": (current[metric] - previous[metric]) / previous[metric] if previous[metric] else None
+                })
+
+    return regressions
+
+
+def save_load_test_result(result, path):
+    """
+    Saves the results of a load test as a JSON baseline.
+
+    Parameters:
+        result (dict): The results, see `run_load_test`.
+        path (str): The path of the JSON file.
+
+    Returns:
+        None
+    """
+
+    with open(path, "w") as fp:
+        json.dump(result, fp, indent=2)
+
+
+def load_load_test_result(path):
+    """
+    Reads a JSON baseline saved by `save_load_test_result`.
+
+    Parameters:
+        path (str): The path of the JSON file.
+
+    Returns:
+        dict: The results of the baseline run.
+    """
+
+    with open(path) as fp:
+        return json.load(fp)
@@ -0,0 +1,108 @@
+import time
+from sqlalchemy import inspect, text
+from models import *
+
+
+def ensure_indexes(conn):
+    """
+    Creates the indexes declared on the models that are missing from the current database.
+
+    Databases created by an older version of the application lack the indexes added since, as
+    tables are only created once. Tables that do not exist yet are skipped; they get their
+    indexes when they are created.
+
+    Parameters:
+        conn (Connection): The connection of an open transaction on the database.
+
+    Returns:
+        list: The names of the indexes created.
+    """
+
+    inspector = inspect(conn)
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(conn)
+                created.append(index.name)
+    return created
+
+
+def maintain_database(vacuum_pages=1000, analysis_limit=1000):
+    """
+    Runs the routine maintenance of the current database.
+
+    The steps are:
+        1. Create missing indexes, see `ensure_indexes`.
+        2. `ANALYZE` every table, sampling at most `analysis_limit` rows per index, so the
+           planner's statistics follow the growth of the tables without reading them in full.
+        3. `PRAGMA incremental_vacuum`, returning up to `vacuum_pages` free pages to the file
+           system, when the database uses incremental auto-vacuum.
+        4. `PRAGMA optimize`, which re-analyzes any table whose statistics went stale.
+
+    Only SQLite databases are maintained; on other databases the steps are skipped.
+
+    Parameters:
+        vacuum_pages (int): The largest number of free pages to release.
+        analysis_limit (int): The number of rows sampled per index by ANALYZE, 0 for all rows.
+
+    Returns:
+        dict: A dictionary with the following keys:
+            - indexes (list): The names of the indexes created.
+            - freed_pages (int): The number of free pages released by the incremental vacuum.
+            - free_pages (int): The number of free pages left in the file.
+            - incremental_vacuum (bool): Whether the database uses incremental auto-vacuum.
+            - seconds (float): How long the maintenance took.
+    """
+
+    started = time.perf_counter()
+    engine = db.engine
+
+    with engine.begin() as conn:
+        indexes = ensure_indexes(conn)
+
+    result = {"indexes": indexes, "freed_pages": 0, "free_pages": 0, "incremental_vacuum": False}
+    if engine.dialect.name != "sqlite":
+        result["seconds"] = time.perf_counter() - started
+        return result
+
+    with engine.connect() as conn:
+        conn.execute(text("pragma analysis_limit = %d" % analysis_limit))
+        conn.execute(text("analyze"))
+        conn.commit()
+
+        result["incremental_vacuum"] = conn.execute(text("pragma auto_vacuum")).scalar() == 2
+        if result["incremental_vacuum"]:
+            before = conn.execute(text("pragma freelist_count")).scalar()
+            # Every step of the pragma releases one page, and only a script runs it to the end.
+            conn.connection.driver_connection.executescript("pragma incremental_vacuum(%d);" % vacuum_pages)
+            result["free_pages"] = conn.execute(text("pragma freelist_count")).scalar()
+            result["freed_pages"] = before - result["free_pages"]
+        else:
+            result["free_pages"] = conn.execute(text("pragma freelist_count")).scalar()
+
+        conn.execute(text("pragma optimize"))
+        conn.commit()
+
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def enable_incremental_vacuum():
+    """
+    Switches the current database to incremental auto-vacuum.
+
+    The setting only takes effect after a full `VACUUM`, which rewrites the whole file and
+    blocks writers while it runs, so do this once in a quiet hour. From then on
+    `maintain_database` releases free pages a few at a time.
+
+    Returns:
+        None
+    """
+
+    with db.engine.connect() as conn:
+        conn.execute(text("pragma auto_vacuum = incremental"))
+        conn.execute(text("vacuum"))
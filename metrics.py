@@ -0,0 +1,480 @@
+import os
+import time
+import atexit
+import sqlite3
+import threading
+from flask import request, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+
+
+REQUEST_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+QUERY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+HISTOGRAM_BUCKETS = {
+    "trainingtally_http_request_duration_seconds": REQUEST_BUCKETS,
+    "trainingtally_db_query_duration_seconds": QUERY_BUCKETS,
+}
+
+METRICS = {
+    "trainingtally_http_requests_total": (
+        "counter", "Number of HTTP requests by route, method and status."),
+    "trainingtally_http_request_duration_seconds": (
+        "histogram", "Time spent handling HTTP requests by route and method."),
+    "trainingtally_db_queries_total": (
+        "counter", "Number of SQL statements executed by database and query."),
+    "trainingtally_db_query_duration_seconds": (
+        "histogram", "Time spent executing SQL statements by database and query."),
+    "trainingtally_db_pool_size": (
+        "gauge", "Configured size of the connection pools of the live processes."),
+    "trainingtally_db_pool_checked_out": (
+        "gauge", "Connections currently checked out of the pools of the live processes."),
+    "trainingtally_db_pool_overflow": (
+        "gauge", "Overflow connections currently open in the pools of the live processes."),
+    "trainingtally_cache_requests_total": (
+        "counter", "Cache lookups by cache and result (hit or miss)."),
+}
+
+RETIRED_PROCESS = "retired"
+
+_lock = threading.Lock()
+_samples = {}
+_gauge_collectors = []
+_store = {"path": None, "flushed_at": 0.0, "interval": 5.0}
+_process = {"key": "%d-%d" % (os.getpid(), time.time() * 1000)}
+
+
+def reset_process_metrics():
+    """
+    Forgets the metrics of the current process.
+
+    Called in forked children, which would otherwise report the counters of their parent a second time.
+
+    Returns:
+        None
+    """
+
+    with _lock:
+        _samples.clear()
+    _process["key"] = "%d-%d" % (os.getpid(), time.time() * 1000)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_process_metrics)
+
+
+def label_key(labels):
+    """
+    Turns a dictionary of labels into the text used in the Prometheus format.
+
+    Parameters:
+        labels (dict): The label names and values.
+
+    Returns:
+        str: The labels as `name="value"` pairs separated by commas, sorted by name.
+    """
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    return ",".join('%s="%s"' % (name, escape(value)) for name, value in sorted(labels.items()))
+
+
+def inc_counter(name, labels, amount=1):
+    """
+    Increments a counter of the current process.
+
+    Parameters:
+        name (str): The name of the metric.
+        labels (dict): The labels of the sample.
+        amount (float): The amount to add.
+
+    Returns:
+        None
+    """
+
+    key = (name, label_key(labels), "")
+    with _lock:
+        _samples[key] = _samples.get(key, 0) + amount
+
+
+def observe_histogram(name, labels, value):
+    """
+    Records an observation in a histogram of the current process.
+
+    The buckets are stored cumulatively, as in the Prometheus format, together with the sum and
+    count of the observations. Only the buckets the value falls into are stored; the others are
+    rendered as 0, see `render_metrics`.
+
+    Parameters:
+        name (str): The name of the metric, with its buckets in `HISTOGRAM_BUCKETS`.
+        labels (dict): The labels of the sample.
+        value (float): The observed value.
+
+    Returns:
+        None
+    """
+
+    labels = label_key(labels)
+    with _lock:
+        for bound in HISTOGRAM_BUCKETS[name]:
+            if value <= bound:
+                key = (name, labels, repr(bound))
+                _samples[key] = _samples.get(key, 0) + 1
+        for bucket, amount in (("+Inf", 1), ("sum", value), ("count", 1)):
+            key = (name, labels, bucket)
+            _samples[key] = _samples.get(key, 0) + amount
+
+
+def record_cache_lookup(cache, hit):
+    """
+    Counts a lookup of one of the application caches.
+
+    Parameters:
+        cache (str): The name of the cache.
+        hit (bool): Whether the lookup was answered from the cache.
+
+    Returns:
+        None
+    """
+
+    inc_counter("trainingtally_cache_requests_total", {"cache": cache, "result": "hit" if hit else "miss"})
+
+
+def gauge_collector(f):
+    """
+    A decorator that registers a function returning gauge samples to be read at every flush.
+
+    The function takes no arguments and returns a list of (name, labels, value) tuples. It runs
+    in the application context of the request that triggers the flush.
+
+    Parameters:
+        f (callable): The collector.
+
+    Returns:
+        callable: The collector, unchanged.
+    """
+
+    _gauge_collectors.append(f)
+    return f
+
+
+def connect_store():
+    """
+    Opens the metrics store shared by the processes of the application, creating it if needed.
+
+    The store is a small SQLite database of its own, accessed without SQLAlchemy so that writing
+    the metrics does not show up in the query metrics.
+
+    Returns:
+        sqlite3.Connection: The connection to the store.
+    """
+
+    conn = sqlite3.connect(_store["path"], timeout=5)
+    conn.execute("""
+    create table if not exists samples (
+        process text not null,
+        kind text not null,
+        name text not null,
+        labels text not null,
+        bucket text not null,
+        value real not null,
+        updated_at real not null,
+        primary key (process, name, labels, bucket)
+    )
+    """)
+    return conn
+
+
+def flush_metrics(force=False):
+    """
+    Writes the metrics of the current process to the shared store.
+
+    Counters and histograms are written as the running totals of the process, so rewriting them is
+    idempotent. Gauges are collected at this point. The samples of processes that have exited are
+    then folded away, see `retire_dead_processes`. To keep requests fast, the metrics are only
+    written when the flush interval has passed, unless `force` is set.
+
+    Parameters:
+        force (bool): Write the metrics even if the flush interval has not passed.
+
+    Returns:
+        None
+    """
+
+    now = time.time()
+    if _store["path"] is None or (not force and now - _store["flushed_at"] < _store["interval"]):
+        return
+    _store["flushed_at"] = now
+
+    rows = []
+    for collector in _gauge_collectors:
+        for name, labels, value in collector():
+            rows.append((_process["key"], "gauge", name, label_key(labels), "", value, now))
+
+    with _lock:
+        for (name, labels, bucket), value in _samples.items():
+            rows.append((_process["key"], METRICS[name][0], name, labels, bucket, value, now))
+
+    conn = connect_store()
+    try:
+        with conn:
+            conn.executemany("""
+            insert into samples (process, kind, name, labels, bucket, value, updated_at)
+                values (?, ?, ?, ?, ?, ?, ?)
+                on conflict (process, name, labels, bucket) do update set
+                    value = excluded.value, updated_at = excluded.updated_at
+            """, rows)
+            retire_dead_processes(conn)
+    finally:
+        conn.close()
+
+
+def retire_dead_processes(conn):
+    """
+    Folds the samples of the processes that have exited into a single aggregate process.
+
+    The counters and histograms of a dead process are added to those of `RETIRED_PROCESS`, so the
+    totals keep growing across worker restarts, and its gauges are deleted, as they no longer
+    describe anything. The store then holds one set of rows per live process plus the aggregate,
+    however often the workers are restarted.
+
+    Parameters:
+        conn (sqlite3.Connection): The connection to the store, in the transaction of the flush.
+
+    Returns:
+        list: The keys of the retired processes.
+    """
+
+    processes = conn.execute("""
+    select process, max(updated_at) from samples where process not in (?, ?) group by process
+    """, (_process["key"], RETIRED_PROCESS)).fetchall()
+
+    dead = [process for process, updated_at in processes if not is_process_alive(process, updated_at)]
+    for process in dead:
+        conn.execute("""
+        insert into samples (process, kind, name, labels, bucket, value, updated_at)
+            select ?, kind, name, labels, bucket, value, updated_at from samples
+                where process = ? and kind != 'gauge'
+            on conflict (process, name, labels, bucket) do update set
+                value = samples.value + excluded.value, updated_at = max(samples.updated_at, excluded.updated_at)
+        """, (RETIRED_PROCESS, process))
+        conn.execute("delete from samples where process = ?", (process,))
+    return dead
+
+
+def is_process_alive(process, updated_at):
+    """
+    Checks whether the process that wrote metrics to the store is still running.
+
+    On Windows, where a process cannot be probed without a handle, a process counts as running
+    if it wrote metrics during the last minute.
+
+    Parameters:
+        process (str): The process key of the samples, starting with the process ID.
+        updated_at (float): When the process last wrote its metrics, as a Unix timestamp.
+
+    Returns:
+        bool: True if the process is running.
+    """
+
+    if os.name == "nt":
+        return time.time() - updated_at < max(60, _store["interval"] * 3)
+
+    try:
+        os.kill(int(process.split("-")[0]), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def render_metrics():
+    """
+    Renders the metrics of all processes in the Prometheus text format.
+
+    Counters and histograms are summed over every process that ever wrote to the store, so they
+    keep growing when workers are restarted. Gauges are summed over the live processes only, as
+    the flush that starts the rendering removes those of the processes that have exited.
+
+    Returns:
+        str: The metrics in the Prometheus text exposition format.
+    """
+
+    flush_metrics(force=True)
+
+    conn = connect_store()
+    try:
+        rows = conn.execute("""
+        select name, labels, bucket, sum(value) from samples group by name, labels, bucket
+        """).fetchall()
+    finally:
+        conn.close()
+
+    totals = {(name, labels, bucket): value for name, labels, bucket, value in rows}
+
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        samples = sorted((labels, bucket, value) for (n, labels, bucket), value in totals.items() if n == name)
+
+        for labels, bucket, value in samples:
+            if kind != "histogram":
+                lines.append("%s{%s} %s" % (name, labels, repr(float(value))) if labels else "%s %s" % (name, repr(float(value))))
+            elif bucket in ("sum", "count"):
+                lines.append("%s_%s{%s} %s" % (name, bucket, labels, repr(float(value))))
+
+        if kind == "histogram":
+            for labels in sorted({labels for labels, _, _ in samples}):
+                for le in [repr(bound) for bound in HISTOGRAM_BUCKETS[name]] + ["+Inf"]:
+                    value = totals.get((name, labels, le), 0)
+                    lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, le, repr(float(value))))
+
+    return "\n".join(lines) + "\n"
+
+
+def get_route_label():
+    """
+    Returns the route of the current request as used in the metric labels.
+
+    Returns:
+        str: The URL rule of the request, or "unmatched" for requests that did not match a route.
+    """
+
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def start_request_timer():
+    """
+    A before_request hook that records when the request started.
+
+    Returns:
+        None
+    """
+
+    g.metrics_started = time.perf_counter()
+
+
+def record_request(response):
+    """
+    An after_request hook that counts the request and records how long it took.
+
+    Parameters:
+        response (Response): The response of the request.
+
+    Returns:
+        Response: The response, unchanged.
+    """
+
+    started = g.pop("metrics_started", None)
+    if started is not None:
+        labels = {"route": get_route_label(), "method": request.method}
+        observe_histogram("trainingtally_http_request_duration_seconds", labels, time.perf_counter() - started)
+        inc_counter("trainingtally_http_requests_total", dict(labels, status=response.status_code))
+        flush_metrics()
+    return response
+
+
+def get_database_label(engine):
+    """
+    Returns the name of the database of an engine as used in the metric labels.
+
+    Parameters:
+        engine (Engine): The engine.
+
+    Returns:
+        str: The file name of the database, or the database name for server databases.
+    """
+
+    return os.path.basename(engine.url.database or "") or engine.url.get_backend_name()
+
+
+def get_query_label(context):
+    """
+    Returns the name of a statement as used in the metric labels.
+
+    Statements run with `run_query` carry the name of their query in the "query" execution
+    option. Other statements, such as the ORM's, are labelled "other".
+
+    Parameters:
+        context (ExecutionContext): The execution context of the statement, or None.
+
+    Returns:
+        str: The name of the query.
+    """
+
+    if context is None:
+        return "other"
+    return context.execution_options.get("query", "other")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("metrics_started")
+    if not started:
+        return
+
+    labels = {"database": get_database_label(conn.engine), "query": get_query_label(context)}
+    observe_histogram("trainingtally_db_query_duration_seconds", labels, time.perf_counter() - started.pop())
+    inc_counter("trainingtally_db_queries_total", labels)
+
+    cache_hit = getattr(context, "cache_hit", None)
+    if cache_hit in (CACHE_HIT, CACHE_MISS):
+        record_cache_lookup("sql_compiled", cache_hit == CACHE_HIT)
+
+
+@event.listens_for(Engine, "handle_error")
+def discard_query_timer(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("metrics_started"):
+        conn.info["metrics_started"].pop()
+
+
+def init_metrics(app, db):
+    """
+    Starts collecting the request, database and cache metrics of an application.
+
+    The metrics of each process are kept in memory and written every `METRICS_FLUSH_SECONDS`
+    to the shared store given by `METRICS_DATABASE`, by default `metrics.db` in the instance folder.
+
+    Parameters:
+        app (Flask): The application.
+        db (SQLAlchemy): The database extension, whose connection pools are reported.
+
+    Returns:
+        None
+    """
+
+    os.makedirs(app.instance_path, exist_ok=True)
+    _store["path"] = app.config.get("METRICS_DATABASE") or os.path.join(app.instance_path, "metrics.db")
+    _store["interval"] = app.config.get("METRICS_FLUSH_SECONDS", 5.0)
+
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+
+    @gauge_collector
+    def collect_pool_stats():
+        samples = []
+        for bind_key, engine in db.engines.items():
+            pool = engine.pool
+            labels = {"bind": bind_key or "default"}
+            for name, stat in (("trainingtally_db_pool_size", "size"),
+                               ("trainingtally_db_pool_checked_out", "checkedout"),
+                               ("trainingtally_db_pool_overflow", "overflow")):
+                if hasattr(pool, stat):
+                    samples.append((name, labels, max(getattr(pool, stat)(), 0)))
+        return samples
+
+    def flush_at_exit():
+        _gauge_collectors.remove(collect_pool_stats)
+        flush_metrics(force=True)
+
+    atexit.register(flush_at_exit)
@@ -1,6 +1,156 @@
+from contextlib import nullcontext
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from flask_sqlalchemy.session import Session
 
-db = SQLAlchemy()
+
+BRANCH_BIND_PREFIX = "branch:"
+READ_BIND_SUFFIX = ":read"
+
+
+def current_branch_bind():
+    """
+    Returns the bind key of the branch selected for the current request, if any.
+
+    The branch name is stored on `flask.g` by the branch selection hook. Outside an
+    application context, or when no branch is selected, the default database is used.
+
+    Returns:
+        str or None: The SQLALCHEMY_BINDS key of the selected branch, or None for the default database.
+    """
+
+    if has_app_context() and g.get("branch"):
+        return BRANCH_BIND_PREFIX + g.branch
+    return None
+
+
+def read_bind_key(bind_key):
+    """
+    Returns the bind key of the read-only pool of a database.
+
+    Parameters:
+        bind_key (str or None): The bind key of the database, or None for the default database.
+
+    Returns:
+        str: The SQLALCHEMY_BINDS key of the read-only pool of the database.
+    """
+
+    return (bind_key or "main") + READ_BIND_SUFFIX
+
+
+def is_read_only_request():
+    """
+    Checks whether the current request reads from the read-only connection pools.
+
+    The role of the request is stored on `flask.g` by the database role hook. Outside a
+    request, for example in CLI commands and workers, everything uses the writer pools.
+
+    Returns:
+        bool: True if reads of the current request go to the read-only pools.
+    """
+
+    return has_app_context() and g.get("db_role") == "read"
+
+
+class BranchRoutingSession(Session):
+    """
+    A session that sends queries for the default models to the database of the selected branch.
+
+    Models declared with their own bind key keep their bind. Only queries that would go to the
+    default database are rerouted to the engine of the branch selected for the request. In
+    read-only requests, SELECT statements on that database go to its read-only pool; flushes
+    and other statements always use the writer.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        engines = self._db.engines
+
+        if bind is not None or engine is not engines.get(None):
+            return engine
+
+        branch_bind = current_branch_bind()
+        if branch_bind in engines:
+            engine = engines[branch_bind]
+
+        if is_read_only_request() and getattr(clause, "is_select", False):
+            return engines.get(read_bind_key(branch_bind), engine)
+        return engine
+
+
+class BranchRoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy extension whose `engine` follows the branch selected for the request.
+
+    Raw SQL in the routes and helpers uses `db.engine.connect()`, so routing the engine
+    property is enough to point those queries at the branch database.
+    """
+
+    @property
+    def engine(self):
+        branch_bind = current_branch_bind()
+        engines = self.engines
+
+        if branch_bind in engines:
+            return engines[branch_bind]
+        return engines[None]
+
+    @property
+    def read_engine(self):
+        """
+        The engine to use for raw SQL that only reads.
+
+        In read-only requests this is the read-only pool of the selected database, when one is
+        configured. Otherwise it is the same engine as `engine`.
+        """
+
+        if is_read_only_request():
+            return self.engines.get(read_bind_key(current_branch_bind()), self.engine)
+        return self.engine
+
+
+db = BranchRoutingSQLAlchemy(session_options={"class_": BranchRoutingSession})
+
+_ensured_tables = set()
+
+
+def ensure_tables(*models, conn=None, populate=None):
+    """
+    Creates the tables of models in the current database if they do not exist yet.
+
+    `create_database_schema` creates every table of a new database. A database created before
+    a table was added gets it the first time the table is used; each table is only looked up
+    once per engine, so later calls return right away. Models declared with their own bind key,
+    such as `Job`, are created in the database of that bind.
+
+    Parameters:
+        *models: The model classes whose tables are needed. They must share the same bind key.
+        conn (Connection, optional): The connection of an open transaction to create the tables in.
+                                     Defaults to a new transaction.
+        populate (callable, optional): Called with the connection after the tables were created,
+                                       to fill them from the existing data.
+
+    Returns:
+        None
+    """
+
+    bind_key = models[0].__table__.metadata.info.get("bind_key")
+    engine = db.engines[bind_key] if bind_key is not None else db.engine
+    tables = [model.__table__ for model in models if (engine.url, model.__tablename__) not in _ensured_tables]
+    if not tables:
+        return
+
+    inspector = inspect(conn if conn is not None else engine)
+    missing = [table for table in tables if not inspector.has_table(table.name)]
+    if missing:
+        with (nullcontext(conn) if conn is not None else engine.begin()) as conn:
+            for table in missing:
+                table.create(conn, checkfirst=True)
+            if populate is not None:
+                populate(conn)
+
+    _ensured_tables.update((engine.url, table.name) for table in tables)
 
 
 class TrainingPlan(db.Model):
@@ -64,6 +214,9 @@ class Athlete(db.Model):
     """
 
     __tablename__ = "athletes"
+    __table_args__ = (
+        db.Index("ix_athletes_training_plan_weight", "training_plan", "weight"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     fullname = db.Column(db.String)
@@ -105,6 +258,10 @@ class CompetitionRegistration(db.Model):
     """
 
     __tablename__ = "competition_registrations"
+    __table_args__ = (
+        db.Index("ix_competition_registrations_competition_id", "competition_id"),
+        db.Index("ix_competition_registrations_athlete_id", "athlete_id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     competition_id = db.Column(db.Integer)
@@ -115,6 +272,9 @@ class TrainingSession(db.Model):
     """
     Represents a training session.
 
+    The IDs are never reused, even after the latest sessions were moved to the archive, so an
+    archived session and a current one never share an ID.
+
     Attributes:
         id (int): The unique identifier of the training session.
         date (datetime.date): The date of the training session.
@@ -122,6 +282,10 @@ class TrainingSession(db.Model):
     """
 
     __tablename__ = "training_sessions"
+    __table_args__ = (
+        db.Index("ix_training_sessions_athlete_date", "athlete_id", "date"),
+        {"sqlite_autoincrement": True}
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.Date)
@@ -132,6 +296,8 @@ class CoachingSession(db.Model):
     """
     Represents a private coaching session.
 
+    The IDs are never reused, see `TrainingSession`.
+
     Attributes:
         id (int): The unique identifier for the coaching session.
         date (date): The date of the coaching session.
@@ -140,8 +306,369 @@ class CoachingSession(db.Model):
     """
 
     __tablename__ = "coaching_sessions"
+    __table_args__ = (
+        db.Index("ix_coaching_sessions_athlete_date", "athlete_id", "date"),
+        {"sqlite_autoincrement": True}
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.Date)
     athlete_id = db.Column(db.Integer)
     tuition_fees = db.Column(db.Float)
+
+
+class Job(db.Model):
+    """
+    Represents a background job, such as a report, queued for the job workers.
+
+    Jobs are stored in their own "jobs" database bind so the queue is shared by all
+    branches and polling it never competes with writes to the gym data.
+
+    Attributes:
+        id (int): The unique identifier of the job.
+        kind (str): The type of job, one of the names registered in `jobs.JOB_HANDLERS`.
+        params (str): The JSON encoded parameters of the job.
+        branch (str): The branch the job runs against, or None for the main database.
+        status (str): One of "queued", "running", "done" or "failed".
+        progress (int): The progress of the job in percent.
+        result_path (str): The path of the file produced by the job.
+        error (str): The error message if the job failed.
+        created_at (datetime): When the job was queued.
+        started_at (datetime): When a worker picked up the job.
+        finished_at (datetime): When the job finished or failed.
+    """
+
+    __bind_key__ = "jobs"
+    __tablename__ = "jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String)
+    params = db.Column(db.String)
+    branch = db.Column(db.String)
+    status = db.Column(db.String, default="queued", index=True)
+    progress = db.Column(db.Integer, default=0)
+    result_path = db.Column(db.String)
+    error = db.Column(db.String)
+    created_at = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+
+class Invoice(db.Model):
+    """
+    Represents the invoice of an athlete for one month, written by the month-end invoice run.
+
+    Attributes:
+        id (int): The unique identifier of the invoice.
+        athlete_id (int): The ID of the invoiced athlete.
+        period (str): The invoiced month in the format "YYYY-MM".
+        training_weeks (int): The number of weeks starting in the month in which the athlete trained.
+        training_fees (float): The training plan fees for those weeks.
+        coaching_fees (float): The tuition fees of the private coaching sessions in the month.
+        competition_fees (float): The entry fees of the competitions held in the month.
+        total (float): The total amount of the invoice.
+        created_at (datetime): When the invoice was written.
+    """
+
+    __tablename__ = "invoices"
+    __table_args__ = (db.UniqueConstraint("period", "athlete_id"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    athlete_id = db.Column(db.Integer)
+    period = db.Column(db.String)
+    training_weeks = db.Column(db.Integer)
+    training_fees = db.Column(db.Float)
+    coaching_fees = db.Column(db.Float)
+    competition_fees = db.Column(db.Float)
+    total = db.Column(db.Float)
+    created_at = db.Column(db.DateTime)
+
+
+class InvoiceRunPartition(db.Model):
+    """
+    Represents a range of athlete IDs processed by one worker of a month-end invoice run.
+
+    The partition is the checkpoint of the run: `last_athlete_id` is advanced in the same
+    transaction that writes each batch of invoices, so an interrupted run resumes after the
+    last committed batch.
+
+    Attributes:
+        id (int): The unique identifier of the partition.
+        period (str): The invoiced month in the format "YYYY-MM".
+        first_id (int): The first athlete ID of the range.
+        last_id (int): The last athlete ID of the range.
+        last_athlete_id (int): The last athlete ID already invoiced, or first_id - 1.
+        athletes (int): The number of athletes invoiced so far.
+        finished (bool): Whether the whole range has been invoiced.
+    """
+
+    __tablename__ = "invoice_run_partitions"
+    __table_args__ = (db.UniqueConstraint("period", "first_id"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String)
+    first_id = db.Column(db.Integer)
+    last_id = db.Column(db.Integer)
+    last_athlete_id = db.Column(db.Integer)
+    athletes = db.Column(db.Integer, default=0)
+    finished = db.Column(db.Boolean, default=False)
+
+
+class ChargeSnapshot(db.Model):
+    """
+    Represents the charges of an athlete for one week (Monday to Sunday).
+
+    Snapshots are written lazily: logging a session or registering for a competition only
+    marks the affected week as dirty, and the charges of dirty weeks are recomputed from the
+    raw sessions the next time the athlete's payments are read.
+
+    Attributes:
+        id (int): The unique identifier of the snapshot.
+        athlete_id (int): The ID of the athlete.
+        week_start (str): The Monday of the week in the format "YYYY-MM-DD".
+        week_end (str): The Sunday of the week in the format "YYYY-MM-DD".
+        training_sessions (int): The number of training sessions in the week.
+        plan_fee (float): The training plan fee charged for the week.
+        coaching_sessions (int): The number of private coaching sessions in the week.
+        coaching_fees (float): The tuition fees of the private coaching sessions in the week.
+        competitions (int): The number of competitions in the week the athlete registered for.
+        competition_fees (float): The entry fees of those competitions.
+        dirty (bool): Whether the charges must be recomputed before they are read.
+    """
+
+    __tablename__ = "charge_snapshots"
+    __table_args__ = (db.UniqueConstraint("athlete_id", "week_start"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    athlete_id = db.Column(db.Integer)
+    week_start = db.Column(db.String)
+    week_end = db.Column(db.String)
+    training_sessions = db.Column(db.Integer, default=0)
+    plan_fee = db.Column(db.Float, default=0)
+    coaching_sessions = db.Column(db.Integer, default=0)
+    coaching_fees = db.Column(db.Float, default=0)
+    competitions = db.Column(db.Integer, default=0)
+    competition_fees = db.Column(db.Float, default=0)
+    dirty = db.Column(db.Boolean, default=True, index=True)
+
+
+class AthleteSummary(db.Model):
+    """
+    Represents the figures of an athlete shown on the athlete roster.
+
+    The summary is updated in the same transaction as every session, competition registration
+    and plan change of the athlete. The weekly counts belong to the week starting on
+    `week_start`; summaries of a past week are rebuilt the first time the roster is read in a
+    new week.
+
+    Attributes:
+        athlete_id (int): The ID of the athlete.
+        week_start (str): The Monday of the week of the counts in the format "YYYY-MM-DD".
+        training_sessions (int): The number of training sessions in the week.
+        coaching_sessions (int): The number of private coaching sessions in the week.
+        balance (float): The training, coaching and competition fees due from the athlete.
+    """
+
+    __tablename__ = "athlete_summaries"
+
+    athlete_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    week_start = db.Column(db.String, index=True)
+    training_sessions = db.Column(db.Integer, default=0)
+    coaching_sessions = db.Column(db.Integer, default=0)
+    balance = db.Column(db.Float, default=0)
+
+
+class KioskCheckIn(db.Model):
+    """
+    Represents a check-in received from a kiosk, with the outcome it was given.
+
+    Kiosks send every check-in with an ID of their own. Keeping the outcome of each ID lets a
+    kiosk resend a batch whose answer it never received without the check-ins being applied twice.
+
+    Attributes:
+        id (str): The ID given to the check-in by the kiosk.
+        kiosk (str): The name of the kiosk.
+        kind (str): Either "training" or "coaching".
+        athlete_id (int): The ID of the athlete.
+        date (str): The date of the session in the format "YYYY-MM-DD".
+        status (str): "accepted" or "rejected".
+        reason (str): Why the check-in was rejected, see `KIOSK_ERRORS`.
+        received_at (str): When the check-in reached the server.
+    """
+
+    __tablename__ = "kiosk_check_ins"
+
+    id = db.Column(db.String, primary_key=True)
+    kiosk = db.Column(db.String)
+    kind = db.Column(db.String)
+    athlete_id = db.Column(db.Integer)
+    date = db.Column(db.String)
+    status = db.Column(db.String)
+    reason = db.Column(db.String)
+    received_at = db.Column(db.String)
+
+
+class IdempotencyKey(db.Model):
+    """
+    Represents the idempotency key of a form submission, with the response it was given.
+
+    A client that retries a POST with the same key gets the stored response back instead of the
+    write being made again. Keys expire after `IDEMPOTENCY_KEY_SECONDS`, and only the latest
+    `IDEMPOTENCY_MAX_KEYS` are kept.
+
+    Attributes:
+        id (int): The unique identifier of the key, in the order the keys were claimed.
+        key (str): The key sent by the client.
+        fingerprint (str): A hash of the route and the form of the request, to detect a key reused
+                           for another request.
+        created_at (str): When the key was claimed, in the format "YYYY-MM-DD HH:MM:SS".
+        status (int): The status code of the response, or None while the request is in progress.
+        location (str): The Location header of the response, for redirects.
+        content_type (str): The content type of the response.
+        body (bytes): The body of the response.
+    """
+
+    __tablename__ = "idempotency_keys"
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String, nullable=False, unique=True)
+    fingerprint = db.Column(db.String, nullable=False)
+    created_at = db.Column(db.String, nullable=False, index=True)
+    status = db.Column(db.Integer)
+    location = db.Column(db.String)
+    content_type = db.Column(db.String)
+    body = db.Column(db.LargeBinary)
+
+
+class ArchiveState(db.Model):
+    """
+    Records how much of a session table has been moved to the archive database.
+
+    All sessions dated before `archived_before` were moved to the archive when it was
+    written; sessions on or after that date are always in the main database.
+
+    Attributes:
+        table_name (str): The name of the archived table.
+        archived_before (str): The archive horizon in the format "YYYY-MM-DD".
+        rows (int): The number of rows moved to the archive so far.
+    """
+
+    __tablename__ = "archive_state"
+
+    table_name = db.Column(db.String, primary_key=True)
+    archived_before = db.Column(db.String)
+    rows = db.Column(db.Integer, default=0)
+
+
+class WeighIn(db.Model):
+    """
+    Represents one weigh-in of an athlete.
+
+    Weigh-ins are only ever appended. The table has no row ID: its primary key is the athlete and
+    the time of the weigh-in, so the rows of an athlete are stored together in time order and
+    range queries read them straight from the primary key. The latest weight is also kept in
+    `Athlete.weight` for eligibility checks.
+
+    Attributes:
+        athlete_id (int): The ID of the athlete.
+        weighed_at (datetime): When the athlete was weighed.
+        weight (float): The weight in KG.
+    """
+
+    __tablename__ = "weigh_ins"
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    athlete_id = db.Column(db.Integer, primary_key=True)
+    weighed_at = db.Column(db.DateTime, primary_key=True)
+    weight = db.Column(db.Float, nullable=False)
+
+
+class TrainingClass(db.Model):
+    """
+    Represents a scheduled class with a fixed number of places.
+
+    `booked` is the number of bookings of the class and is kept up to date by the booking
+    functions, so checking for a free place is a single row read. The partial index on the
+    classes with free places lets the schedule list open classes without reading full ones.
+
+    Attributes:
+        id (int): The unique identifier of the class.
+        name (str): The name of the class.
+        date (str): The date of the class in the format "YYYY-MM-DD".
+        starts_at (str): The start of the class in the format "YYYY-MM-DD HH:MM".
+        ends_at (str): The end of the class in the format "YYYY-MM-DD HH:MM", on the same day.
+        capacity (int): The maximum number of athletes.
+        booked (int): The number of athletes booked.
+    """
+
+    __tablename__ = "training_classes"
+    __table_args__ = (
+        db.Index("ix_training_classes_open", "starts_at",
+                 sqlite_where=db.text("booked < capacity"), postgresql_where=db.text("booked < capacity")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+    date = db.Column(db.String)
+    starts_at = db.Column(db.String, nullable=False, index=True)
+    ends_at = db.Column(db.String, nullable=False)
+    capacity = db.Column(db.Integer, nullable=False)
+    booked = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ClassBooking(db.Model):
+    """
+    Represents the booking of an athlete into a class.
+
+    Every booking creates a training session on the day of the class, so it counts against the
+    weekly number of sessions of the athlete's plan. The times of the class are copied onto the
+    booking, so overlapping bookings of an athlete are found through the (athlete_id, starts_at)
+    index without reading the bookings of other athletes.
+
+    Attributes:
+        id (int): The unique identifier of the booking.
+        class_id (int): The ID of the class.
+        athlete_id (int): The ID of the athlete.
+        training_session_id (int): The ID of the training session created for the booking.
+        starts_at (str): The start of the class in the format "YYYY-MM-DD HH:MM".
+        ends_at (str): The end of the class in the format "YYYY-MM-DD HH:MM".
+    """
+
+    __tablename__ = "class_bookings"
+    __table_args__ = (
+        db.UniqueConstraint("class_id", "athlete_id"),
+        db.Index("ix_class_bookings_athlete_starts_at", "athlete_id", "starts_at"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    class_id = db.Column(db.Integer, nullable=False)
+    athlete_id = db.Column(db.Integer, nullable=False)
+    training_session_id = db.Column(db.Integer)
+    starts_at = db.Column(db.String, nullable=False)
+    ends_at = db.Column(db.String, nullable=False)
+
+
+class ChangeEvent(db.Model):
+    """
+    Represents one change in the change-event outbox.
+
+    Writes append an event in the same transaction as the change itself, so an event exists if
+    and only if its change was committed. Open dashboards follow the outbox by ID. The IDs are
+    never reused, even after old events are pruned, so a reader that remembers the last ID it saw
+    never misses or repeats an event.
+
+    Attributes:
+        id (int): The position of the event in the outbox.
+        created_at (str): When the change was made, in the format "YYYY-MM-DD HH:MM:SS".
+        kind (str): The kind of change, for example "athlete" or "training_session".
+        payload (str): The details of the change as a JSON object, including the changes of the
+                       dashboard counters under "counts".
+    """
+
+    __tablename__ = "change_events"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.String, nullable=False)
+    kind = db.Column(db.String, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
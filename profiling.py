@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+from datetime import datetime
+from flask import current_app, request, session, make_response
+
+
+def get_profiles_folder():
+    """
+    Returns the folder where request profiles are stored, creating it if needed.
+
+    Returns:
+        str: The path of the "profiles" folder inside the instance folder.
+    """
+
+    folder = os.path.join(current_app.instance_path, "profiles")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def is_profiling_requested():
+    """
+    Checks whether the current request should run under the profiler.
+
+    Profiling is requested with the `profile=1` query parameter or the `X-Profile: 1` header,
+    and is only honoured for the administrator.
+
+    Returns:
+        bool: True if the request should be profiled.
+    """
+
+    requested = request.args.get("profile") == "1" or request.headers.get("X-Profile") == "1"
+    return requested and session.get("user") == "admin"
+
+
+def get_top_functions(stats, limit=15):
+    """
+    Returns the functions with the highest cumulative time of a profile.
+
+    Parameters:
+        stats (pstats.Stats): The statistics of the profile.
+        limit (int): The number of functions to return.
+
+    Returns:
+        list: Dictionaries with the "function", "calls", "own_time" and "cumulative_time" of each function.
+    """
+
+    stats.sort_stats("cumulative")
+    top = []
+    for func in stats.fcn_list[:limit]:
+        filename, line, name = func
+        _, calls, own_time, cumulative_time, _ = stats.stats[func]
+        top.append({
+            "function": "%s:%d(%s)" % (os.path.basename(filename), line, name) if line else name,
+            "calls": calls,
+            "own_time": own_time,
+            "cumulative_time": cumulative_time
+        })
+    return top
+
+
+def prune_profiles(folder, keep):
+    """
+    Deletes the oldest profiles so that at most `keep` remain.
+
+    Parameters:
+        folder (str): The profiles folder.
+        keep (int): The number of profiles to keep.
+
+    Returns:
+        None
+    """
+
+    names = sorted(name[:-len(".json")] for name in os.listdir(folder) if name.endswith(".json"))
+    for name in names[:max(len(names) - keep, 0)]:
+        for extension in (".json", ".prof"):
+            path = os.path.join(folder, name + extension)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def profile_request(f, *args, **kwargs):
+    """
+    Runs a view function under cProfile and stores the profile.
+
+    Two files are written to the profiles folder: the raw statistics as a `.prof` file, which
+    can be opened with `pstats`, snakeviz or flameprof, and a `.json` file with the request and
+    its top functions for the profiles page. The oldest profiles are deleted beyond the
+    `PROFILE_RETENTION` limit.
+
+    Parameters:
+        f (callable): The view function.
+        *args, **kwargs: The arguments of the view function.
+
+    Returns:
+        Response: The response of the view function, with the name of the profile in the `X-Profile-Id` header.
+    """
+
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    response = make_response(profiler.runcall(f, *args, **kwargs))
+    seconds = time.perf_counter() - started
+
+    folder = get_profiles_folder()
+    now = datetime.now()
+    name = "%s-%s" % (now.strftime("%Y%m%d-%H%M%S-%f"), request.endpoint)
+    profiler.dump_stats(os.path.join(folder, name + ".prof"))
+
+    with open(os.path.join(folder, name + ".json"), "w") as fp:
+        json.dump({
+            "name": name,
+            "created_at": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "method": request.method,
+            "url": request.full_path.rstrip("?"),
+            "endpoint": request.endpoint,
+            "status": response.status_code,
+            "seconds": seconds,
+            "top": get_top_functions(pstats.Stats(profiler))
+        }, fp)
+
+    prune_profiles(folder, current_app.config.get("PROFILE_RETENTION", 50))
+    response.headers["X-Profile-Id"] = name
+    return response
+
+
+def get_recent_profiles():
+    """
+    Returns the stored profiles, newest first.
+
+    Returns:
+        list: The contents of the `.json` file of every profile.
+    """
+
+    folder = get_profiles_folder()
+    profiles = []
+    for filename in sorted(os.listdir(folder), reverse=True):
+        if filename.endswith(".json"):
+            with open(os.path.join(folder, filename)) as fp:
+                profiles.append(json.load(fp))
+    return profiles
@@ -0,0 +1,1031 @@
+from sqlalchemy import (Date, DateTime, Float, Integer, String, bindparam, case, cast, delete, distinct, exists,
+                        func, insert, literal, select, true, union, update)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from models import *
+
+
+class week_start(FunctionElement):
+    """
+    The Monday of the week of a date, as text in the format "YYYY-MM-DD".
+
+    SQLite stores dates as text and computes the Monday with `date()` modifiers; PostgreSQL
+    truncates the date to its ISO week, which also starts on Monday.
+    """
+
+    type = String()
+    name = "week_start"
+    inherit_cache = True
+
+
+@compiles(week_start, "sqlite")
+def compile_week_start_sqlite(element, compiler, **kw):
+    return "date(%s, '-6 days', 'weekday 1')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(week_start)
+def compile_week_start(element, compiler, **kw):
+    return "to_char(date_trunc('week', cast(%s as date)), 'YYYY-MM-DD')" % compiler.process(element.clauses, **kw)
+
+
+class week_number(FunctionElement):
+    """
+    The week of the year of a date as two digits, counted from the first Monday of the year.
+
+    This is SQLite's `strftime('%W')`; PostgreSQL has no format for it, so it is computed from
+    the day of the year and the day of the week.
+    """
+
+    type = String()
+    name = "week_number"
+    inherit_cache = True
+
+
+@compiles(week_number, "sqlite")
+def compile_week_number_sqlite(element, compiler, **kw):
+    return "strftime('%%W', %s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(week_number)
+def compile_week_number(element, compiler, **kw):
+    value = "cast(%s as date)" % compiler.process(element.clauses, **kw)
+    return "lpad(cast((cast(extract(doy from {0}) as integer) + 6 - (cast(extract(isodow from {0}) as integer) - 1)) " \
+           "/ 7 as varchar), 2, '0')".format(value)
+
+
+class add_days(FunctionElement):
+    """
+    A date plus a number of days, as text in the format "YYYY-MM-DD".
+
+    Takes the date and the number of days as arguments.
+    """
+
+    type = String()
+    name = "add_days"
+    inherit_cache = True
+
+
+@compiles(add_days, "sqlite")
+def compile_add_days_sqlite(element, compiler, **kw):
+    value, days = element.clauses.clauses
+    return "date(%s, %s || ' days')" % (compiler.process(value, **kw), compiler.process(days, **kw))
+
+
+@compiles(add_days)
+def compile_add_days(element, compiler, **kw):
+    value, days = element.clauses.clauses
+    return "to_char(cast(%s as date) + %s, 'YYYY-MM-DD')" % (compiler.process(value, **kw), compiler.process(days, **kw))
+
+
+class day_number(FunctionElement):
+    """
+    A timestamp as a number of days, with the time of day as the fraction.
+
+    Only the difference between two day numbers is meaningful: SQLite counts Julian days and
+    PostgreSQL days since the Unix epoch.
+    """
+
+    type = Float()
+    name = "day_number"
+    inherit_cache = True
+
+
+@compiles(day_number, "sqlite")
+def compile_day_number_sqlite(element, compiler, **kw):
+    return "julianday(%s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(day_number)
+def compile_day_number(element, compiler, **kw):
+    return "extract(epoch from cast(%s as timestamp)) / 86400.0" % compiler.process(element.clauses, **kw)
+
+
+class floor_int(FunctionElement):
+    """
+    The largest integer not above a number.
+
+    SQLite truncates when casting to an integer, which is the floor for the positive numbers this
+    is used with; PostgreSQL rounds, so the floor is taken first.
+    """
+
+    type = Integer()
+    name = "floor_int"
+    inherit_cache = True
+
+
+@compiles(floor_int, "sqlite")
+def compile_floor_int_sqlite(element, compiler, **kw):
+    return "cast(%s as integer)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(floor_int)
+def compile_floor_int(element, compiler, **kw):
+    return "cast(floor(%s) as integer)" % compiler.process(element.clauses, **kw)
+
+
+class least(FunctionElement):
+    """
+    The smallest of its arguments: SQLite's scalar `min()`, PostgreSQL's `least()`.
+    """
+
+    type = Integer()
+    name = "least"
+    inherit_cache = True
+
+
+@compiles(least, "sqlite")
+def compile_least_sqlite(element, compiler, **kw):
+    return "min(%s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(least)
+def compile_least(element, compiler, **kw):
+    return "least(%s)" % compiler.process(element.clauses, **kw)
+
+
+class as_date(FunctionElement):
+    """
+    A text date as a date, to compare it with a date column or to store it in one.
+
+    SQLite stores dates as text and would turn a cast to DATE into a number, so the value is used
+    as it is there. Other databases cast it.
+    """
+
+    type = Date()
+    name = "as_date"
+    inherit_cache = True
+
+
+@compiles(as_date, "sqlite")
+def compile_as_date_sqlite(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+
+@compiles(as_date)
+def compile_as_date(element, compiler, **kw):
+    return "cast(%s as date)" % compiler.process(element.clauses, **kw)
+
+
+class as_timestamp(FunctionElement):
+    """
+    A text timestamp as a timestamp. Like `as_date`, this is a no-op on SQLite.
+    """
+
+    type = DateTime()
+    name = "as_timestamp"
+    inherit_cache = True
+
+
+@compiles(as_timestamp, "sqlite")
+def compile_as_timestamp_sqlite(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+
+@compiles(as_timestamp)
+def compile_as_timestamp(element, compiler, **kw):
+    return "cast(%s as timestamp)" % compiler.process(element.clauses, **kw)
+
+
+def text_param(name):
+    """
+    Returns a bound parameter for a date or timestamp passed as text.
+
+    The SQLite date types only accept Python dates, so parameters compared with date columns are
+    declared as text. The dates of the application are ISO strings, which compare correctly.
+
+    Parameters:
+        name (str): The name of the parameter.
+
+    Returns:
+        BindParameter: The parameter.
+    """
+
+    return bindparam(name, type_=String)
+
+
+def upsert(dialect, table):
+    """
+    Returns an INSERT statement with the ON CONFLICT clauses of a dialect.
+
+    Parameters:
+        dialect (str): The name of the database dialect, "sqlite" or "postgresql".
+        table (Table): The table to insert into.
+
+    Returns:
+        Insert: The statement, with `on_conflict_do_update` and `on_conflict_do_nothing`.
+    """
+
+    return (postgresql.insert if dialect == "postgresql" else sqlite.insert)(table)
+
+
+def _count_subquery(source, *conditions):
+    """
+    Returns a scalar subquery counting the rows of a source that match conditions.
+    """
+
+    return select(func.count()).select_from(source).where(*conditions).scalar_subquery()
+
+
+def _sum_subquery(column, source, *conditions):
+    """
+    Returns a scalar subquery summing a column of a source over the rows that match conditions, 0 if none.
+    """
+
+    return select(func.coalesce(func.sum(column), 0)).select_from(source).where(*conditions).scalar_subquery()
+
+
+# Every statement of the application, by name. A query is declared by a builder function that
+# returns a SQLAlchemy Core statement for a database dialect, so the same query runs on SQLite and
+# PostgreSQL. Values are passed as bound parameters. A session table that may have to include the
+# archive is passed to the builder by name, for example `training_sessions`, as returned by
+# `sessions_table`.
+#
+# Parameters of UPDATE statements must not be named after a column of the updated table:
+# SQLAlchemy would add them to the SET clause. They are named after the value instead, for example
+# ":athlete" for the athlete ID in the charge snapshots.
+QUERIES = {}
+
+
+def query_builder(name):
+    """
+    Registers the builder of a query under a name.
+
+    Parameters:
+        name (str): The name of the query.
+
+    Returns:
+        function: A decorator that registers the builder and returns it unchanged.
+    """
+
+    def decorator(f):
+        QUERIES[name] = f
+        return f
+    return decorator
+
+
+# Athletes
+
+@query_builder("list_athletes")
+def _list_athletes(dialect):
+    a, t, s = Athlete.__table__.alias("a"), TrainingPlan.__table__.alias("t"), AthleteSummary.__table__.alias("s")
+    return select(
+        a.c.id, a.c.fullname, a.c.gender, a.c.age, a.c.weight,
+        t.c.name.label("training_plan"), t.c.can_attend_competitions,
+        s.c.training_sessions, s.c.coaching_sessions, s.c.balance,
+        case((s.c.training_sessions < t.c.num_of_sessions, t.c.num_of_sessions - s.c.training_sessions),
+             else_=0).label("remaining_sessions")
+    ).select_from(
+        a.join(t, a.c.training_plan == t.c.id).outerjoin(s, s.c.athlete_id == a.c.id)
+    ).order_by(a.c.id)
+
+
+@query_builder("export_athletes")
+def _export_athletes(dialect):
+    a, t = Athlete.__table__.alias("a"), TrainingPlan.__table__.alias("t")
+    return select(a.c.id, a.c.fullname, a.c.gender, a.c.age, a.c.weight, t.c.name.label("training_plan")) \
+        .select_from(a.join(t, a.c.training_plan == t.c.id)) \
+        .where(a.c.id > bindparam("last_id")).order_by(a.c.id).limit(bindparam("batch_size"))
+
+
+@query_builder("invoice_batch_athlete_ids")
+def _invoice_batch_athlete_ids(dialect):
+    a = Athlete.__table__
+    return select(a.c.id).where(a.c.id > bindparam("last_athlete_id"), a.c.id <= bindparam("last_id")) \
+        .order_by(a.c.id).limit(bindparam("batch_size"))
+
+
+@query_builder("athlete_id_range")
+def _athlete_id_range(dialect):
+    a = Athlete.__table__
+    return select(func.min(a.c.id), func.max(a.c.id))
+
+
+@query_builder("current_weight")
+def _current_weight(dialect):
+    a = Athlete.__table__
+    return select(a.c.weight).where(a.c.id == bindparam("athlete_id"))
+
+
+# Sessions
+
+def _sessions_per_athlete(sessions):
+    c, a = sessions.alias("c"), Athlete.__table__.alias("a")
+    return select(a.c.id, a.c.fullname, func.count().label("sessions")) \
+        .select_from(c.join(a, c.c.athlete_id == a.c.id)) \
+        .group_by(a.c.id, a.c.fullname)
+
+
+@query_builder("training_sessions_per_athlete")
+def _training_sessions_per_athlete(dialect, training_sessions):
+    return _sessions_per_athlete(training_sessions)
+
+
+@query_builder("coaching_sessions_per_athlete")
+def _coaching_sessions_per_athlete(dialect, coaching_sessions):
+    return _sessions_per_athlete(coaching_sessions)
+
+
+def _sessions_per_week(sessions, *columns):
+    s = sessions.alias("s")
+    week = week_start(s.c.date)
+    return select(
+        func.max(week_number(s.c.date)).label("WeekNumber"),
+        week.label("WeekStart"),
+        add_days(week, 6).label("WeekEnd"),
+        func.count().label("NumSessions"),
+        *[column(s) for column in columns]
+    ).where(s.c.athlete_id == bindparam("athlete_id")).group_by(week).order_by(week)
+
+
+@query_builder("training_sessions_per_week")
+def _training_sessions_per_week(dialect, training_sessions):
+    return _sessions_per_week(training_sessions)
+
+
+@query_builder("coaching_sessions_per_week")
+def _coaching_sessions_per_week(dialect, coaching_sessions):
+    return _sessions_per_week(coaching_sessions, lambda s: func.sum(s.c.tuition_fees).label("total_fees"))
+
+
+@query_builder("count_athlete_sessions")
+def _count_athlete_sessions(dialect, sessions):
+    s = sessions.alias("s")
+    return select(func.count()).select_from(s).where(
+        s.c.athlete_id == bindparam("athlete_id"), s.c.date.between(text_param("start"), text_param("end")))
+
+
+@query_builder("athlete_sessions")
+def _athlete_sessions(dialect, sessions):
+    s = sessions.alias("s")
+    return select(s).where(s.c.athlete_id == bindparam("athlete_id")).order_by(s.c.date)
+
+
+@query_builder("register_training_session")
+def _register_training_session(dialect, training_sessions):
+    a, tp, t = Athlete.__table__.alias("a"), TrainingPlan.__table__.alias("tp"), training_sessions.alias("t")
+    week_sessions = _count_subquery(t, t.c.athlete_id == bindparam("athlete_id"),
+                                   t.c.date.between(text_param("week_start"), text_param("week_end")))
+    return insert(TrainingSession.__table__).from_select(
+        ["athlete_id", "date"],
+        select(a.c.id, as_date(text_param("date")))
+        .select_from(a.join(tp, tp.c.id == a.c.training_plan))
+        .where(a.c.id == bindparam("athlete_id"), week_sessions < tp.c.num_of_sessions))
+
+
+@query_builder("register_coaching_session")
+def _register_coaching_session(dialect, coaching_sessions):
+    a, tp, c = Athlete.__table__.alias("a"), TrainingPlan.__table__.alias("tp"), coaching_sessions.alias("c")
+    week_sessions = _count_subquery(c, c.c.athlete_id == bindparam("athlete_id"),
+                                   c.c.date.between(text_param("week_start"), text_param("week_end")))
+    return insert(CoachingSession.__table__).from_select(
+        ["athlete_id", "date", "tuition_fees"],
+        select(a.c.id, as_date(text_param("date")), cast(bindparam("tuition_fees"), Float))
+        .select_from(a.join(tp, tp.c.id == a.c.training_plan))
+        .where(a.c.id == bindparam("athlete_id"), tp.c.can_attend_private_coaching == true(),
+               week_sessions < tp.c.private_coaching_max_sessions))
+
+
+@query_builder("delete_training_session")
+def _delete_training_session(dialect):
+    t = TrainingSession.__table__
+    return delete(t).where(t.c.id == bindparam("session_id"))
+
+
+def _sessions_since(sessions, fees):
+    s, a = sessions.alias("s"), Athlete.__table__.alias("a")
+    return select(s.c.athlete_id, week_start(s.c.date).label("week"), a.c.training_plan, fees(s)) \
+        .select_from(s.join(a, a.c.id == s.c.athlete_id)) \
+        .where(s.c.date >= text_param("since"))
+
+
+@query_builder("training_sessions_since")
+def _training_sessions_since(dialect, training_sessions):
+    return _sessions_since(training_sessions, lambda s: literal(0).label("fees"))
+
+
+@query_builder("coaching_sessions_since")
+def _coaching_sessions_since(dialect, coaching_sessions):
+    return _sessions_since(coaching_sessions, lambda s: s.c.tuition_fees)
+
+
+# Archive
+
+@query_builder("archive_horizon")
+def _archive_horizon(dialect):
+    s = ArchiveState.__table__
+    return select(s.c.archived_before).where(s.c.table_name == bindparam("table_name"))
+
+
+# Competitions
+
+def _weight_category_label(wc):
+    return (wc.c.name + " (" + cast(wc.c.max_weight, String) + " kg)")
+
+
+@query_builder("list_competitions")
+def _list_competitions(dialect):
+    c = Competition.__table__.alias("c")
+    cr = CompetitionRegistration.__table__.alias("cr")
+    wc = WeightCategory.__table__.alias("wc")
+    return select(
+        c.c.id, c.c.name.label("competition_name"), c.c.date, c.c.entry_fee,
+        func.count(cr.c.id).label("participants_count"), _weight_category_label(wc).label("weight_category")
+    ).select_from(
+        c.outerjoin(cr, c.c.id == cr.c.competition_id).join(wc, c.c.weight_category == wc.c.id)
+    ).group_by(c.c.id, c.c.name, c.c.date, c.c.entry_fee, wc.c.name, wc.c.max_weight).order_by(c.c.name, c.c.id)
+
+
+@query_builder("first_competition_id")
+def _first_competition_id(dialect):
+    c = Competition.__table__
+    return select(func.min(c.c.id))
+
+
+@query_builder("competition")
+def _competition(dialect):
+    c, wc = Competition.__table__.alias("c"), WeightCategory.__table__.alias("wc")
+    return select(c.c.id, c.c.name, c.c.date, _weight_category_label(wc).label("weight"), wc.c.id.label("weight_id")) \
+        .select_from(c.join(wc, c.c.weight_category == wc.c.id)) \
+        .where(c.c.id == bindparam("competition_id"))
+
+
+@query_builder("competition_participants")
+def _competition_participants(dialect):
+    cr, a = CompetitionRegistration.__table__.alias("cr"), Athlete.__table__.alias("a")
+    return select(cr.c.id, a.c.fullname, a.c.weight) \
+        .select_from(cr.join(a, cr.c.athlete_id == a.c.id)) \
+        .where(cr.c.competition_id == bindparam("competition_id"))
+
+
+@query_builder("eligible_competition_athletes")
+def _eligible_competition_athletes(dialect):
+    tp, at = TrainingPlan.__table__.alias("tp"), Athlete.__table__.alias("at")
+    wc = WeightCategory.__table__.alias("wc")
+    return select(at.c.id, at.c.fullname, at.c.weight) \
+        .select_from(tp.outerjoin(at, tp.c.id == at.c.training_plan)
+                     .join(wc, wc.c.id == bindparam("weight_category"))) \
+        .where(tp.c.can_attend_competitions == true(), at.c.weight.between(wc.c.min_weight, wc.c.max_weight))
+
+
+def _athlete_registrations():
+    cr, cp = CompetitionRegistration.__table__.alias("cr"), Competition.__table__.alias("cp")
+    return cr, cp, cr.join(cp, cp.c.id == cr.c.competition_id)
+
+
+@query_builder("athlete_competitions")
+def _athlete_competitions(dialect):
+    cr, cp, source = _athlete_registrations()
+    return select(cp.c.name, cp.c.date, cp.c.entry_fee).select_from(source) \
+        .where(cr.c.athlete_id == bindparam("athlete_id"))
+
+
+@query_builder("athlete_competition_fees")
+def _athlete_competition_fees(dialect):
+    cr, cp, source = _athlete_registrations()
+    return select(func.sum(cp.c.entry_fee)).select_from(source).where(cr.c.athlete_id == bindparam("athlete_id"))
+
+
+# Dashboard
+
+@query_builder("dashboard_snapshot")
+def _dashboard_snapshot(dialect):
+    counts = [_count_subquery(model.__table__).label(model.__tablename__)
+              for model in (Athlete, Competition, TrainingSession, CoachingSession)]
+    events = ChangeEvent.__table__
+    last_event_id = select(func.coalesce(func.max(events.c.id), 0)).scalar_subquery().label("last_event_id")
+    return select(*counts, last_event_id)
+
+
+# Athlete summaries
+
+@query_builder("stale_athlete_summaries")
+def _stale_athlete_summaries(dialect):
+    a, s = Athlete.__table__.alias("a"), AthleteSummary.__table__.alias("s")
+    summary = select(1).select_from(s).where(s.c.athlete_id == a.c.id, s.c.week_start == bindparam("week_start"))
+    return select(exists(select(1).select_from(a).where(~exists(summary))))
+
+
+def _rebuild_athlete_summaries(dialect, training_sessions, coaching_sessions, condition):
+    summaries = AthleteSummary.__table__
+    a, tp = Athlete.__table__.alias("a"), TrainingPlan.__table__.alias("tp")
+    t, c = training_sessions.alias("t"), coaching_sessions.alias("c")
+    cr, cp, registrations = _athlete_registrations()
+    in_week = lambda column: column.between(text_param("week_start"), text_param("week_end"))
+
+    training_weeks = select(func.count(distinct(week_start(t.c.date)))).select_from(t) \
+        .where(t.c.athlete_id == a.c.id).scalar_subquery()
+    balance = func.coalesce(tp.c.price, 0) * training_weeks \
+        + _sum_subquery(c.c.tuition_fees, c, c.c.athlete_id == a.c.id) \
+        + _sum_subquery(cp.c.entry_fee, registrations, cr.c.athlete_id == a.c.id)
+
+    statement = upsert(dialect, summaries).from_select(
+        ["athlete_id", "week_start", "training_sessions", "coaching_sessions", "balance"],
+        select(
+            a.c.id, bindparam("week_start", type_=String),
+            _count_subquery(t, t.c.athlete_id == a.c.id, in_week(t.c.date)),
+            _count_subquery(c, c.c.athlete_id == a.c.id, in_week(c.c.date)),
+            balance
+        ).select_from(a.outerjoin(tp, tp.c.id == a.c.training_plan)).where(condition(a)))
+
+    return statement.on_conflict_do_update(index_elements=[summaries.c.athlete_id], set_={
+        "week_start": statement.excluded.week_start,
+        "training_sessions": statement.excluded.training_sessions,
+        "coaching_sessions": statement.excluded.coaching_sessions,
+        "balance": statement.excluded.balance
+    })
+
+
+@query_builder("rebuild_stale_athlete_summaries")
+def _rebuild_stale_athlete_summaries(dialect, training_sessions, coaching_sessions):
+    summaries = AthleteSummary.__table__
+    current = select(summaries.c.athlete_id).where(summaries.c.week_start == bindparam("week_start"))
+    return _rebuild_athlete_summaries(dialect, training_sessions, coaching_sessions,
+                                     lambda a: a.c.id.not_in(current))
+
+
+@query_builder("rebuild_athlete_summary")
+def _rebuild_athlete_summary(dialect, training_sessions, coaching_sessions):
+    return _rebuild_athlete_summaries(dialect, training_sessions, coaching_sessions,
+                                     lambda a: a.c.id == bindparam("athlete_id"))
+
+
+@query_builder("update_athlete_summary")
+def _update_athlete_summary(dialect):
+    s = AthleteSummary.__table__
+    a, tp = Athlete.__table__.alias("a"), TrainingPlan.__table__.alias("tp")
+    this_week = s.c.week_start == bindparam("current_week")
+    price = select(tp.c.price).select_from(a.join(tp, tp.c.id == a.c.training_plan)) \
+        .where(a.c.id == bindparam("athlete")).scalar_subquery()
+    return update(s).where(s.c.athlete_id == bindparam("athlete")).values(
+        training_sessions=s.c.training_sessions + case((this_week, bindparam("training_delta", type_=Integer)), else_=0),
+        coaching_sessions=s.c.coaching_sessions + case((this_week, bindparam("coaching_delta", type_=Integer)), else_=0),
+        balance=s.c.balance + bindparam("fees", type_=Float)
+        + bindparam("training_weeks", type_=Integer) * func.coalesce(price, 0))
+
+
+# Kiosks
+
+@query_builder("kiosk_athletes")
+def _kiosk_athletes(dialect):
+    a, s = Athlete.__table__.alias("a"), AthleteSummary.__table__.alias("s")
+    this_week = s.c.week_start == bindparam("week_start")
+    return select(
+        a.c.id, a.c.fullname, a.c.training_plan,
+        case((this_week, s.c.training_sessions), else_=0).label("training_sessions"),
+        case((this_week, s.c.coaching_sessions), else_=0).label("coaching_sessions")
+    ).select_from(a.outerjoin(s, s.c.athlete_id == a.c.id)).order_by(a.c.id)
+
+
+# Charge snapshots and invoices
+
+def _charge_weeks(training_sessions, coaching_sessions):
+    t, c = training_sessions.alias("t"), coaching_sessions.alias("c")
+    cr, cp, registrations = _athlete_registrations()
+    weeks = union(
+        select(t.c.athlete_id, week_start(t.c.date).label("week_start")),
+        select(c.c.athlete_id, week_start(c.c.date)),
+        select(cr.c.athlete_id, week_start(cp.c.date)).select_from(registrations)
+    ).subquery("w")
+    return select(weeks.c.athlete_id, weeks.c.week_start, add_days(weeks.c.week_start, 6), true())
+
+
+@query_builder("backfill_charge_snapshots")
+def _backfill_charge_snapshots(dialect, training_sessions, coaching_sessions):
+    return insert(ChargeSnapshot.__table__).from_select(
+        ["athlete_id", "week_start", "week_end", "dirty"], _charge_weeks(training_sessions, coaching_sessions))
+
+
+@query_builder("mark_charge_weeks_dirty")
+def _mark_charge_weeks_dirty(dialect, training_sessions, coaching_sessions):
+    snapshots = ChargeSnapshot.__table__
+    # SQLite needs a where clause to tell the ON of the upsert from the ON of a join.
+    return upsert(dialect, snapshots).from_select(
+        ["athlete_id", "week_start", "week_end", "dirty"], _charge_weeks(training_sessions, coaching_sessions).where(true())
+    ).on_conflict_do_update(index_elements=[snapshots.c.athlete_id, snapshots.c.week_start], set_={"dirty": True})
+
+
+@query_builder("mark_charge_week_dirty")
+def _mark_charge_week_dirty(dialect):
+    snapshots = ChargeSnapshot.__table__
+    return upsert(dialect, snapshots).values(
+        athlete_id=bindparam("athlete_id"), week_start=bindparam("week_start"), week_end=bindparam("week_end"),
+        dirty=True
+    ).on_conflict_do_update(index_elements=[snapshots.c.athlete_id, snapshots.c.week_start], set_={"dirty": True})
+
+
+@query_builder("mark_athlete_charges_dirty")
+def _mark_athlete_charges_dirty(dialect):
+    snapshots = ChargeSnapshot.__table__
+    return update(snapshots).where(snapshots.c.athlete_id == bindparam("athlete")).values(dirty=True)
+
+
+@query_builder("first_dirty_charge_week")
+def _first_dirty_charge_week(dialect):
+    snapshots = ChargeSnapshot.__table__
+    return select(func.min(snapshots.c.week_start)).where(snapshots.c.dirty == true())
+
+
+@query_builder("first_dirty_athlete_charge_week")
+def _first_dirty_athlete_charge_week(dialect):
+    snapshots = ChargeSnapshot.__table__
+    return select(func.min(snapshots.c.week_start)) \
+        .where(snapshots.c.dirty == true(), snapshots.c.athlete_id == bindparam("athlete"))
+
+
+def _refresh_charge_snapshots(training_sessions, coaching_sessions):
+    cs = ChargeSnapshot.__table__
+    a, tp = Athlete.__table__.alias("a"), TrainingPlan.__table__.alias("tp")
+    t, c = training_sessions.alias("t"), coaching_sessions.alias("c")
+    cr, cp, registrations = _athlete_registrations()
+
+    def in_week(sessions):
+        return [sessions.c.athlete_id == cs.c.athlete_id,
+                sessions.c.date.between(as_date(cs.c.week_start), as_date(cs.c.week_end))]
+
+    competitions_in_week = [cr.c.athlete_id == cs.c.athlete_id, cp.c.date.between(cs.c.week_start, cs.c.week_end)]
+    price = select(tp.c.price).select_from(a.join(tp, tp.c.id == a.c.training_plan)) \
+        .where(a.c.id == cs.c.athlete_id).scalar_subquery()
+
+    return update(cs).where(cs.c.dirty == true()).values(
+        training_sessions=_count_subquery(t, *in_week(t)),
+        plan_fee=case((exists(select(1).select_from(t).where(*in_week(t))), price), else_=0),
+        coaching_sessions=_count_subquery(c, *in_week(c)),
+        coaching_fees=_sum_subquery(c.c.tuition_fees, c, *in_week(c)),
+        competitions=_count_subquery(registrations, *competitions_in_week),
+        competition_fees=_sum_subquery(cp.c.entry_fee, registrations, *competitions_in_week),
+        dirty=False)
+
+
+@query_builder("refresh_charge_snapshots")
+def _refresh_all_charge_snapshots(dialect, training_sessions, coaching_sessions):
+    return _refresh_charge_snapshots(training_sessions, coaching_sessions)
+
+
+@query_builder("refresh_athlete_charge_snapshots")
+def _refresh_athlete_charge_snapshots(dialect, training_sessions, coaching_sessions):
+    snapshots = ChargeSnapshot.__table__
+    return _refresh_charge_snapshots(training_sessions, coaching_sessions) \
+        .where(snapshots.c.athlete_id == bindparam("athlete"))
+
+
+@query_builder("payments_summary")
+def _payments_summary(dialect):
+    snapshots = ChargeSnapshot.__table__
+    return select(func.sum(snapshots.c.plan_fee), func.sum(snapshots.c.coaching_fees),
+                  func.sum(snapshots.c.competition_fees))
+
+
+@query_builder("invoice_training_fees")
+def _invoice_training_fees(dialect, training_sessions):
+    t = training_sessions.alias("t")
+    a, tp = Athlete.__table__.alias("a"), TrainingPlan.__table__.alias("tp")
+    weeks = select(t.c.athlete_id, week_start(t.c.date).label("week_start")).where(
+        t.c.athlete_id.between(bindparam("first_id"), bindparam("last_id")),
+        t.c.date.between(text_param("month_start"), text_param("weeks_end"))
+    ).subquery("w")
+    return select(weeks.c.athlete_id, func.count(distinct(weeks.c.week_start)).label("weeks"), tp.c.price) \
+        .select_from(weeks.join(a, a.c.id == weeks.c.athlete_id).join(tp, tp.c.id == a.c.training_plan)) \
+        .where(func.substr(weeks.c.week_start, 1, 7) == bindparam("period")) \
+        .group_by(weeks.c.athlete_id, tp.c.price)
+
+
+@query_builder("invoice_coaching_fees")
+def _invoice_coaching_fees(dialect, coaching_sessions):
+    c = coaching_sessions.alias("c")
+    return select(c.c.athlete_id, func.sum(c.c.tuition_fees).label("fees")).where(
+        c.c.athlete_id.between(bindparam("first_id"), bindparam("last_id")),
+        c.c.date.between(text_param("month_start"), text_param("month_end"))
+    ).group_by(c.c.athlete_id)
+
+
+@query_builder("invoice_competition_fees")
+def _invoice_competition_fees(dialect):
+    cr, cp, registrations = _athlete_registrations()
+    return select(cr.c.athlete_id, func.sum(cp.c.entry_fee).label("fees")).select_from(registrations).where(
+        cr.c.athlete_id.between(bindparam("first_id"), bindparam("last_id")),
+        cp.c.date.between(bindparam("month_start"), bindparam("month_end"))
+    ).group_by(cr.c.athlete_id)
+
+
+# Weigh-ins
+
+@query_builder("backfill_weigh_ins")
+def _backfill_weigh_ins(dialect):
+    a = Athlete.__table__
+    return insert(WeighIn.__table__).from_select(
+        ["athlete_id", "weighed_at", "weight"],
+        select(a.c.id, as_timestamp(text_param("now")), a.c.weight).where(a.c.weight.is_not(None)))
+
+
+@query_builder("record_weigh_in")
+def _record_weigh_in(dialect):
+    weigh_ins = WeighIn.__table__
+    statement = upsert(dialect, weigh_ins).values(
+        athlete_id=bindparam("athlete_id"), weighed_at=as_timestamp(text_param("weighed_at")),
+        weight=bindparam("new_weight"))
+    return statement.on_conflict_do_update(index_elements=[weigh_ins.c.athlete_id, weigh_ins.c.weighed_at],
+                                           set_={"weight": statement.excluded.weight})
+
+
+@query_builder("update_current_weight")
+def _update_current_weight(dialect):
+    a, weigh_ins = Athlete.__table__, WeighIn.__table__
+    later = select(1).select_from(weigh_ins).where(
+        weigh_ins.c.athlete_id == bindparam("athlete_id"),
+        weigh_ins.c.weighed_at > as_timestamp(text_param("weighed_at")))
+    return update(a).where(a.c.id == bindparam("athlete_id"), ~exists(later)).values(weight=bindparam("new_weight"))
+
+
+@query_builder("weight_series")
+def _weight_series(dialect):
+    w = WeighIn.__table__
+    start, end, points = text_param("start"), text_param("end"), bindparam("points", type_=Integer)
+    bucket = least(
+        floor_int((day_number(w.c.weighed_at) - day_number(start)) * points / (day_number(end) - day_number(start))),
+        points - 1)
+    weighed_at = func.min(w.c.weighed_at)
+    return select(
+        weighed_at.label("weighed_at"), func.avg(w.c.weight).label("weight"),
+        func.min(w.c.weight).label("min"), func.max(w.c.weight).label("max"), func.count().label("count")
+    ).where(
+        w.c.athlete_id == bindparam("athlete_id"),
+        w.c.weighed_at.between(as_timestamp(start), as_timestamp(end))
+    ).group_by(bucket).order_by(weighed_at)
+
+
+# JSON API
+#
+# The builders of the API resources take the fields to select, the filters of the request and
+# whether the records are paged, so every shape of request is built once and then cached.
+
+def _api_select(source, columns, key, fields, filters, paged, date=None, order=None):
+    """
+    Returns the select of an API resource with the fields and filters of a request.
+
+    Only the columns of the resource can be selected or filtered on, so the names given by the
+    client never reach the SQL. Lists of values are bound as expanding parameters.
+
+    Parameters:
+        source (FromClause): The tables the resource is read from.
+        columns (dict): The column of every field of the resource, by name.
+        key (Column): The column the records are fetched by with "ids" and paged by with "after".
+        fields (tuple): The names of the fields to select.
+        filters (tuple): The filters of the request: "ids", "after", "since", "until" or the name
+                         of a field filtered with the list of values of the parameter of that name.
+        paged (bool): Whether at most "limit" records are read.
+        date (Column, optional): The column filtered by "since" and "until".
+        order (list, optional): The columns to order the records by. Defaults to the key.
+
+    Returns:
+        Select: The statement.
+    """
+
+    statement = select(*[columns[field].label(field) for field in fields]).select_from(source)
+    for name in filters:
+        if name == "ids":
+            statement = statement.where(key.in_(bindparam("ids", expanding=True)))
+        elif name == "after":
+            statement = statement.where(key > bindparam("after", type_=Integer))
+        elif name == "since":
+            statement = statement.where(date >= text_param("since"))
+        elif name == "until":
+            statement = statement.where(date <= text_param("until"))
+        else:
+            statement = statement.where(columns[name].in_(bindparam(name, expanding=True)))
+    statement = statement.order_by(*(order or [key]))
+    return statement.limit(bindparam("limit", type_=Integer)) if paged else statement
+
+
+@query_builder("api_athletes")
+def _api_athletes(dialect, fields, filters, paged):
+    a, tp = Athlete.__table__.alias("a"), TrainingPlan.__table__.alias("tp")
+    columns = {
+        "id": a.c.id, "fullname": a.c.fullname, "gender": a.c.gender, "age": a.c.age, "weight": a.c.weight,
+        "training_plan": a.c.training_plan, "training_plan_name": tp.c.name
+    }
+    return _api_select(a.outerjoin(tp, tp.c.id == a.c.training_plan), columns, a.c.id, fields, filters, paged)
+
+
+@query_builder("api_training_sessions")
+def _api_training_sessions(dialect, fields, filters, paged, training_sessions):
+    t = training_sessions.alias("t")
+    columns = {"id": t.c.id, "athlete_id": t.c.athlete_id, "date": t.c.date}
+    return _api_select(t, columns, t.c.id, fields, filters, paged, date=t.c.date)
+
+
+@query_builder("api_coaching_sessions")
+def _api_coaching_sessions(dialect, fields, filters, paged, coaching_sessions):
+    c = coaching_sessions.alias("c")
+    columns = {"id": c.c.id, "athlete_id": c.c.athlete_id, "date": c.c.date, "tuition_fees": c.c.tuition_fees}
+    return _api_select(c, columns, c.c.id, fields, filters, paged, date=c.c.date)
+
+
+@query_builder("api_competitions")
+def _api_competitions(dialect, fields, filters, paged):
+    cp, cr = Competition.__table__.alias("cp"), CompetitionRegistration.__table__.alias("cr")
+    columns = {
+        "id": cp.c.id, "name": cp.c.name, "date": cp.c.date, "entry_fee": cp.c.entry_fee,
+        "participants": _count_subquery(cr, cr.c.competition_id == cp.c.id)
+    }
+    return _api_select(cp, columns, cp.c.id, fields, filters, paged, date=cp.c.date)
+
+
+@query_builder("api_payments")
+def _api_payments(dialect, fields, filters, paged):
+    s = ChargeSnapshot.__table__.alias("s")
+    columns = {
+        name: s.c[name] for name in ("athlete_id", "week_start", "week_end", "training_sessions", "plan_fee",
+                                     "coaching_sessions", "coaching_fees", "competitions", "competition_fees")
+    }
+    return _api_select(s, columns, s.c.athlete_id, fields, filters, paged, date=s.c.week_start,
+                       order=[s.c.athlete_id, s.c.week_start])
+
+
+# Classes
+
+@query_builder("training_class")
+def _training_class(dialect):
+    c = TrainingClass.__table__
+    return select(c.c.id, c.c.date, c.c.starts_at, c.c.ends_at).where(c.c.id == bindparam("class_id"))
+
+
+@query_builder("take_class_place")
+def _take_class_place(dialect):
+    c = TrainingClass.__table__
+    return update(c).where(c.c.id == bindparam("class_id"), c.c.booked < c.c.capacity).values(booked=c.c.booked + 1)
+
+
+@query_builder("release_class_place")
+def _release_class_place(dialect):
+    c = TrainingClass.__table__
+    return update(c).where(c.c.id == bindparam("class_id")).values(booked=c.c.booked - 1)
+
+
+@query_builder("overlapping_class_booking")
+def _overlapping_class_booking(dialect):
+    b = ClassBooking.__table__
+    return select(b.c.class_id).where(
+        b.c.athlete_id == bindparam("athlete_id"),
+        b.c.starts_at >= bindparam("date"), b.c.starts_at < bindparam("ends_at"),
+        b.c.ends_at > bindparam("starts_at")
+    ).limit(1)
+
+
+@query_builder("latest_training_session_of_day")
+def _latest_training_session_of_day(dialect):
+    t = TrainingSession.__table__
+    return select(func.max(t.c.id)).where(t.c.athlete_id == bindparam("athlete_id"), t.c.date == text_param("date"))
+
+
+@query_builder("add_class_booking")
+def _add_class_booking(dialect):
+    return insert(ClassBooking.__table__).values(
+        class_id=bindparam("class_id"), athlete_id=bindparam("athlete_id"),
+        training_session_id=bindparam("training_session_id"),
+        starts_at=bindparam("starts_at"), ends_at=bindparam("ends_at"))
+
+
+def _class_schedule(conditions):
+    c = TrainingClass.__table__.alias("c")
+    return select(c, (c.c.capacity - c.c.booked).label("free")) \
+        .where(c.c.starts_at >= bindparam("since"), *conditions(c)).order_by(c.c.starts_at)
+
+
+@query_builder("class_schedule")
+def _all_class_schedule(dialect):
+    return _class_schedule(lambda c: [])
+
+
+@query_builder("open_class_schedule")
+def _open_class_schedule(dialect):
+    return _class_schedule(lambda c: [c.c.booked < c.c.capacity])
+
+
+@query_builder("class_bookings")
+def _class_bookings(dialect):
+    b, a = ClassBooking.__table__.alias("b"), Athlete.__table__.alias("a")
+    return select(b.c.id, b.c.athlete_id, a.c.fullname).select_from(b.join(a, a.c.id == b.c.athlete_id)) \
+        .where(b.c.class_id == bindparam("class_id")).order_by(a.c.fullname)
+
+
+# Change events
+
+@query_builder("record_change_event")
+def _record_change_event(dialect):
+    return insert(ChangeEvent.__table__).values(
+        created_at=bindparam("created_at"), kind=bindparam("kind"), payload=bindparam("payload"))
+
+
+@query_builder("change_events_after")
+def _change_events_after(dialect):
+    e = ChangeEvent.__table__
+    return select(e.c.id, e.c.created_at, e.c.kind, e.c.payload) \
+        .where(e.c.id > bindparam("after_id")).order_by(e.c.id).limit(bindparam("limit"))
+
+
+@query_builder("last_change_event_id")
+def _last_change_event_id(dialect):
+    e = ChangeEvent.__table__
+    return select(func.coalesce(func.max(e.c.id), 0))
+
+
+@query_builder("prune_change_events")
+def _prune_change_events(dialect):
+    e = ChangeEvent.__table__
+    return delete(e).where(e.c.id <= bindparam("last_id"))
+
+
+# Idempotency keys
+
+@query_builder("idempotency_key")
+def _idempotency_key(dialect):
+    k = IdempotencyKey.__table__
+    return select(k.c.fingerprint, k.c.created_at, k.c.status, k.c.location, k.c.content_type, k.c.body) \
+        .where(k.c.key == bindparam("idempotency_key"))
+
+
+@query_builder("claim_idempotency_key")
+def _claim_idempotency_key(dialect):
+    k = IdempotencyKey.__table__
+    return upsert(dialect, k).values(
+        key=bindparam("idempotency_key"), fingerprint=bindparam("fingerprint"), created_at=bindparam("claimed_at")
+    ).on_conflict_do_nothing(index_elements=[k.c.key])
+
+
+@query_builder("take_over_idempotency_key")
+def _take_over_idempotency_key(dialect):
+    k = IdempotencyKey.__table__
+    return update(k).where(
+        k.c.key == bindparam("idempotency_key"), k.c.status.is_(None), k.c.created_at < bindparam("stale_before")
+    ).values(created_at=bindparam("claimed_at"))
+
+
+@query_builder("store_idempotent_response")
+def _store_idempotent_response(dialect):
+    k = IdempotencyKey.__table__
+    return update(k).where(k.c.key == bindparam("idempotency_key")).values(
+        status=bindparam("response_status"), location=bindparam("response_location"),
+        content_type=bindparam("response_content_type"), body=bindparam("response_body"))
+
+
+@query_builder("release_idempotency_key")
+def _release_idempotency_key(dialect):
+    k = IdempotencyKey.__table__
+    return delete(k).where(k.c.key == bindparam("idempotency_key"), k.c.status.is_(None))
+
+
+@query_builder("prune_idempotency_keys")
+def _prune_idempotency_keys(dialect):
+    k = IdempotencyKey.__table__
+    newest = select(func.max(k.c.id)).scalar_subquery()
+    return delete(k).where((k.c.created_at < bindparam("expired_before")) | (k.c.id <= newest - bindparam("max_keys")))
+
+
+_statements = {}
+
+
+def get_statement(name, dialect, **sources):
+    """
+    Returns the statement of a registered query for a database dialect.
+
+    The statement is built from its builder in `QUERIES` the first time it is requested for a
+    dialect and a set of sources, and reused afterwards, so SQLAlchemy finds its compiled form in
+    the compiled cache and the database driver finds the prepared statement in its statement
+    cache. Every statement is tagged with its name in the "query" execution option, which labels
+    its timing in the metrics.
+
+    Parameters:
+        name (str): The name of the query in `QUERIES`.
+        dialect (str): The name of the database dialect, for example "sqlite" or "postgresql".
+        **sources: The session tables the query reads, by name, as returned by `sessions_table`,
+                   and the other arguments of its builder. They must be hashable.
+
+    Returns:
+        Executable: The statement.
+    """
+
+    key = (name, dialect, tuple(sorted(sources.items(), key=lambda item: item[0])))
+    statement = _statements.get(key)
+    if statement is None:
+        statement = QUERIES[name](dialect, **sources).execution_options(query=name)
+        statement = _statements.setdefault(key, statement)
+    return statement
+
+
+def run_query(conn, name, params=None, **sources):
+    """
+    Executes a registered query.
+
+    Parameters:
+        conn (Connection or Session): The connection or database session to execute the query with.
+        name (str): The name of the query in `QUERIES`.
+        params (dict, optional): The values of the bound parameters of the query.
+        **sources: The session tables the query reads, see `get_statement`.
+
+    Returns:
+        Result: The result of the query.
+    """
+
+    dialect = conn.dialect if hasattr(conn, "dialect") else conn.get_bind().dialect
+    return conn.execute(get_statement(name, dialect.name, **sources), params or {})
@@ -0,0 +1,409 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+from inspect import signature
+from flask import Flask
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from models import *
+from helpers import *
+from loadtest import seed_load_test_data
+from maintenance import maintain_database
+
+
+QUERY_PLAN_PAGES = [
+    "/dashboard",
+    "/list-athletes",
+    "/list-training-sessions",
+    "/list-private-coaching",
+    "/list-competitions",
+    "/list-classes",
+    "/analytics",
+    "/view-athlete/{athlete_id}?tab=profile",
+    "/view-athlete/{athlete_id}?tab=training-sessions",
+    "/view-athlete/{athlete_id}?tab=private-coaching",
+    "/view-athlete/{athlete_id}?tab=payments",
+    "/view-athlete/{athlete_id}?tab=competitions",
+    "/view-athlete/{athlete_id}?tab=weight",
+    "/view-athlete/{athlete_id}/weigh-ins.json",
+    "/view-competition/{competition_id}",
+    "/add-competition-participant/{competition_id}/{weight_category}",
+    "/api/v1/athletes?ids={athlete_id}",
+    "/api/v1/training-sessions?athlete_id={athlete_id}",
+    "/api/v1/payments?ids={athlete_id}"
+]
+
+# Tables that may be read in full. The lookup tables are tiny, and the list pages show every
+# athlete and competition on purpose.
+QUERY_PLAN_ALLOWED_SCANS = {
+    "*": {"training_plans", "weight_categories", "sqlite_master", "sqlite_schema"},
+    "/dashboard": {"athletes", "competitions", "training_sessions", "coaching_sessions"},
+    "/list-athletes": {"athletes"},
+    "/list-training-sessions": {"training_sessions", "athletes"},
+    "/list-private-coaching": {"coaching_sessions", "athletes"},
+    "/list-competitions": {"competitions", "competition_registrations"},
+    "/analytics": {"training_sessions", "coaching_sessions", "athletes"},
+    "/view-competition/{competition_id}": set(),
+    "/api/v1/athletes?ids={athlete_id}": set()
+}
+
+# The parameters every query of `QUERIES` is explained with by `check_registry_query_plans`, and
+# the tables it may read in full besides those allowed everywhere. Every query must have a case,
+# so a new query cannot escape the check. Builders that read a session table get the main table;
+# "sessions" names the table of the builders that read either of them, and "arguments" gives the
+# other arguments of the builder.
+_WEEK = {"week_start": "2024-09-02", "week_end": "2024-09-08"}
+_MONTH = {"first_id": 1, "last_id": 100, "period": "2024-09", "month_start": "2024-09-01", "month_end": "2024-09-30",
+          "weeks_end": "2024-10-06"}
+_API_PAGE = {"after": 0, "limit": 101}
+
+QUERY_PLAN_CASES = {
+    # Athletes
+    "list_athletes": {"scans": {"athletes"}},
+    "export_athletes": {"params": {"last_id": 0, "batch_size": 500}},
+    "invoice_batch_athlete_ids": {"params": {"last_athlete_id": 0, "last_id": 100, "batch_size": 50}},
+    "athlete_id_range": {},
+    "current_weight": {"params": {"athlete_id": 1}},
+    # Sessions
+    "training_sessions_per_athlete": {"scans": {"training_sessions", "athletes"}},
+    "coaching_sessions_per_athlete": {"scans": {"coaching_sessions", "athletes"}},
+    "training_sessions_per_week": {"params": {"athlete_id": 1}},
+    "coaching_sessions_per_week": {"params": {"athlete_id": 1}},
+    "count_athlete_sessions": {"sessions": "training_sessions",
+                               "params": {"athlete_id": 1, "start": "2024-09-02", "end": "2024-09-08"}},
+    "athlete_sessions": {"sessions": "coaching_sessions", "params": {"athlete_id": 1}},
+    "register_training_session": {"params": dict(_WEEK, athlete_id=1, date="2024-09-03")},
+    "register_coaching_session": {"params": dict(_WEEK, athlete_id=1, date="2024-09-03", tuition_fees=100)},
+    "delete_training_session": {"params": {"session_id": 1}},
+    "training_sessions_since": {"params": {"since": "2024-09-02"}},
+    "coaching_sessions_since": {"params": {"since": "2024-09-02"}},
+    # Archive
+    "archive_horizon": {"params": {"table_name": "training_sessions"}},
+    # Competitions
+    "list_competitions": {"scans": {"competitions", "competition_registrations"}},
+    "first_competition_id": {},
+    "competition": {"params": {"competition_id": 1}},
+    "competition_participants": {"params": {"competition_id": 1}},
+    "eligible_competition_athletes": {"params": {"weight_category": 1}, "scans": {"athletes"}},
+    "athlete_competitions": {"params": {"athlete_id": 1}},
+    "athlete_competition_fees": {"params": {"athlete_id": 1}},
+    # Dashboard
+    "dashboard_snapshot": {"scans": {"athletes", "competitions", "training_sessions", "coaching_sessions"}},
+    # Athlete summaries
+    "stale_athlete_summaries": {"params": _WEEK},
+    "rebuild_stale_athlete_summaries": {"params": _WEEK, "scans": {"athletes"}},
+    "rebuild_athlete_summary": {"params": dict(_WEEK, athlete_id=1)},
+    "update_athlete_summary": {"params": {"athlete": 1, "current_week": "2024-09-02", "training_delta": 1,
+                                          "coaching_delta": 0, "fees": 0, "training_weeks": 1}},
+    # Kiosks
+    "kiosk_athletes": {"params": {"week_start": "2024-09-02"}, "scans": {"athletes"}},
+    # Charge snapshots and invoices
+    "backfill_charge_snapshots": {"scans": {"training_sessions", "coaching_sessions", "competition_registrations",
+                                            "competitions"}},
+    "mark_charge_weeks_dirty": {"scans": {"training_sessions", "coaching_sessions", "competition_registrations",
+                                          "competitions"}},
+    "mark_charge_week_dirty": {"params": dict(_WEEK, athlete_id=1)},
+    "mark_athlete_charges_dirty": {"params": {"athlete": 1}},
+    "first_dirty_charge_week": {},
+    "first_dirty_athlete_charge_week": {"params": {"athlete": 1}},
+    "refresh_charge_snapshots": {},
+    "refresh_athlete_charge_snapshots": {"params": {"athlete": 1}},
+    "payments_summary": {"scans": {"charge_snapshots", "athletes"}},
+    "invoice_training_fees": {"params": _MONTH},
+    "invoice_coaching_fees": {"params": _MONTH},
+    "invoice_competition_fees": {"params": _MONTH},
+    # Weigh-ins
+    "backfill_weigh_ins": {"params": {"now": "2024-09-02 08:00:00"}, "scans": {"athletes"}},
+    "record_weigh_in": {"params": {"athlete_id": 1, "weighed_at": "2024-09-02 08:00:00", "new_weight": 70}},
+    "update_current_weight": {"params": {"athlete_id": 1, "weighed_at": "2024-09-02 08:00:00", "new_weight": 70}},
+    "weight_series": {"params": {"athlete_id": 1, "start": "2024-01-01 00:00:00", "end": "2024-12-31 23:59:59",
+                                 "points": 60}},
+    # JSON API
+    "api_athletes": {"arguments": {"fields": ("id", "fullname"), "filters": ("ids",), "paged": False},
+                     "params": {"ids": [1, 2, 3]}},
+    "api_training_sessions": {"arguments": {"fields": ("id", "date"), "filters": ("athlete_id", "after"), "paged": True},
+                              "params": dict(_API_PAGE, athlete_id=[1, 2])},
+    "api_coaching_sessions": {"arguments": {"fields": ("id", "date"), "filters": ("athlete_id", "after"), "paged": True},
+                              "params": dict(_API_PAGE, athlete_id=[1, 2])},
+    "api_competitions": {"arguments": {"fields": ("id", "participants"), "filters": ("after",), "paged": True},
+                         "params": _API_PAGE},
+    "api_payments": {"arguments": {"fields": ("athlete_id", "week_start"), "filters": ("ids",), "paged": False},
+                     "params": {"ids": [1, 2]}},
+    # Classes
+    "training_class": {"params": {"class_id": 1}},
+    "take_class_place": {"params": {"class_id": 1}},
+    "release_class_place": {"params": {"class_id": 1}},
+    "overlapping_class_booking": {"params": {"athlete_id": 1, "date": "2024-09-03", "starts_at": "18:00",
+                                             "ends_at": "19:00"}},
+    "latest_training_session_of_day": {"params": {"athlete_id": 1, "date": "2024-09-03"}},
+    "add_class_booking": {"params": {"class_id": 1, "athlete_id": 1, "training_session_id": 1, "starts_at": "18:00",
+                                     "ends_at": "19:00"}},
+    "class_schedule": {"params": {"since": "2024-09-02"}},
+    "open_class_schedule": {"params": {"since": "2024-09-02"}},
+    "class_bookings": {"params": {"class_id": 1}},
+    # Change events
+    "record_change_event": {"params": {"created_at": "2024-09-02 08:00:00", "kind": "athlete", "payload": "{}"}},
+    "change_events_after": {"params": {"after_id": 0, "limit": 100}},
+    "last_change_event_id": {},
+    "prune_change_events": {"params": {"last_id": 0}},
+    # Idempotency keys
+    "idempotency_key": {"params": {"idempotency_key": "key"}},
+    "claim_idempotency_key": {"params": {"idempotency_key": "key", "fingerprint": "", "claimed_at": "2024-09-02 08:00:00"}},
+    "take_over_idempotency_key": {"params": {"idempotency_key": "key", "stale_before": "2024-09-02 08:00:00",
+                                             "claimed_at": "2024-09-02 08:00:00"}},
+    "store_idempotent_response": {"params": {"idempotency_key": "key", "response_status": 302, "response_location": "/",
+                                             "response_content_type": "text/html", "response_body": b""}},
+    "release_idempotency_key": {"params": {"idempotency_key": "key"}},
+    "prune_idempotency_keys": {"params": {"expired_before": "2024-09-01 08:00:00", "max_keys": 10000}}
+}
+
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+TABLE_ALIAS = re.compile(r"\b(?:from|join)\s+(?:\w+\.)?(\w+)(?:\s+as)?\s+(\w+)", re.IGNORECASE)
+SUBQUERY_ALIAS = re.compile(r"\)\s+(?:as\s+)?(\w+)", re.IGNORECASE)
+
+
+def get_full_scans(conn, statement, parameters):
+    """
+    Finds the tables a statement reads in full, from its `EXPLAIN QUERY PLAN`.
+
+    A full scan is a "SCAN" step without an index. Scans of subqueries, views and constant rows,
+    and scans through an index, are not full scans of a table. SQLite names the tables of a plan
+    by their alias in the statement, so aliases are mapped back to table names.
+
+    Parameters:
+        conn (Connection): The connection to explain the statement with.
+        statement (str): The SQL statement, as sent to the database.
+        parameters (tuple or dict): The parameters the statement was run with.
+
+    Returns:
+        list: The names of the tables read in full, in the order of the plan.
+    """
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("explain query plan " + statement, parameters)
+        steps = [row[3] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+    aliases = {alias.lower(): table for table, alias in TABLE_ALIAS.findall(statement)}
+    subqueries = {alias.lower() for alias in SUBQUERY_ALIAS.findall(statement)}
+    tables = []
+    for step in steps:
+        match = FULL_SCAN.match(step)
+        if match and match.group(1) not in ("CONSTANT", "SUBQUERY") and match.group(1).lower() not in subqueries:
+            tables.append(aliases.get(match.group(1).lower(), match.group(1)))
+    return tables
+
+
+def capture_statements():
+    """
+    Starts recording the statements sent to the database by the current thread.
+
+    Returns:
+        tuple: The list the statements are recorded into, as (label, statement, parameters)
+               tuples, and a function that sets the label of the following statements and,
+               when called with None, stops the recording.
+    """
+
+    captured = []
+    state = threading.local()
+    state.label = None
+    thread = threading.get_ident()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread and state.label and not executemany:
+            captured.append((state.label, statement, parameters))
+
+    event.listen(Engine, "before_cursor_execute", record)
+
+    def set_label(label):
+        if label is None:
+            event.remove(Engine, "before_cursor_execute", record)
+        state.label = label
+
+    return captured, set_label
+
+
+def run_query_plan_check(app, branch=None):
+    """
+    Checks that the queries of the application do not read whole tables unexpectedly.
+
+    Every page of `QUERY_PLAN_PAGES` is requested once with the IDs of the first athlete and
+    competition of the database, and a training and a coaching check-in are made in a
+    transaction that is rolled back, so the database is not changed apart from the charge
+    snapshots the payments pages refresh. Every statement sent to the database is then explained
+    with `EXPLAIN QUERY PLAN` and its full table scans are compared with `QUERY_PLAN_ALLOWED_SCANS`.
+
+    Run it against a database seeded with `flask load-test-seed` and analyzed with
+    `flask db-maintain`, so the planner chooses the plans it would choose in production.
+    Only SQLite databases can be checked.
+
+    Parameters:
+        app (Flask): The application.
+        branch (str, optional): The branch whose database is checked.
+
+    Returns:
+        dict: A dictionary with the following keys:
+            - statements (int): The number of distinct statements explained.
+            - violations (list): One dictionary per unexpected full scan, with the "page" or
+                                 write that ran the statement, the "table" and the "statement".
+    """
+
+    with app.app_context():
+        g.branch = branch
+        if db.engine.dialect.name != "sqlite":
+            raise ValueError("Query plans can only be checked on SQLite databases.")
+        athlete_id = db.session.execute(text("select min(id) from athletes")).scalar()
+        competition = db.session.execute(text("""
+        select id, weight_category from competitions order by id limit 1
+        """)).first()
+        if athlete_id is None or competition is None:
+            raise ValueError("The database has no athletes or competitions. Seed it with `flask load-test-seed` first.")
+        session_dt = db.session.execute(text("""
+        select max(date) from training_sessions where athlete_id = :athlete_id
+        """), {"athlete_id": athlete_id}).scalar()
+        db.session.rollback()
+
+    ids = {"athlete_id": athlete_id, "competition_id": competition.id, "weight_category": competition.weight_category}
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["logged_in"] = True
+        session["user"] = "admin"
+        session["branch"] = branch
+
+    captured, set_label = capture_statements()
+    try:
+        for page in QUERY_PLAN_PAGES:
+            set_label(page)
+            response = client.get(page.format(**ids))
+            if response.status_code >= 400:
+                raise ValueError("%s returned %d" % (page.format(**ids), response.status_code))
+
+        with app.app_context():
+            g.branch = branch
+            for label, write in (("check_in_training_session", lambda: check_in_training_session(athlete_id, session_dt)),
+                                 ("check_in_coaching_session", lambda: check_in_coaching_session(athlete_id, session_dt, 0))):
+                set_label(label)
+                write()
+                set_label("rollback")
+                db.session.rollback()
+    finally:
+        set_label(None)
+
+    violations = []
+    explained = set()
+    with app.app_context():
+        g.branch = branch
+        with db.engine.connect() as conn:
+            for label, statement, parameters in captured:
+                verb = statement.lstrip().split(None, 1)[0].lower()
+                if verb not in ("select", "insert", "update", "delete", "with") or (label, statement) in explained:
+                    continue
+                explained.add((label, statement))
+
+                allowed = QUERY_PLAN_ALLOWED_SCANS["*"] | QUERY_PLAN_ALLOWED_SCANS.get(label, set())
+                for table in get_full_scans(conn, statement, parameters):
+                    if table not in allowed:
+                        violations.append({"page": label, "table": table, "statement": " ".join(statement.split())})
+            conn.rollback()
+
+    return {
+        "statements": len({statement for _, statement in explained}),
+        "violations": violations
+    }
+
+
+def explain_registry_query(conn, name, case):
+    """
+    Finds the tables a query of the registry reads in full, without running it.
+
+    The query is executed with the parameters of its case, but the statement sent to the database
+    is replaced by its `EXPLAIN QUERY PLAN`, so writes change nothing. The statement is recorded as
+    SQLAlchemy rendered it, lists of values included, and explained with `get_full_scans`.
+
+    Parameters:
+        conn (Connection): The connection to explain the query with.
+        name (str): The name of the query in `QUERIES`.
+        case (dict): The case of the query in `QUERY_PLAN_CASES`.
+
+    Returns:
+        list: The names of the tables read in full, in the order of the plan.
+    """
+
+    sources = dict(case.get("arguments", {}))
+    for table in ("training_sessions", "coaching_sessions"):
+        if table in signature(QUERIES[name]).parameters:
+            sources[table] = sessions_table(conn, table)
+    if "sessions" in case:
+        sources["sessions"] = sessions_table(conn, case["sessions"])
+
+    rendered = []
+
+    def explain_instead(conn, cursor, statement, parameters, context, executemany):
+        rendered.append((statement, parameters))
+        return "explain query plan " + statement, parameters
+
+    event.listen(conn, "before_cursor_execute", explain_instead, retval=True)
+    try:
+        run_query(conn, name, case.get("params"), **sources).close()
+    finally:
+        event.remove(conn, "before_cursor_execute", explain_instead)
+
+    return [table for statement, parameters in rendered for table in get_full_scans(conn, statement, parameters)]
+
+
+def check_registry_query_plans(athletes=500, weeks=12):
+    """
+    Checks that no query of the registry reads a whole table it is not allowed to read.
+
+    A throw-away SQLite database is seeded with `seed_load_test_data` and analyzed with
+    `maintain_database`, so the planner sees realistic tables. Every query of `QUERIES` is then
+    explained with the parameters of its case in `QUERY_PLAN_CASES` (see `explain_registry_query`)
+    and its full table scans are compared with the tables the case allows. A query without a
+    case, or a case without a query, fails the check too.
+
+    Parameters:
+        athletes (int): The number of athletes to seed.
+        weeks (int): The weeks of sessions to seed.
+
+    Returns:
+        int: The number of queries checked.
+
+    Raises:
+        AssertionError: With one line per failure.
+    """
+
+    folder = tempfile.mkdtemp(prefix="trainingtally-plans-")
+    app = Flask("query-plan-test", instance_path=folder)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(folder, "plans.db")
+    db.init_app(app)
+
+    failures = ["%s: no case in QUERY_PLAN_CASES" % name for name in QUERIES if name not in QUERY_PLAN_CASES]
+    failures += ["%s: case of a query that is not in QUERIES" % name for name in QUERY_PLAN_CASES if name not in QUERIES]
+    try:
+        with app.app_context():
+            seed_load_test_data(athletes, weeks)
+            maintain_database()
+
+            with db.engine.connect() as conn:
+                for name in QUERIES:
+                    if name not in QUERY_PLAN_CASES:
+                        continue
+                    case = QUERY_PLAN_CASES[name]
+                    allowed = QUERY_PLAN_ALLOWED_SCANS["*"] | case.get("scans", set())
+                    try:
+                        scans = explain_registry_query(conn, name, case)
+                    except Exception as e:
+                        failures.append("%s: cannot be explained: %s" % (name, str(e).splitlines()[0]))
+                        continue
+                    failures += ["%s: full scan of %s" % (name, table) for table in scans if table not in allowed]
+                conn.rollback()
+            db.engine.dispose()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    assert not failures, "\n".join(failures)
+    return len(QUERIES)
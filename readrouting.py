@@ -0,0 +1,141 @@
+import time
+from functools import wraps
+from flask import current_app, g, request, session
+from sqlalchemy.engine import make_url
+from models import *
+
+
+def get_read_uri(uri):
+    """
+    Returns the URI of a read-only connection to a SQLite database file.
+
+    The database is opened with the SQLite URI parameter `mode=ro`, so the connections of the
+    read pool can never write, even by mistake.
+
+    Parameters:
+        uri (str): The database URI used for writing.
+
+    Returns:
+        str or None: The read-only URI, or None if the database is not a SQLite file.
+    """
+
+    url = make_url(uri)
+    if not url.drivername.startswith("sqlite") or url.database in (None, "", ":memory:"):
+        return None
+    if url.query.get("uri"):
+        return url.update_query_dict({"mode": "ro"}).render_as_string(hide_password=False)
+
+    return url.set(database="file:" + url.database).update_query_dict(
+        {"mode": "ro", "uri": "true"}).render_as_string(hide_password=False)
+
+
+def configure_read_pools(app):
+    """
+    Registers a read-only connection pool next to the main database and every branch database.
+
+    The main database reads from `DB_READ_URI` when it is set, for example a replica. SQLite
+    databases without a configured replica get a `mode=ro` connection to the same file, see
+    `get_read_uri`. Server databases without a replica have no read pool and read from the writer.
+
+    The writer pools are kept small with `DB_WRITER_POOL_SIZE` and `DB_WRITER_MAX_OVERFLOW`,
+    and the read pools are sized with `DB_READER_POOL_SIZE` and `DB_READER_MAX_OVERFLOW`.
+
+    Must be called after `configure_branches` and before `db.init_app(app)`.
+
+    Parameters:
+        app (Flask): The Flask application.
+
+    Returns:
+        None
+    """
+
+    writer_options = {
+        "pool_size": app.config["DB_WRITER_POOL_SIZE"],
+        "max_overflow": app.config["DB_WRITER_MAX_OVERFLOW"]
+    }
+    engine_options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    for name, value in writer_options.items():
+        engine_options.setdefault(name, value)
+
+    binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+    databases = {None: app.config.get("DB_READ_URI") or get_read_uri(app.config["SQLALCHEMY_DATABASE_URI"])}
+    for bind_key, uri in list(binds.items()):
+        if bind_key.startswith(BRANCH_BIND_PREFIX):
+            binds[bind_key] = dict(writer_options, url=uri)
+            databases[bind_key] = get_read_uri(uri)
+
+    if not app.config["DB_READ_ROUTING"]:
+        return
+
+    for bind_key, read_uri in databases.items():
+        if read_uri:
+            binds[read_bind_key(bind_key)] = {
+                "url": read_uri,
+                "pool_size": app.config["DB_READER_POOL_SIZE"],
+                "max_overflow": app.config["DB_READER_MAX_OVERFLOW"]
+            }
+
+
+def read_from_writer(f):
+    """
+    A decorator that makes a GET route read from the writer pools.
+
+    Use it for pages that must see writes which may not have reached a replica yet.
+
+    Parameters:
+        f (callable): The route function.
+
+    Returns:
+        callable: The route function, marked to read from the writer.
+    """
+
+    f.read_from_writer = True
+    return f
+
+
+def read_your_writes(f):
+    """
+    A decorator that makes the pages following a write read the data that was just written.
+
+    After a non-GET request to the route, the reads of the same user go to the writer pools for
+    `READ_YOUR_WRITES_SECONDS`, so a redirect to the updated record never shows the old values
+    from a replica that is behind.
+
+    Parameters:
+        f (callable): The route function.
+
+    Returns:
+        callable: The decorated route function.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        response = f(*args, **kwargs)
+        if request.method not in ("GET", "HEAD"):
+            session["read_from_writer_until"] = time.time() + current_app.config["READ_YOUR_WRITES_SECONDS"]
+        return response
+    return decorated_function
+
+
+def select_database_role():
+    """
+    Chooses whether the current request reads from the read-only pools or from the writer.
+
+    GET and HEAD requests read from the read-only pools, unless the route is marked with
+    `read_from_writer` or the user wrote something moments ago (see `read_your_writes`).
+    All other requests use the writer. Meant to be registered as a before_request hook.
+
+    Recent writes only pin the reads of the main database to the writer when it reads from a
+    replica (`DB_READ_URI`). The read-only pools of SQLite files read the same file as the
+    writer and always see committed writes, so pinning them would only crowd the small writer pools.
+
+    Returns:
+        None
+    """
+
+    view = current_app.view_functions.get(request.endpoint)
+    replica = current_app.config.get("DB_READ_URI") and not g.get("branch")
+    pinned = getattr(view, "read_from_writer", False) or \
+        (replica and session.get("read_from_writer_until", 0) > time.time())
+
+    g.db_role = "read" if request.method in ("GET", "HEAD") and not pinned else "write"
@@ -0,0 +1,173 @@
+from datetime import datetime
+from models import *
+from helpers import *
+
+
+BOOKING_ERRORS = {
+    "not-found": "The class does not exist.",
+    "full": "The class is fully booked.",
+    "already-booked": "The athlete is already booked into this class.",
+    "overlap": "The athlete is booked into another class at the same time.",
+    "limit": "Athlete has reached the maximum number of sessions for the week."
+}
+
+
+def add_class(name, date, start_time, end_time, capacity):
+    """
+    Schedules a new class.
+
+    The caller commits the transaction.
+
+    Parameters:
+        name (str): The name of the class.
+        date (str): The date of the class in the format "YYYY-MM-DD".
+        start_time (str): The start time in the format "HH:MM".
+        end_time (str): The end time in the format "HH:MM", later than the start time.
+        capacity (int): The maximum number of athletes, at least 1.
+
+    Returns:
+        TrainingClass: The new class.
+    """
+
+    datetime.strptime(date, "%Y-%m-%d")
+    if datetime.strptime(end_time, "%H:%M") <= datetime.strptime(start_time, "%H:%M"):
+        raise ValueError("A class must end after it starts.")
+    if int(capacity) < 1:
+        raise ValueError("A class must have at least one place.")
+
+    ensure_tables(TrainingClass, ClassBooking, conn=db.session.connection())
+    training_class = TrainingClass(
+        name=name,
+        date=date,
+        starts_at="%s %s" % (date, start_time),
+        ends_at="%s %s" % (date, end_time),
+        capacity=int(capacity),
+        booked=0
+    )
+    db.session.add(training_class)
+    return training_class
+
+
+def book_class(athlete_id, class_id):
+    """
+    Books an athlete into a class.
+
+    A place is taken with a conditional update of the class's booked counter, so concurrent
+    bookings can never exceed the capacity. Then the athlete's bookings of the same day are
+    checked for an overlap through the (athlete_id, starts_at) index, and a training session is
+    added for the day of the class with `register_training_session`, which enforces the weekly
+    limit of the athlete's plan.
+
+    The caller commits the transaction when the booking succeeds and must roll it back otherwise,
+    to give the place back.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+        class_id (int): The ID of the class.
+
+    Returns:
+        str: "booked" on success, otherwise the reason the booking failed: "not-found", "full",
+             "already-booked", "overlap" or "limit". See `BOOKING_ERRORS`.
+    """
+
+    ensure_tables(TrainingClass, ClassBooking, conn=db.session.connection())
+    lock_athlete(athlete_id)
+
+    training_class = run_query(db.session, "training_class", {"class_id": class_id}).one_or_none()
+    if training_class is None:
+        return "not-found"
+
+    taken = run_query(db.session, "take_class_place", {"class_id": class_id}).rowcount
+    if not taken:
+        return "full"
+
+    overlap = run_query(db.session, "overlapping_class_booking", {
+        "athlete_id": athlete_id,
+        "date": training_class.date,
+        "starts_at": training_class.starts_at,
+        "ends_at": training_class.ends_at
+    }).first()
+    if overlap is not None:
+        return "already-booked" if overlap.class_id == training_class.id else "overlap"
+
+    if not register_training_session(athlete_id, training_class.date):
+        return "limit"
+
+    training_session_id = run_query(db.session, "latest_training_session_of_day",
+                                    {"athlete_id": athlete_id, "date": training_class.date}).scalar()
+
+    run_query(db.session, "add_class_booking", {
+        "class_id": training_class.id,
+        "athlete_id": athlete_id,
+        "training_session_id": training_session_id,
+        "starts_at": training_class.starts_at,
+        "ends_at": training_class.ends_at
+    })
+
+    mark_charge_week_dirty(athlete_id, training_class.date)
+    update_athlete_summary(athlete_id, training_class.date, training_sessions=1)
+    record_change_event("training_session", {"training_sessions": 1}, athlete_id=athlete_id, date=training_class.date)
+    return "booked"
+
+
+def cancel_booking(booking_id):
+    """
+    Cancels a class booking, giving the place back and removing its training session.
+
+    The caller commits the transaction.
+
+    Parameters:
+        booking_id (int): The ID of the booking.
+
+    Returns:
+        int or None: The ID of the class of the booking, or None if the booking does not exist.
+    """
+
+    ensure_tables(TrainingClass, ClassBooking, conn=db.session.connection())
+    booking = db.session.get(ClassBooking, booking_id)
+    if booking is None:
+        return None
+
+    class_id, athlete_id, date = booking.class_id, booking.athlete_id, booking.starts_at[:10]
+    run_query(db.session, "delete_training_session", {"session_id": booking.training_session_id})
+    run_query(db.session, "release_class_place", {"class_id": class_id})
+    db.session.delete(booking)
+    mark_charge_week_dirty(athlete_id, date)
+    update_athlete_summary(athlete_id, date, training_sessions=-1)
+    record_change_event("training_session", {"training_sessions": -1}, athlete_id=athlete_id, date=date)
+    return class_id
+
+
+def get_class_schedule(since=None, open_only=False):
+    """
+    Retrieves the classes starting on or after a date.
+
+    Parameters:
+        since (str, optional): The first date in the format "YYYY-MM-DD". Defaults to today.
+        open_only (bool): Only return classes with free places, read through the partial index on open classes.
+
+    Returns:
+        list: The classes ordered by start time, as rows with the columns of the classes table
+              plus "free", the number of free places.
+    """
+
+    ensure_tables(TrainingClass, ClassBooking)
+    with db.read_engine.connect() as conn:
+        return run_query(conn, "open_class_schedule" if open_only else "class_schedule",
+                         {"since": since or datetime.now().strftime("%Y-%m-%d")}).fetchall()
+
+
+def get_class_bookings(class_id):
+    """
+    Retrieves the athletes booked into a class.
+
+    Parameters:
+        class_id (int): The ID of the class.
+
+    Returns:
+        list: The bookings as rows with the booking ID, athlete ID and athlete name, ordered by name.
+    """
+
+    ensure_tables(TrainingClass, ClassBooking)
+    with db.read_engine.connect() as conn:
+        return run_query(conn, "class_bookings", {"class_id": class_id}).fetchall()
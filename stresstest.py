@@ -0,0 +1,315 @@
+import bisect
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask
+from sqlalchemy.exc import OperationalError
+from models import *
+from helpers import *
+from groupcommit import *
+from scheduling import *
+
+
+def init_stress_test_database(app, folder, database_uri=None, timeout=30, **engine_options):
+    """
+    Points the application of a stress test at its throw-away database and empties it.
+
+    Without `database_uri`, a new SQLite database is created in `folder`. With it, the tables of
+    that database are dropped first, so it must be a scratch database, for example a PostgreSQL
+    database created for the benchmark; comparing both shows the throughput of each backend
+    under the same concurrent writes.
+
+    Parameters:
+        app (Flask): The application of the stress test.
+        folder (str): The temporary folder of the stress test.
+        database_uri (str, optional): The URI of a scratch database. Defaults to SQLite in `folder`.
+        timeout (int): How long a SQLite connection waits for the write lock, in seconds.
+        **engine_options: Other options of the engine, such as the size of the pool.
+
+    Returns:
+        str: The name of the database dialect, for example "sqlite" or "postgresql".
+    """
+
+    if database_uri is None:
+        database_uri = "sqlite:///" + os.path.join(folder, "stress.db")
+        engine_options["connect_args"] = {"timeout": timeout}
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
+    db.init_app(app)
+
+    with app.app_context():
+        db.metadata.drop_all(bind=db.engine)
+        return db.engine.dialect.name
+
+
+def get_latency_stats(timings):
+    """
+    Summarizes the latencies of a list of timed operations.
+
+    Parameters:
+        timings (list): The (started, finished) times of the operations, from `time.perf_counter`.
+
+    Returns:
+        dict: The median and the longest latency under "median_ms" and "max_ms".
+    """
+
+    latencies = sorted((finished - started) * 1000 for started, finished in timings)
+    if not latencies:
+        return {"median_ms": 0.0, "max_ms": 0.0}
+    return {"median_ms": latencies[len(latencies) // 2], "max_ms": latencies[-1]}
+
+
+def count_overlapping(timings, busy):
+    """
+    Counts the operations that finished while at least one other operation was in progress.
+
+    Parameters:
+        timings (list): The (started, finished) times of the operations to count.
+        busy (list): The (started, finished) times of the operations in progress.
+
+    Returns:
+        int: The number of operations of `timings` that finished within one of the `busy` intervals.
+    """
+
+    merged = []
+    for started, finished in sorted(busy):
+        if merged and started <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], finished)
+        else:
+            merged.append([started, finished])
+
+    starts = [started for started, _ in merged]
+    count = 0
+    for _, finished in timings:
+        i = bisect.bisect_right(starts, finished) - 1
+        if i >= 0 and finished <= merged[i][1]:
+            count += 1
+    return count
+
+
+def run_quota_stress_test(threads=16, attempts=20, session_dt="2024-09-02", group_commit=False, database_uri=None):
+    """
+    Checks that the weekly training limit holds when many workers check in the same athlete at once.
+
+    A throw-away database is created with one "hammered" athlete on the beginner plan and one
+    athlete per thread on the elite plan. All threads start together; every attempt checks in the
+    hammered athlete and then the thread's own athlete for the same week, each in its own
+    transaction, exactly as `log_training_session` does. With `group_commit`, the check-ins go
+    through the group committer instead and share transactions.
+
+    The limit holds if the hammered athlete ends up with exactly the plan's weekly number of
+    sessions. The other athletes must all reach their own limit too, which shows that check-ins
+    for unrelated athletes were not turned away while the hammered athlete was contended.
+
+    Every check-in is timed. The check-ins of the other athletes that completed while a check-in
+    of the hammered athlete was still in progress are counted: with more than one thread, the test
+    only passes if there are some, so the other athletes were not queued behind the hammered one.
+
+    Parameters:
+        threads (int): The number of concurrent workers.
+        attempts (int): The number of check-in attempts per worker.
+        session_dt (str): The date of the sessions in the format "YYYY-MM-DD".
+        group_commit (bool): Commit the check-ins through the group committer.
+        database_uri (str, optional): The URI of a scratch database to run against, see
+                                      `init_stress_test_database`. Defaults to a new SQLite database.
+
+    Returns:
+        dict: A dictionary with the following keys:
+            - passed (bool): Whether the limit held for every athlete.
+            - dialect (str): The database the test ran against, for example "sqlite".
+            - limit (int): The weekly limit of the hammered athlete.
+            - hammered_sessions (int): The sessions stored for the hammered athlete.
+            - other_sessions (list): The sessions stored for each of the other athletes.
+            - other_limit (int): The weekly limit of the other athletes.
+            - errors (int): The check-ins that failed with a database error, such as a lock timeout.
+            - seconds (float): How long the check-ins took.
+            - check_ins_per_second (float): The accepted and rejected check-ins per second.
+            - commits (int): The number of commits of the check-ins.
+            - commits_per_second (float): The number of commits per second.
+            - hammered_latency (dict): The median and longest check-in of the hammered athlete,
+                                       see `get_latency_stats`.
+            - other_latency (dict): The median and longest check-in of the other athletes.
+            - overlapping (int): The check-ins of the other athletes that completed while a check-in
+                                 of the hammered athlete was in progress.
+    """
+
+    folder = tempfile.mkdtemp(prefix="trainingtally-stress-")
+    app = Flask("quota-stress-test", instance_path=folder)
+    app.config["GROUP_COMMIT"] = group_commit
+    app.config["GROUP_COMMIT_MAX_BATCH"] = threads * 2
+    app.config["GROUP_COMMIT_MAX_DELAY_MS"] = 5
+    app.config["GROUP_COMMIT_TIMEOUT_SECONDS"] = 30
+    dialect = init_stress_test_database(app, folder, database_uri)
+
+    with app.app_context():
+        create_database_schema()
+        beginner = TrainingPlan.query.filter_by(name="beginner").first()
+        elite = TrainingPlan.query.filter_by(name="elite").first()
+
+        hammered = Athlete(fullname="Hammered", gender="Male", age=20, weight=70, training_plan=beginner.id)
+        others = [Athlete(fullname="Athlete %d" % n, gender="Male", age=20, weight=70, training_plan=elite.id)
+                  for n in range(threads)]
+        db.session.add_all([hammered] + others)
+        db.session.commit()
+
+        hammered_id = hammered.id
+        other_ids = [athlete.id for athlete in others]
+        limit, other_limit = beginner.num_of_sessions, elite.num_of_sessions
+
+    barrier = threading.Barrier(threads)
+    errors = []
+    commits = []
+    timings = {"hammered": [], "others": []}
+
+    def check_in(athlete_id):
+        started = time.perf_counter()
+        try:
+            commit_write(check_in_training_session, athlete_id, session_dt)
+            commits.append(athlete_id)
+        except OperationalError:
+            db.session.rollback()
+            errors.append(athlete_id)
+        timings["hammered" if athlete_id == hammered_id else "others"].append((started, time.perf_counter()))
+
+    def worker(n):
+        with app.app_context():
+            barrier.wait()
+            for _ in range(attempts):
+                check_in(hammered_id)
+                check_in(other_ids[n])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(worker, range(threads)))
+    seconds = time.perf_counter() - started
+
+    with app.app_context():
+        hammered_sessions = TrainingSession.query.filter_by(athlete_id=hammered_id).count()
+        other_sessions = [TrainingSession.query.filter_by(athlete_id=athlete_id).count()
+                          for athlete_id in other_ids]
+        if group_commit:
+            commits = get_group_commit_stats()["main"]["commits"]
+        else:
+            commits = len(commits)
+        for engine in db.engines.values():
+            engine.dispose()
+    shutil.rmtree(folder, ignore_errors=True)
+
+    overlapping = count_overlapping(timings["others"], timings["hammered"])
+    return {
+        "passed": (hammered_sessions == limit and all(count == other_limit for count in other_sessions)
+                   and (overlapping > 0 or threads == 1)),
+        "dialect": dialect,
+        "limit": limit,
+        "hammered_sessions": hammered_sessions,
+        "other_sessions": other_sessions,
+        "other_limit": other_limit,
+        "errors": len(errors),
+        "seconds": seconds,
+        "check_ins_per_second": threads * attempts * 2 / seconds if seconds else 0,
+        "commits": commits,
+        "commits_per_second": commits / seconds if seconds else 0,
+        "hammered_latency": get_latency_stats(timings["hammered"]),
+        "other_latency": get_latency_stats(timings["others"]),
+        "overlapping": overlapping
+    }
+
+
+def run_booking_stress_test(threads=200, capacity=20, class_dt="2024-09-02", database_uri=None):
+    """
+    Checks that a class is never overbooked when many athletes book its last places at once.
+
+    A throw-away database is created with one class of `capacity` places and one athlete per
+    thread on the elite plan. All threads start together and each books its athlete into the
+    class, in its own transaction, exactly as `book_training_class` does.
+
+    The capacity holds if exactly `capacity` bookings were accepted, the booked counter of the
+    class equals the number of stored bookings, and every booking has its training session.
+
+    Parameters:
+        threads (int): The number of concurrent bookings.
+        capacity (int): The number of places in the class.
+        class_dt (str): The date of the class in the format "YYYY-MM-DD".
+        database_uri (str, optional): The URI of a scratch database to run against, see
+                                      `init_stress_test_database`. Defaults to a new SQLite database.
+                                      A database server must accept `threads` connections.
+
+    Returns:
+        dict: A dictionary with the following keys:
+            - passed (bool): Whether the capacity held.
+            - dialect (str): The database the test ran against, for example "sqlite".
+            - capacity (int): The number of places in the class.
+            - booked (int): The booked counter of the class.
+            - bookings (int): The number of stored bookings.
+            - training_sessions (int): The number of stored training sessions.
+            - results (dict): The number of booking attempts per result, such as "booked" and "full".
+            - errors (int): The bookings that failed with a database error, such as a lock timeout.
+            - seconds (float): How long the bookings took.
+            - bookings_per_second (float): The accepted and rejected bookings per second.
+    """
+
+    folder = tempfile.mkdtemp(prefix="trainingtally-stress-")
+    app = Flask("booking-stress-test", instance_path=folder)
+    dialect = init_stress_test_database(app, folder, database_uri, timeout=60, pool_size=threads, max_overflow=0)
+
+    with app.app_context():
+        create_database_schema()
+        elite = TrainingPlan.query.filter_by(name="elite").first()
+
+        athletes = [Athlete(fullname="Athlete %d" % n, gender="Male", age=20, weight=70, training_plan=elite.id)
+                    for n in range(threads)]
+        db.session.add_all(athletes)
+        training_class = add_class("Stress test", class_dt, "18:00", "19:00", capacity)
+        db.session.commit()
+
+        athlete_ids = [athlete.id for athlete in athletes]
+        class_id = training_class.id
+
+    barrier = threading.Barrier(threads)
+    lock = threading.Lock()
+    results = {}
+    errors = []
+
+    def worker(athlete_id):
+        with app.app_context():
+            barrier.wait()
+            try:
+                result = book_class(athlete_id, class_id)
+                if result == "booked":
+                    db.session.commit()
+                else:
+                    db.session.rollback()
+                with lock:
+                    results[result] = results.get(result, 0) + 1
+            except OperationalError:
+                db.session.rollback()
+                errors.append(athlete_id)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(worker, athlete_ids))
+    seconds = time.perf_counter() - started
+
+    with app.app_context():
+        booked = db.session.get(TrainingClass, class_id).booked
+        bookings = ClassBooking.query.filter_by(class_id=class_id).count()
+        training_sessions = TrainingSession.query.filter_by(date=class_dt).count()
+        for engine in db.engines.values():
+            engine.dispose()
+    shutil.rmtree(folder, ignore_errors=True)
+
+    return {
+        "passed": booked == bookings == training_sessions == results.get("booked", 0) == min(capacity, threads),
+        "dialect": dialect,
+        "capacity": capacity,
+        "booked": booked,
+        "bookings": bookings,
+        "training_sessions": training_sessions,
+        "results": results,
+        "errors": len(errors),
+        "seconds": seconds,
+        "bookings_per_second": threads / seconds if seconds else 0
+    }
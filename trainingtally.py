@@ -2,26 +2,102 @@
 # -*- coding: utf-8 -*-
 
 import os
-from datetime import datetime
+import socket
+import time
+import click
+from datetime import datetime, timedelta
 from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, session
-from sqlalchemy import text
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_file, send_from_directory, abort, g, Response
 from models import *
 from helpers import *
+from branches import *
+from jobs import *
+from invoices import *
+from analytics import *
+from archive import *
+from stresstest import *
+from groupcommit import *
+from metrics import *
+from profiling import *
+from readrouting import *
+from weighins import *
+from api import *
+from scheduling import *
+from events import *
+from loadtest import *
+from maintenance import *
+from queryplans import *
+from compression import *
+from kiosk import *
+from backup import *
+from idempotency import *
 
 
 app = Flask(__name__)
 app.secret_key = '97e55e1619aefaa8128ce991145ab3aa'
-app.config["SQLALCHEMY_DATABASE_URI"] = (
-    "sqlite:///database.db"
-)
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("TRAININGTALLY_DATABASE_URI", "sqlite:///database.db")
+app.config["SQLALCHEMY_BINDS"] = {
+    "jobs": "sqlite:///jobs.db"
+}
+app.config["ARCHIVE_HORIZON_DAYS"] = 365
+app.config["JOB_TIMEOUT_SECONDS"] = 3600
+app.config["GROUP_COMMIT"] = os.environ.get("TRAININGTALLY_GROUP_COMMIT") == "1"
+app.config["GROUP_COMMIT_MAX_BATCH"] = int(os.environ.get("TRAININGTALLY_GROUP_COMMIT_MAX_BATCH", 32))
+app.config["GROUP_COMMIT_MAX_DELAY_MS"] = float(os.environ.get("TRAININGTALLY_GROUP_COMMIT_MAX_DELAY_MS", 5))
+app.config["GROUP_COMMIT_TIMEOUT_SECONDS"] = 30
+app.config["METRICS_TOKEN"] = os.environ.get("TRAININGTALLY_METRICS_TOKEN")
+app.config["METRICS_FLUSH_SECONDS"] = 5.0
+app.config["PROFILE_RETENTION"] = 50
+app.config["DB_READ_ROUTING"] = os.environ.get("TRAININGTALLY_READ_ROUTING", "1") == "1"
+app.config["DB_READ_URI"] = os.environ.get("TRAININGTALLY_READ_URI")
+app.config["DB_WRITER_POOL_SIZE"] = 2
+app.config["DB_WRITER_MAX_OVERFLOW"] = 3
+app.config["DB_READER_POOL_SIZE"] = 10
+app.config["DB_READER_MAX_OVERFLOW"] = 10
+app.config["READ_YOUR_WRITES_SECONDS"] = 5
+app.config["API_TOKEN"] = os.environ.get("TRAININGTALLY_API_TOKEN")
+app.config["CHANGE_EVENTS_POLL_SECONDS"] = 0.5
+app.config["CHANGE_EVENTS_BUFFER"] = 1000
+app.config["CHANGE_EVENTS_RETENTION"] = 10000
+app.config["CHANGE_EVENTS_KEEP_ALIVE_SECONDS"] = 15
+app.config["CHANGE_EVENTS_STREAM_SECONDS"] = 300
+app.config["CHANGE_EVENTS_GAP_SECONDS"] = 10
+app.config["COMPRESSION"] = os.environ.get("TRAININGTALLY_COMPRESSION", "1") == "1"
+app.config["COMPRESSION_MIN_SIZE"] = int(os.environ.get("TRAININGTALLY_COMPRESSION_MIN_SIZE", 1024))
+app.config["COMPRESSION_GZIP_LEVEL"] = int(os.environ.get("TRAININGTALLY_COMPRESSION_GZIP_LEVEL", 6))
+app.config["COMPRESSION_BROTLI_LEVEL"] = int(os.environ.get("TRAININGTALLY_COMPRESSION_BROTLI_LEVEL", 4))
+app.config["KIOSK_CENTRAL_URL"] = os.environ.get("TRAININGTALLY_KIOSK_URL")
+app.config["KIOSK_TOKEN"] = os.environ.get("TRAININGTALLY_KIOSK_TOKEN")
+app.config["KIOSK_NAME"] = os.environ.get("TRAININGTALLY_KIOSK_NAME", socket.gethostname())
+app.config["KIOSK_DATABASE"] = os.environ.get("TRAININGTALLY_KIOSK_DATABASE")
+app.config["KIOSK_SYNC_SECONDS"] = 10
+app.config["KIOSK_SYNC_BATCH"] = 100
+app.config["KIOSK_TIMEOUT_SECONDS"] = 5
+app.config["BACKUP_FOLDER"] = os.environ.get("TRAININGTALLY_BACKUP_FOLDER")
+app.config["BACKUP_PAGES_PER_STEP"] = 100
+app.config["BACKUP_STEP_SLEEP_MS"] = 10
+app.config["BACKUP_FULL_EVERY"] = 7
+app.config["BACKUP_KEEP"] = 4
+app.config["IDEMPOTENCY_KEY_SECONDS"] = 24 * 60 * 60
+app.config["IDEMPOTENCY_MAX_KEYS"] = 10000
+app.config["IDEMPOTENCY_PENDING_SECONDS"] = 30
+configure_branches(app, os.environ.get("TRAININGTALLY_BRANCHES"))
+configure_read_pools(app)
 db.init_app(app)
+init_compression(app)
+init_metrics(app, db)
+app.before_request(select_branch)
+app.before_request(select_database_role)
+app.jinja_env.globals["new_idempotency_key"] = new_idempotency_key
 
 
 def login_required(f):
     """
     A decorator function that checks if a user is logged in before allowing access to a route.
 
+    When the administrator adds `profile=1` to the query string or sends the `X-Profile: 1` header,
+    the route runs under the profiler and its profile is stored (see `profile_request`).
+
     Parameters:
     - f: The function to be decorated
 
@@ -37,6 +113,28 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
         if not session.get("logged_in"):
             return redirect(url_for("login"))
+        if is_profiling_requested():
+            return profile_request(f, *args, **kwargs)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def admin_required(f):
+    """
+    A decorator function that only allows the administrator to access a route.
+
+    Must be applied after `login_required`.
+
+    Parameters:
+    - f: The function to be decorated
+
+    Returns:
+    - decorated_function: The decorated function that returns a 403 error to users other than the administrator.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get("user") != "admin":
+            abort(403)
         return f(*args, **kwargs)
     return decorated_function
 
@@ -46,20 +144,24 @@ def create_database():
     """
     Creates a database if it does not already exist.
 
-    If the database file "./instance/database.db" exists, it prints a message indicating that the database already exists 
+    If the database already has its tables, it prints a message indicating that the database already exists 
     and advises the user to contact the administrator to reset the database. 
-    Otherwise, it creates the database schema using the `create_database_schema` function from the `helpers` module.
+    Otherwise, it creates the database schema using the `create_database_schema` function from the `helpers` module,
+    in the main database and in the database of every configured branch that does not have it yet. The branch
+    selected for the logged-in user is ignored, so the check and the creation always use the main database.
 
     Returns:
         A rendered template indicating whether the database was created or not. 
         If the database already exists, the template will have the `dbexist` parameter set to `True`, otherwise it will be set to `False`.
     """
 
-    if os.path.exists("./instance/database.db"):
+    g.pop("branch", None)
+    if inspect(db.engine).has_table(Athlete.__tablename__):
         print('Database already exists. Contact your administrator to reset the database.')
         return render_template("dbcreated.html", dbexist=True)
 
     create_database_schema()
+    run_on_branches(create_missing_database_schema)
     return render_template("dbcreated.html", dbexist=False)
 
 
@@ -84,6 +186,8 @@ def login():
     If the request method is POST, it retrieves the username and password from the form data.
     If the username is "admin" and the password is "admin", it sets the session variables
     "logged_in" to True, "user" to the username, and "fullname" to "Gym Administrator".
+    When branches are configured, the branch selected on the login form is stored in the session
+    and used for all following requests.
     Finally, it redirects the user to the dashboard route.
     If the request method is not POST, it renders the login.html template.
 
@@ -99,9 +203,10 @@ def login():
             session["logged_in"] = True
             session["user"] = username
             session["fullname"] = "Gym Administrator"
+            session["branch"] = request.form.get("branch")
         return redirect(url_for("dashboard"))
 
-    return render_template("login.html")
+    return render_template("login.html", branches=get_branches())
 
 
 @app.route("/logout")
@@ -130,22 +235,62 @@ def dashboard():
         The rendered template for the dashboard page.
     """
 
-    athletes = Athlete.query.count()
-    competitions = Competition.query.count()
-    training_sessions = TrainingSession.query.count()
-    coaching_sessions = CoachingSession.query.count()
-
-    data = {
-        "athletes": athletes,
-        "competitions": competitions,
-        "training_sessions": training_sessions,
-        "coaching_sessions": coaching_sessions
-    }
+    data = get_dashboard_snapshot()
     return render_template("dashboard.html", data=data, pageIs='dashboard')
 
 
+@app.route("/dashboard/events")
+@login_required
+def dashboard_events():
+    """
+    Route handler for the live updates of the dashboard, as a Server-Sent Events stream.
+
+    Sends every change event written after the position given by the `Last-Event-ID` header of a
+    reconnecting browser, or by the `after` query parameter of a new connection. All open
+    dashboards of a branch share one tail of the change-event outbox, see `ChangeEventTail`.
+
+    Returns:
+        Response: The event stream.
+    """
+
+    after_id = request.headers.get("Last-Event-ID", type=int)
+    if after_id is None:
+        after_id = request.args.get("after", 0, type=int)
+
+    stream = stream_change_events(
+        get_change_event_tail(),
+        after_id,
+        keep_alive=app.config["CHANGE_EVENTS_KEEP_ALIVE_SECONDS"],
+        duration=app.config["CHANGE_EVENTS_STREAM_SECONDS"]
+    )
+    return Response(stream, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/hq-dashboard")
+@login_required
+def hq_dashboard():
+    """
+    Route handler for the HQ dashboard page.
+
+    Collects the dashboard counts, payments and competitions of every branch in parallel
+    and renders them per branch together with the totals over all branches.
+
+    Returns:
+        The rendered template for the HQ dashboard page, or a redirect to the dashboard
+        when no branches are configured.
+    """
+
+    if not get_branches():
+        return redirect(url_for("dashboard"))
+
+    summary = get_hq_summary()
+    return render_template("hq-dashboard.html", pageIs='hq', summary=summary)
+
+
 @app.route("/add-athlete", methods=["GET", "POST"])
 @login_required
+@read_your_writes
 def add_athlete():
     """
     Handles the addition of a new athlete to the database.
@@ -182,6 +327,10 @@ def add_athlete():
         training_plan=training_plan
     )
     db.session.add(athlete)
+    db.session.flush()
+    record_weigh_in(athlete.id, weight)
+    rebuild_athlete_summary(athlete.id)
+    record_change_event("athlete", {"athletes": 1}, athlete_id=athlete.id, fullname=fullname)
     db.session.commit()
 
     return redirect(url_for("list_athletes"))
@@ -189,6 +338,7 @@ def add_athlete():
 
 @app.route("/update-athlete", methods=["POST"])
 @login_required
+@read_your_writes
 def update_athlete():
     """
     Update the details of an athlete in the database.
@@ -199,6 +349,7 @@ def update_athlete():
     - gender (str): The gender of the athlete.
     - age (int): The age of the athlete.
     - weight (float): The weight of the athlete.
+    - training_plan (int, optional): The ID of the new training plan of the athlete.
 
     Returns:
     - redirect: Redirects to the view_athlete route with the updated athlete's ID.
@@ -211,12 +362,24 @@ def update_athlete():
     age = int(request.form["age"])
     weight = float(request.form["weight"])
 
-    # Update athlete details
+    training_plan = int(request.form.get("training_plan", 0))
+
+    # Update athlete details. A new weight is appended to the weigh-in history,
+    # which also updates the current weight of the athlete. A new training plan
+    # reprices the training fees in the athlete's roster summary.
     athlete = Athlete.query.filter_by(id=athlete_id).first()
     athlete.fullname = fullname
     athlete.gender = gender
     athlete.age = age
-    athlete.weight = weight
+    plan_changed = training_plan and training_plan != athlete.training_plan
+    if plan_changed:
+        athlete.training_plan = training_plan
+        mark_athlete_charges_dirty(athlete.id)
+    db.session.flush()
+    if weight != athlete.weight:
+        record_weigh_in(athlete.id, weight)
+    if plan_changed:
+        rebuild_athlete_summary(athlete.id)
     db.session.commit()
 
     return redirect(url_for("view_athlete", athlete_id=athlete_id))
@@ -241,7 +404,7 @@ def view_athlete(athlete_id):
 
     # Select active tab
     allowed_tabs = ["profile", "training-sessions",
-                    "private-coaching", "payments", "competitions"]
+                    "private-coaching", "payments", "competitions", "weight"]
 
     active_tab = request.args.get("tab", None)
     if not active_tab or active_tab not in allowed_tabs:
@@ -266,8 +429,7 @@ def view_athlete(athlete_id):
     # Render training sessions tab
     #
     if active_tab == "training-sessions":
-        training_sessions = TrainingSession.query.filter_by(
-            athlete_id=athlete_id).all()
+        training_sessions = get_athlete_sessions("training_sessions", athlete_id)
 
         return render_template("view-athlete.html",
                                pageIs='athletes',
@@ -278,8 +440,7 @@ def view_athlete(athlete_id):
     # Render private coaching tab
     #
     if active_tab == "private-coaching":
-        coaching_sessions = CoachingSession.query.filter_by(
-            athlete_id=athlete_id).all()
+        coaching_sessions = get_athlete_sessions("coaching_sessions", athlete_id)
 
         return render_template("view-athlete.html",
                                pageIs='athletes',
@@ -298,22 +459,29 @@ def view_athlete(athlete_id):
                                athlete=athlete,
                                competitions=competitions)
 
+    # Render weight tab. The chart loads its data from the weigh-ins endpoint
+    #
+    if active_tab == "weight":
+
+        return render_template("view-athlete.html",
+                               pageIs='athletes',
+                               active_tab=active_tab,
+                               athlete=athlete,
+                               current_weight=get_current_weight(athlete_id))
+
     # Render payments tab
     #
     if active_tab == "payments":
 
-        athlete_plan_fee = get_training_plan(
-            get_athelete_training_plan(athlete_id)).price
+        weekly_charges = get_weekly_charges(athlete_id)
+        training_summary = [week for week in weekly_charges if week.training_sessions]
+        training_fees = sum([week.plan_fee for week in weekly_charges])
 
-        training_summary = training_sessions_per_week(athlete_id)
-        training_fees = calculate_training_fees(athlete_id)
-
-        coaching_summary_fees = coaching_sessions_per_week(athlete_id)
-        coaching_fees = sum([coaching[4]
-                            for coaching in coaching_summary_fees])
+        coaching_summary_fees = [week for week in weekly_charges if week.coaching_sessions]
+        coaching_fees = sum([week.coaching_fees for week in weekly_charges])
 
         competitions_summary = get_competitions_summary(athlete_id)
-        competition_fees = calculate_competition_fees(athlete_id)
+        competition_fees = sum([week.competition_fees for week in weekly_charges])
 
         total_payment = training_fees + coaching_fees + competition_fees
 
@@ -321,7 +489,6 @@ def view_athlete(athlete_id):
                                pageIs='athletes',
                                active_tab=active_tab,
                                athlete=athlete,
-                               athlete_plan_fee=athlete_plan_fee,
                                training_summary=training_summary,
                                training_fees=training_fees,
                                coaching_summary_fees=coaching_summary_fees,
@@ -330,6 +497,59 @@ def view_athlete(athlete_id):
                                total_payment=total_payment)
 
 
+@app.route("/view-athlete/<int:athlete_id>/weigh-ins.json", methods=["GET"])
+@login_required
+def athlete_weigh_ins(athlete_id):
+    """
+    Returns the weigh-ins of an athlete in a period, downsampled for the weight chart.
+
+    Query parameters:
+        start (str): The first day, in the format "YYYY-MM-DD". Defaults to 90 days before `end`.
+        end (str): The last day, in the format "YYYY-MM-DD". Defaults to today.
+        points (int): The maximum number of points. Defaults to 60.
+
+    Args:
+        athlete_id (int): The ID of the athlete.
+
+    Returns:
+        Response: A JSON document with the points of the period, see `get_weight_series`.
+    """
+
+    try:
+        end = datetime.strptime(request.args["end"], "%Y-%m-%d") + timedelta(days=1) \
+            if request.args.get("end") else datetime.now()
+        start = datetime.strptime(request.args["start"], "%Y-%m-%d") if request.args.get("start") else None
+        points = min(request.args.get("points", 60, type=int), 500)
+    except ValueError:
+        abort(400)
+
+    return jsonify({"points": get_weight_series(athlete_id, start, end, points)})
+
+
+@app.route("/log-weigh-in", methods=["POST"])
+@login_required
+@read_your_writes
+def log_weigh_in():
+    """
+    Records a weigh-in of an athlete.
+
+    The weigh-in is appended to the athlete's history. When no time is given, the athlete is weighed now.
+
+    Returns:
+        redirect: Redirects to the weight tab of the athlete.
+    """
+
+    athlete_id = int(request.form["athlete_id"])
+    weight = float(request.form["weight"])
+    weighed_at = request.form.get("weighed_at")
+
+    record_weigh_in(athlete_id, weight,
+                    datetime.strptime(weighed_at, "%Y-%m-%dT%H:%M") if weighed_at else None)
+    db.session.commit()
+
+    return redirect(url_for("view_athlete", athlete_id=athlete_id, tab="weight"))
+
+
 @app.route("/list-athletes", methods=["GET"])
 @login_required
 def list_athletes():
@@ -340,17 +560,9 @@ def list_athletes():
         render_template: The rendered template containing the list of athletes.
     """
 
-    with db.engine.connect() as conn:
-        query = """
-        select a.id, a.fullname, a.gender, a.age, 
-        a.weight, t.name as 'training_plan', t.can_attend_competitions as 'can_attend_competitions'
-        from athletes as a join training_plans as t on a.training_plan = t.id
-        """
+    athletes = get_athlete_roster()
 
-        athletes = conn.execute(text(query))
-        results = athletes.all()
-
-    return render_template("list-athletes.html", pageIs='athletes', athletes=results)
+    return render_template("list-athletes.html", pageIs='athletes', athletes=athletes)
 
 
 @app.route("/list-training-sessions", methods=["GET"])
@@ -366,14 +578,9 @@ def list_training_sessions():
         render_template: The rendered template containing the list of training sessions.
     """
 
-    with db.engine.connect() as conn:
-        query = """
-        select a.id, fullname, count(*) as 'sessions' 
-            from training_sessions as c 
-            join athletes as a on c.athlete_id = a.id 
-            group by athlete_id
-        """
-        training_sessions = conn.execute(text(query))
+    with db.read_engine.connect() as conn:
+        training_sessions = run_query(conn, "training_sessions_per_athlete",
+                                      training_sessions=sessions_table(conn, "training_sessions"))
         results = training_sessions.all()
 
     return render_template("list-training-sessions.html", pageIs='training', training_sessions=results)
@@ -381,6 +588,8 @@ def list_training_sessions():
 
 @app.route("/log-training-session", methods=["GET", "POST"])
 @login_required
+@read_your_writes
+@idempotent
 def log_training_session():
     """
     Handles the logging of a new training session for an athlete.
@@ -389,9 +598,12 @@ def log_training_session():
         Renders a form to log a new training session. The form includes a list of all athletes.
 
     POST:
-        Processes the form submission to log a new training session. Validates if the athlete can register
-        a new session for the given date. If validation fails, an error message is displayed. If successful,
-        the new training session is added to the database and the user is redirected to the list of training sessions.
+        Processes the form submission to log a new training session. The weekly limit check and the insert
+        are done atomically by `register_training_session`, so concurrent check-ins cannot exceed the limit.
+        The write is committed by `commit_write`, which shares the commit with other check-ins when group
+        commit is enabled and returns only once the session is durable. If the limit is reached, an error
+        message is displayed. If successful, the new training session is added to the database and the user
+        is redirected to the list of training sessions.
 
     Returns:
         render_template: The rendered template for logging a training session (GET) or displaying an error (POST).
@@ -405,23 +617,16 @@ def log_training_session():
     athlete_id = request.form["athlete_id"]
     session_dt = request.form["session_dt"]
 
-    if not can_athlete_register_training_session(athlete_id, session_dt):
+    if not commit_write(check_in_training_session, athlete_id, session_dt):
         return render_template("log-training-session.html", pageIs='training',
                                error="Athlete has reached the maximum number of sessions for the week.")
 
-    training_session = TrainingSession(
-        athlete_id=athlete_id,
-        date=datetime.strptime(session_dt, "%Y-%m-%d")
-    )
-
-    db.session.add(training_session)
-    db.session.commit()
-
     return redirect(url_for("list_training_sessions"))
 
 
 @app.route("/add-competition", methods=["GET", "POST"])
 @login_required
+@read_your_writes
 def add_competition():
     """
     Handles the addition of a new competition.
@@ -459,6 +664,8 @@ def add_competition():
         entry_fee=entry_fee
     )
     db.session.add(competition)
+    db.session.flush()
+    record_change_event("competition", {"competitions": 1}, competition_id=competition.id, name=name, date=date)
     db.session.commit()
 
     return redirect(url_for("list_competitions"))
@@ -470,7 +677,7 @@ def list_competitions():
     """
     Retrieves a list of competitions from the database and renders them in a template.
 
-    This route handler connects to the database and executes a query to retrieve details of all competitions,
+    This route handler uses `get_competitions_list` to retrieve details of all competitions,
     including the competition name, date, entry fee, number of participants, and weight category. The results
     are then passed to the "list-competitions.html" template for rendering.
 
@@ -478,19 +685,7 @@ def list_competitions():
         render_template: The rendered template containing the list of competitions.
     """
 
-    query = """
-    select c.id, c.name as competition_name, c.date, c.entry_fee,
-        count(cr.id) as participants_count, concat(wc.name, ' (', wc.max_weight, ' kg)' ) as weight_category
-        from competitions as c
-        left join competition_registrations as cr on c.id = cr.competition_id
-        join weight_categories as wc on c.weight_category = wc.id
-        group by c.name
-        """
-
-    with db.engine.connect() as conn:
-        result = conn.execute(text(query))
-        competitions = result.fetchall()
-
+    competitions = get_competitions_list()
     return render_template("list-competitions.html", pageIs='competitions', competitions=competitions)
 
 
@@ -513,24 +708,11 @@ def view_competition(competition_id):
         render_template: The rendered template containing the competition details and list of participants.
     """
 
-    with db.engine.connect() as conn:
-        query = """
-        select c.id, c.name, c.date, concat(wc.name, ' (', wc.max_weight, ' kg)' ) as 'weight', wc.id as 'weight_id' 
-            from competitions as c 
-            join weight_categories as wc on c.weight_category = wc.id
-            where c.id = %d
-        """ % competition_id
-        result = conn.execute(text(query))
+    with db.read_engine.connect() as conn:
+        result = run_query(conn, "competition", {"competition_id": competition_id})
         competition = result.fetchone()
 
-    with db.engine.connect() as conn:
-        query = """
-        select cr.id, a.fullname, a.weight
-            from competition_registrations as cr
-            join athletes as a on cr.athlete_id = a.id
-            where cr.competition_id = %d
-        """ % competition_id
-        result = conn.execute(text(query))
+        result = run_query(conn, "competition_participants", {"competition_id": competition_id})
         participants = result.fetchall()
 
     return render_template("view-competition.html", pageIs='competitions', competition=competition, participants=participants)
@@ -538,13 +720,15 @@ def view_competition(competition_id):
 
 @app.route("/add-competition-participant/<int:competition_id>/<int:weight_cat>", methods=["GET", "POST"])
 @login_required
+@read_your_writes
+@idempotent
 def add_competition_participant(competition_id, weight_cat):
     """
     Handles the addition of an athlete to a specific competition.
 
     GET:
         Renders a form to add a new participant to the competition. The form includes a list of eligible athletes
-        based on their weight category and training plan.
+        based on their training plan and on whether their current weight, the latest weigh-in, is in the weight category.
 
     POST:
         Processes the form submission to add a new participant to the competition. Validates the input data and
@@ -562,16 +746,8 @@ def add_competition_participant(competition_id, weight_cat):
 
     if request.method == "GET":
 
-        query = """
-        select at.id, at.fullname, at.weight from training_plans as tp 
-            left join athletes as at on tp.id = at.training_plan 
-		    join weight_categories as wc on wc.id = %d
-		    where tp.can_attend_competitions = 1
-		    and at.weight between wc.min_weight and wc.max_weight
-        """ % weight_cat
-
-        with db.engine.connect() as conn:
-            result = conn.execute(text(query))
+        with db.read_engine.connect() as conn:
+            result = run_query(conn, "eligible_competition_athletes", {"weight_category": weight_cat})
             athletes = result.fetchall()
 
         if len(athletes) == 0:
@@ -592,6 +768,10 @@ def add_competition_participant(competition_id, weight_cat):
         athlete_id=athlete_id
     )
     db.session.add(registration)
+    competition = db.session.get(Competition, competition_id)
+    mark_charge_week_dirty(athlete_id, competition.date)
+    update_athlete_summary(athlete_id, competition.date, fees=competition.entry_fee)
+    record_change_event("competition_participant", competition_id=competition_id, athlete_id=int(athlete_id))
     db.session.commit()
 
     return redirect(url_for("view_competition", competition_id=competition_id))
@@ -610,20 +790,17 @@ def list_private_coaching():
         render_template: The rendered template containing the list of private coaching sessions.
     """
 
-    with db.engine.connect() as conn:
-        query = """
-        select a.id, fullname, count(*) as 'sessions' 
-            from coaching_sessions as c 
-            join athletes as a on c.athlete_id = a.id 
-            group by athlete_id
-        """
-        res = conn.execute(text(query))
+    with db.read_engine.connect() as conn:
+        res = run_query(conn, "coaching_sessions_per_athlete",
+                        coaching_sessions=sessions_table(conn, "coaching_sessions"))
         coaching_sessions = res.all()
     return render_template("list-coaching-sessions.html", pageIs='coaching', coaching_sessions=coaching_sessions)
 
 
 @app.route("/log-coaching-session", methods=["GET", "POST"])
 @login_required
+@read_your_writes
+@idempotent
 def log_private_coaching():
     """
     Handles the logging of a new private coaching session for an athlete.
@@ -632,9 +809,10 @@ def log_private_coaching():
         Renders a form to log a new private coaching session. The form includes a list of all athletes.
 
     POST:
-        Processes the form submission to log a new private coaching session. Validates if the athlete can register
-        a new session for the given date. If validation fails, an error message is displayed. If successful,
-        the new private coaching session is added to the database and the user is redirected to the list of private coaching sessions.
+        Processes the form submission to log a new private coaching session. The weekly limit check and the
+        insert are done atomically by `register_coaching_session`. If the limit is reached, an error message
+        is displayed. If successful, the new private coaching session is added to the database and the user
+        is redirected to the list of private coaching sessions.
 
     Returns:
         render_template: The rendered template for logging a private coaching session (GET) or displaying an error (POST).
@@ -649,20 +827,879 @@ def log_private_coaching():
     session_dt = request.form["session_dt"]
     tuition_fees = request.form["tuition_fees"]
 
-    if not can_athlete_register_coaching_session(athlete_id, session_dt):
+    if not commit_write(check_in_coaching_session, athlete_id, session_dt, tuition_fees):
         return render_template("log-coaching-session.html", pageIs='coaching',
                                error="Athlete has reached the maximum number of private coaching sessions for the week.")
 
-    coaching_session = CoachingSession(
-        athlete_id=athlete_id,
-        date=datetime.strptime(session_dt, "%Y-%m-%d"),
-        tuition_fees=tuition_fees
-    )
+    return redirect(url_for("list_private_coaching"))
+
+
+@app.route("/list-classes", methods=["GET"])
+@login_required
+def list_classes():
+    """
+    Renders the schedule of upcoming classes with their free places.
+
+    With the query parameter `open=1`, only classes with free places are listed.
+
+    Returns:
+        render_template: The rendered template containing the list of classes.
+    """
+
+    open_only = request.args.get("open") == "1"
+    classes = get_class_schedule(open_only=open_only)
+    return render_template("list-classes.html", pageIs='classes', classes=classes, open_only=open_only)
+
+
+@app.route("/add-class", methods=["GET", "POST"])
+@login_required
+@read_your_writes
+def add_training_class():
+    """
+    Handles the scheduling of a new class.
+
+    GET:
+        Renders a form to schedule a new class.
+
+    POST:
+        Processes the form submission to schedule a new class with its date, start and end time and capacity.
+        If the times or the capacity are invalid, an error message is displayed. If successful, the user is
+        redirected to the list of classes.
+
+    Returns:
+        render_template: The rendered template for scheduling a class (GET) or displaying an error (POST).
+        redirect: Redirects to the list of classes upon successful scheduling.
+    """
+
+    if request.method == "GET":
+        return render_template("add-class.html", pageIs='classes')
 
-    db.session.add(coaching_session)
+    try:
+        add_class(request.form["name"], request.form["date"], request.form["start_time"],
+                  request.form["end_time"], request.form["capacity"])
+    except ValueError as e:
+        return render_template("add-class.html", pageIs='classes', error=str(e))
     db.session.commit()
 
-    return redirect(url_for("list_private_coaching"))
+    return redirect(url_for("list_classes"))
+
+
+@app.route("/view-class/<int:class_id>", methods=["GET"])
+@login_required
+def view_class(class_id):
+    """
+    Renders the details of a class with the athletes booked into it and a form to book an athlete.
+
+    Args:
+        class_id (int): The ID of the class.
+
+    Returns:
+        render_template: The rendered template containing the class details.
+    """
+
+    ensure_tables(TrainingClass, ClassBooking)
+    training_class = db.get_or_404(TrainingClass, class_id)
+    return render_template("view-class.html", pageIs='classes', training_class=training_class,
+                           bookings=get_class_bookings(class_id), athletes=Athlete.query.all())
+
+
+@app.route("/book-class/<int:class_id>", methods=["POST"])
+@login_required
+@read_your_writes
+def book_training_class(class_id):
+    """
+    Books an athlete into a class.
+
+    The booking takes a place of the class and a training session of the athlete's weekly plan
+    (see `book_class`). If the class is full, overlaps another booking of the athlete or the
+    weekly limit is reached, nothing is saved and an error message is displayed.
+
+    Args:
+        class_id (int): The ID of the class.
+
+    Returns:
+        redirect: Redirects to the class details page upon successful booking.
+        render_template: The class details page with an error message if the booking failed.
+    """
+
+    result = book_class(int(request.form["athlete_id"]), class_id)
+    if result != "booked":
+        db.session.rollback()
+        training_class = db.get_or_404(TrainingClass, class_id)
+        return render_template("view-class.html", pageIs='classes', training_class=training_class,
+                               bookings=get_class_bookings(class_id), athletes=Athlete.query.all(),
+                               error=BOOKING_ERRORS[result])
+    db.session.commit()
+
+    return redirect(url_for("view_class", class_id=class_id))
+
+
+@app.route("/cancel-booking/<int:booking_id>", methods=["POST"])
+@login_required
+@read_your_writes
+def cancel_class_booking(booking_id):
+    """
+    Cancels a class booking and removes the training session it created.
+
+    Args:
+        booking_id (int): The ID of the booking.
+
+    Returns:
+        redirect: Redirects to the class details page, or a 404 error if the booking does not exist.
+    """
+
+    class_id = cancel_booking(booking_id)
+    if class_id is None:
+        abort(404)
+    db.session.commit()
+
+    return redirect(url_for("view_class", class_id=class_id))
+
+
+def kiosk_required(f):
+    """
+    A decorator function that returns a 404 error unless the application runs as a kiosk.
+
+    Parameters:
+    - f: The function to be decorated
+
+    Returns:
+    - decorated_function: The decorated function, available only when `TRAININGTALLY_KIOSK_URL` is set.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not app.config["KIOSK_CENTRAL_URL"]:
+            abort(404)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@app.route("/kiosk", methods=["GET"])
+@login_required
+@kiosk_required
+def kiosk():
+    """
+    Renders the check-in page of a kiosk.
+
+    The page lists the athletes of the kiosk's local copy, so it works while the central server
+    cannot be reached, along with the number of check-ins waiting to be synced, the outcome of the
+    last sync and the check-ins the central server rejected.
+
+    Returns:
+        render_template: The rendered kiosk page.
+    """
+
+    get_kiosk_sync()
+    status = get_kiosk_status(get_kiosk_store_path(app))
+    return render_template("kiosk.html", pageIs='kiosk', message=request.args.get("message"),
+                           error=KIOSK_ERRORS.get(request.args.get("error")), errors=KIOSK_ERRORS, **status)
+
+
+@app.route("/kiosk/check-in", methods=["POST"])
+@login_required
+@kiosk_required
+def kiosk_check_in():
+    """
+    Checks an athlete in at the kiosk for today's training or private coaching session.
+
+    The check-in is stored in the kiosk's local queue and sent to the central server by the
+    background sync, which is woken up right away. The weekly limits are checked against the
+    kiosk's copy; see `check_in_at_kiosk`.
+
+    Returns:
+        redirect: Redirects to the kiosk page with the outcome of the check-in.
+    """
+
+    kind = request.form.get("kind")
+    athlete_id = request.form.get("athlete_id", type=int)
+    tuition_fees = request.form.get("tuition_fees", 0, type=float)
+    if kind not in ("training", "coaching") or athlete_id is None:
+        return redirect(url_for("kiosk", error="invalid"))
+
+    outcome = check_in_at_kiosk(get_kiosk_store_path(app), athlete_id, kind, tuition_fees)
+    if outcome != "queued":
+        return redirect(url_for("kiosk", error=outcome))
+
+    get_kiosk_sync().wake()
+    return redirect(url_for("kiosk", message="Checked in."))
+
+
+@app.route("/kiosk/sync", methods=["POST"])
+@login_required
+@kiosk_required
+def kiosk_sync():
+    """
+    Syncs the kiosk with the central server right away.
+
+    Returns:
+        redirect: Redirects to the kiosk page with the outcome of the sync.
+    """
+
+    try:
+        result = get_kiosk_sync().sync()
+    except KioskSyncError:
+        return redirect(url_for("kiosk"))
+
+    return redirect(url_for("kiosk", message="Synced %d check-ins, %d rejected." % (result["sent"], result["rejected"])))
+
+
+@app.route("/kiosk/dismiss/<check_in_id>", methods=["POST"])
+@login_required
+@kiosk_required
+def kiosk_dismiss(check_in_id):
+    """
+    Removes a rejected check-in from the kiosk page.
+
+    Args:
+        check_in_id (str): The ID of the check-in.
+
+    Returns:
+        redirect: Redirects to the kiosk page.
+    """
+
+    dismiss_kiosk_check_in(get_kiosk_store_path(app), check_in_id)
+    return redirect(url_for("kiosk"))
+
+
+@app.route("/analytics", methods=["GET"])
+@login_required
+def analytics():
+    """
+    Renders the plan utilization and revenue charts.
+
+    The charts are drawn with Chartist from the data returned by the utilization analytics endpoint.
+
+    Returns:
+        render_template: The rendered analytics page.
+    """
+
+    return render_template("analytics.html", pageIs='analytics')
+
+
+@app.route("/analytics/utilization.json", methods=["GET"])
+@login_required
+def utilization_analytics():
+    """
+    Returns plan utilization and revenue analytics as JSON.
+
+    The "weeks" query parameter sets how many weeks, ending with the current week, are included.
+    It defaults to 12 and is limited to 104.
+
+    Returns:
+        Response: A JSON document with Chartist data sets, see `get_utilization_analytics`.
+    """
+
+    num_of_weeks = min(max(request.args.get("weeks", 12, type=int), 1), 104)
+    return jsonify(get_utilization_analytics(num_of_weeks))
+
+
+@app.route("/reports/athlete-payments/<int:athlete_id>", methods=["POST"])
+@login_required
+def export_athlete_payments_report(athlete_id):
+    """
+    Queues an export of the full payment history of an athlete.
+
+    Args:
+        athlete_id (int): The ID of the athlete.
+
+    Returns:
+        redirect: Redirects to the list of jobs, where the progress of the export is shown.
+    """
+
+    enqueue_job("athlete-payments", athlete_id=athlete_id)
+    return redirect(url_for("list_jobs"))
+
+
+@app.route("/reports/roster", methods=["POST"])
+@login_required
+def export_roster_report():
+    """
+    Queues an export of the list of athletes.
+
+    Returns:
+        redirect: Redirects to the list of jobs, where the progress of the export is shown.
+    """
+
+    enqueue_job("roster")
+    return redirect(url_for("list_jobs"))
+
+
+def api_auth_required(f):
+    """
+    A decorator function that checks if an API request is authenticated.
+
+    API clients authenticate with the bearer token set in `TRAININGTALLY_API_TOKEN`. Requests
+    from a logged-in browser session are accepted too. Errors raised as `ApiError` are returned
+    as JSON.
+
+    Parameters:
+    - f: The function to be decorated
+
+    Returns:
+    - decorated_function: The decorated function that returns a 401 JSON error to unauthenticated requests.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = app.config["API_TOKEN"]
+        authorized = token and request.headers.get("Authorization") == "Bearer %s" % token
+        if not authorized and not session.get("logged_in"):
+            return jsonify({"error": "authentication required"}), 401
+        try:
+            return f(*args, **kwargs)
+        except ApiError as e:
+            return jsonify({"error": e.message}), e.status
+    return decorated_function
+
+
+@app.route("/api/v1/<resource>", methods=["GET"])
+@api_auth_required
+def api_list(resource):
+    """
+    Returns records of an API resource as JSON.
+
+    The resources are athletes, training-sessions, coaching-sessions, competitions and payments.
+    Clients can select fields with `fields=id,fullname` and fetch several records in one query
+    with `ids=1,2,3`; see `fetch_resource` for all parameters.
+
+    Args:
+        resource (str): The name of the resource.
+
+    Returns:
+        Response: A JSON document with the records under "data" and the cursor of the next page under "next".
+    """
+
+    return jsonify(fetch_resource(resource, request.args))
+
+
+@app.route("/api/v1/<resource>/<int:item_id>", methods=["GET"])
+@api_auth_required
+def api_item(resource, item_id):
+    """
+    Returns a single record of an API resource as JSON.
+
+    Args:
+        resource (str): The name of the resource.
+        item_id (int): The ID of the record. For payments, the ID of the athlete.
+
+    Returns:
+        Response: A JSON document with the record under "data", or a 404 error if it does not exist.
+    """
+
+    return jsonify(fetch_resource_item(resource, item_id, request.args))
+
+
+@app.route("/api/v1/kiosk/snapshot", methods=["GET"])
+@api_auth_required
+def api_kiosk_snapshot():
+    """
+    Returns the athletes, plans and weekly session counts a kiosk needs to check athletes in offline.
+
+    Returns:
+        Response: The snapshot as JSON, see `get_kiosk_snapshot`.
+    """
+
+    return jsonify(get_kiosk_snapshot())
+
+
+@app.route("/api/v1/kiosk/check-ins", methods=["POST"])
+@api_auth_required
+def api_kiosk_check_ins():
+    """
+    Applies a batch of check-ins queued by a kiosk.
+
+    The body is a JSON document with the name of the "kiosk" and its "check_ins". Each check-in is
+    applied with the weekly limits of the branch and answered with its outcome; see
+    `apply_kiosk_check_ins`. The batch is committed once, by `commit_write`.
+
+    Returns:
+        Response: A JSON document with one outcome per check-in under "results".
+    """
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        raise ApiError("the body must be a JSON object")
+
+    results = commit_write(apply_kiosk_check_ins, str(payload.get("kiosk") or "kiosk"), payload.get("check_ins"))
+    return jsonify({"results": results})
+
+
+@app.route("/group-commit/stats", methods=["GET"])
+@login_required
+def group_commit_stats():
+    """
+    Returns the statistics of the group committers of this process as JSON.
+
+    Returns:
+        Response: A JSON document with the group commit settings and, per branch, the number of commits
+                  and writes, the average batch size and the commits and writes per second over the last minute.
+    """
+
+    return jsonify({
+        "enabled": app.config["GROUP_COMMIT"],
+        "max_batch": app.config["GROUP_COMMIT_MAX_BATCH"],
+        "max_delay_ms": app.config["GROUP_COMMIT_MAX_DELAY_MS"],
+        "branches": get_group_commit_stats()
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Returns the request, database and cache metrics of all processes in the Prometheus text format.
+
+    Prometheus authenticates with the bearer token set in `TRAININGTALLY_METRICS_TOKEN`. Without a
+    token, only logged-in users can read the metrics.
+
+    Returns:
+        Response: The metrics as plain text.
+        redirect: Redirects to the login page if the request is neither authenticated nor logged in.
+    """
+
+    token = app.config["METRICS_TOKEN"]
+    authorized = token and request.headers.get("Authorization") == "Bearer %s" % token
+    if not authorized and not session.get("logged_in"):
+        if token and "Authorization" in request.headers:
+            abort(403)
+        return redirect(url_for("login"))
+
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@app.route("/profiles", methods=["GET"])
+@login_required
+@admin_required
+def list_profiles():
+    """
+    Renders the list of the most recent request profiles with their top functions.
+
+    Returns:
+        render_template: The rendered template containing the list of profiles.
+    """
+
+    return render_template("list-profiles.html", pageIs='profiles', profiles=get_recent_profiles())
+
+
+@app.route("/profiles/<name>.prof", methods=["GET"])
+@login_required
+@admin_required
+def download_profile(name):
+    """
+    Sends the raw statistics of a request profile.
+
+    Args:
+        name (str): The name of the profile.
+
+    Returns:
+        Response: The `.prof` file as an attachment, or a 404 error if the profile does not exist.
+    """
+
+    return send_from_directory(get_profiles_folder(), name + ".prof", as_attachment=True)
+
+
+@app.route("/jobs", methods=["GET"])
+@login_required
+def list_jobs():
+    """
+    Renders the list of the most recent background jobs.
+
+    Jobs that are still queued or running are polled from the page through the job status endpoint.
+
+    Returns:
+        render_template: The rendered template containing the list of jobs.
+    """
+
+    ensure_tables(Job)
+    jobs = Job.query.order_by(Job.id.desc()).limit(50).all()
+    return render_template("list-jobs.html", pageIs='jobs', jobs=jobs)
+
+
+@app.route("/jobs/<int:job_id>/status", methods=["GET"])
+@login_required
+def job_status(job_id):
+    """
+    Returns the status and progress of a background job as JSON.
+
+    Args:
+        job_id (int): The ID of the job.
+
+    Returns:
+        Response: A JSON document with the status, progress and download URL of the job.
+    """
+
+    job = db.get_or_404(Job, job_id)
+    return jsonify(get_job_status(job))
+
+
+@app.route("/jobs/<int:job_id>/download", methods=["GET"])
+@login_required
+def download_job_result(job_id):
+    """
+    Sends the file produced by a finished background job.
+
+    Args:
+        job_id (int): The ID of the job.
+
+    Returns:
+        Response: The result file as an attachment, or a 404 error if the job is not done.
+    """
+
+    job = db.get_or_404(Job, job_id)
+    if job.status != "done" or not job.result_path or not os.path.exists(job.result_path):
+        abort(404)
+
+    return send_file(job.result_path, as_attachment=True,
+                     download_name="%s-%d.csv" % (job.kind, job.id))
+
+
+@app.cli.command("jobs-worker")
+@click.option("--processes", default=2, help="Number of worker processes.")
+@click.option("--poll-interval", default=1.0, help="Seconds to wait when the queue is empty.")
+@click.option("--once", is_flag=True, help="Exit when the queue is empty.")
+def jobs_worker(processes, poll_interval, once):
+    """
+    Runs background jobs from the queue in a pool of worker processes.
+    """
+
+    start_workers(processes, poll_interval, once)
+
+
+@app.cli.command("invoice-run")
+@click.option("--month", help="Month to invoice as YYYY-MM. Defaults to the previous month.")
+@click.option("--branch", help="Branch to invoice. Defaults to all branches.")
+@click.option("--processes", default=4, help="Number of worker processes.")
+@click.option("--batch-size", default=500, help="Number of athletes invoiced per transaction.")
+@click.option("--restart", is_flag=True, help="Start over instead of resuming an interrupted run.")
+def invoice_run(month, branch, processes, batch_size, restart):
+    """
+    Writes the month-end invoices of all athletes, resuming an interrupted run.
+    """
+
+    if not month:
+        month = (datetime.today().replace(day=1) - timedelta(days=1)).strftime("%Y-%m")
+
+    for name in [branch] if branch else get_branches() or [None]:
+        g.branch = name
+        result = run_invoices(month, processes, batch_size, restart)
+        click.echo("%s%s: invoiced %d athletes in %.1f seconds (%.1f athletes/second)" % (
+            month, " (%s)" % name if name else "",
+            result["athletes"], result["seconds"], result["throughput"]))
+
+
+@app.cli.command("archive-sessions")
+@click.option("--horizon-days", type=int, help="Days of sessions to keep in the main database.")
+@click.option("--branch", help="Branch to archive. Defaults to all branches.")
+def archive_sessions_command(horizon_days, branch):
+    """
+    Moves training and coaching sessions older than the horizon to the archive database.
+    """
+
+    before = get_archive_horizon(horizon_days or app.config["ARCHIVE_HORIZON_DAYS"])
+
+    for name in [branch] if branch else get_branches() or [None]:
+        g.branch = name
+        moved = archive_sessions(before)
+        click.echo("%s%s: archived %d training sessions and %d coaching sessions" % (
+            before, " (%s)" % name if name else "",
+            moved["training_sessions"], moved["coaching_sessions"]))
+
+
+@app.cli.command("db-maintain")
+@click.option("--branch", help="Branch to maintain. Defaults to all branches.")
+@click.option("--interval", type=float, help="Repeat every this many seconds instead of running once.")
+@click.option("--vacuum-pages", default=1000, help="Free pages released per run by the incremental vacuum.")
+@click.option("--enable-incremental-vacuum", "incremental", is_flag=True,
+              help="Switch to incremental auto-vacuum first. Rewrites the whole database once.")
+def db_maintain(branch, interval, vacuum_pages, incremental):
+    """
+    Creates missing indexes and refreshes the planner statistics with ANALYZE, incremental VACUUM and PRAGMA optimize.
+    """
+
+    names = [branch] if branch else get_branches() or [None]
+    if incremental:
+        for name in names:
+            g.branch = name
+            enable_incremental_vacuum()
+
+    while True:
+        for name in names:
+            g.branch = name
+            result = maintain_database(vacuum_pages)
+            click.echo("%s%s: %d indexes created, %d free pages released, %d left%s, %.1f seconds" % (
+                datetime.now().strftime("%Y-%m-%d %H:%M:%S"), " (%s)" % name if name else "",
+                len(result["indexes"]), result["freed_pages"], result["free_pages"],
+                "" if result["incremental_vacuum"] else " (incremental vacuum is off)", result["seconds"]))
+            for index in result["indexes"]:
+                click.echo("  created %s" % index)
+
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+@app.cli.command("db-backup")
+@click.option("--branch", help="Branch to back up. Defaults to all branches.")
+@click.option("--interval", type=float, help="Repeat every this many seconds instead of running once.")
+@click.option("--full", is_flag=True, help="Take a full snapshot even if the current chain is not complete.")
+@click.option("--verify/--no-verify", default=True, help="Restore every snapshot into a temporary file and check it.")
+@click.option("--pages", type=int, help="Pages copied per step.")
+@click.option("--sleep-ms", type=float, help="Pause between two steps, in milliseconds.")
+@click.option("--measure-stalls", is_flag=True,
+              help="Measure how long writers wait for the backup. For benchmarks only.")
+def db_backup(branch, interval, full, verify, pages, sleep_ms, measure_stalls):
+    """
+    Backs up the databases with the SQLite online backup API while the application keeps running.
+    """
+
+    names = [branch] if branch else get_branches() or [None]
+    pages = pages or app.config["BACKUP_PAGES_PER_STEP"]
+    sleep = (app.config["BACKUP_STEP_SLEEP_MS"] if sleep_ms is None else sleep_ms) / 1000
+
+    while True:
+        for name in names:
+            g.branch = name
+            try:
+                schemas = list(get_database_files())
+            except ValueError as e:
+                raise click.ClickException(str(e))
+
+            for schema in schemas:
+                result = backup_database(schema, full, pages, sleep, app.config["BACKUP_FULL_EVERY"],
+                                         app.config["BACKUP_KEEP"], measure_stalls)
+                click.echo("%s%s %s: %s snapshot %s, %d of %d pages, %d bytes, %.1f seconds, %d restarts" % (
+                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"), " (%s)" % name if name else "", schema,
+                    result["kind"], result["name"], result["changed_pages"], result["page_count"], result["bytes"],
+                    result["seconds"], result["restarts"]))
+                if measure_stalls:
+                    click.echo("  writers stalled %.1f ms at most, %.1f ms in total over %d probes" % (
+                        result["max_stall_ms"], result["total_stall_ms"], result["probes"]))
+                for deleted in result["deleted"]:
+                    click.echo("  deleted %s" % deleted)
+
+                if verify:
+                    problems = verify_snapshot(get_backup_folder(schema), result["name"])
+                    for problem in problems:
+                        click.echo("  restore check failed: %s" % problem)
+                    if problems:
+                        raise click.ClickException("Snapshot %s could not be restored." % result["name"])
+                    click.echo("  restore verified")
+
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+@app.cli.command("db-restore")
+@click.argument("snapshot", required=False)
+@click.argument("target", required=False)
+@click.option("--branch", help="Branch whose snapshots are restored. Defaults to the main database.")
+@click.option("--schema", type=click.Choice(["main", "archive"]), default="main", help="Database to restore.")
+def db_restore(snapshot, target, branch, schema):
+    """
+    Rebuilds SNAPSHOT into the file TARGET. Without arguments, lists the snapshots.
+    """
+
+    g.branch = branch
+    folder = get_backup_folder(schema)
+    if not snapshot:
+        for manifest in list_snapshots(folder):
+            click.echo("%s  %-11s %8d bytes  %s" % (manifest["name"], manifest["kind"], manifest["bytes"], manifest["created_at"]))
+        return
+
+    if not target:
+        raise click.ClickException("Give the file to restore %s into." % snapshot)
+    if os.path.exists(target):
+        raise click.ClickException("%s already exists. Stop the application and move it away first." % target)
+
+    try:
+        restore_snapshot(folder, snapshot, target)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo("Restored %s into %s" % (snapshot, target))
+
+
+@app.cli.command("query-plan-check")
+@click.option("--branch", help="Branch to check. Defaults to the main database.")
+def query_plan_check(branch):
+    """
+    Explains every query of the main pages and check-ins and fails on unexpected full table scans.
+    """
+
+    try:
+        result = run_query_plan_check(app, branch)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    for violation in result["violations"]:
+        click.echo("%s: full scan of %s in\n  %s" % (violation["page"], violation["table"], violation["statement"]))
+
+    if result["violations"]:
+        raise click.ClickException("%d unexpected full scans in %d statements" % (
+            len(result["violations"]), result["statements"]))
+    click.echo("%d statements checked, no unexpected full scans" % result["statements"])
+
+
+@app.cli.command("query-plan-test")
+@click.option("--athletes", default=500, help="Number of athletes to seed.")
+@click.option("--weeks", default=12, help="Weeks of session history to seed.")
+def query_plan_test(athletes, weeks):
+    """
+    Seeds a throw-away database and fails if a named query reads a whole table unexpectedly or has no plan case.
+    """
+
+    try:
+        checked = check_registry_query_plans(athletes, weeks)
+    except AssertionError as e:
+        raise click.ClickException("The query plan test failed:\n%s" % e)
+    click.echo("%d queries checked, no unexpected full scans" % checked)
+
+
+@app.cli.command("compression-benchmark")
+@click.option("--branch", help="Branch whose pages are rendered. Defaults to the main database.")
+@click.option("--repeat", default=5, help="Number of times each page is compressed at each level.")
+def compression_benchmark(branch, repeat):
+    """
+    Measures the CPU time and the bytes saved by compressing the main pages at several levels.
+    """
+
+    try:
+        pages = run_compression_benchmark(app, branch, repeat=repeat)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    for page in pages:
+        click.echo("%s: %d bytes" % (page["page"], page["bytes"]))
+        for result in page["results"]:
+            click.echo("  %-4s level %2d: %8d bytes, %5.1f%% saved, %7.2f ms" % (
+                result["encoding"], result["level"], result["bytes"], result["saved"] * 100, result["milliseconds"]))
+
+
+@app.cli.command("kiosk-sync")
+def kiosk_sync_command():
+    """
+    Sends the queued check-ins of this kiosk to the central server and reloads the athletes.
+    """
+
+    if not app.config["KIOSK_CENTRAL_URL"]:
+        raise click.ClickException("Set TRAININGTALLY_KIOSK_URL to the URL of the central server.")
+
+    try:
+        result = sync_kiosk(get_kiosk_store_path(app), app.config["KIOSK_CENTRAL_URL"], app.config["KIOSK_TOKEN"],
+                            app.config["KIOSK_NAME"], app.config["KIOSK_SYNC_BATCH"], app.config["KIOSK_TIMEOUT_SECONDS"])
+    except KioskSyncError as e:
+        raise click.ClickException(str(e))
+
+    click.echo("%d check-ins sent, %d accepted, %d rejected; %d athletes loaded" % (
+        result["sent"], result["accepted"], result["rejected"], result["athletes"]))
+
+
+@app.cli.command("quota-stress-test")
+@click.option("--threads", default=16, help="Number of concurrent workers.")
+@click.option("--attempts", default=20, help="Check-in attempts per worker.")
+@click.option("--group-commit", is_flag=True, help="Commit the check-ins through the group committer.")
+@click.option("--database-uri", help="Scratch database to run against, emptied first. Defaults to a new SQLite database.")
+def quota_stress_test(threads, attempts, group_commit, database_uri):
+    """
+    Hammers one athlete with concurrent check-ins and checks the weekly limit holds.
+    """
+
+    result = run_quota_stress_test(threads, attempts, group_commit=group_commit, database_uri=database_uri)
+    click.echo("Database: %s" % result["dialect"])
+    click.echo("Hammered athlete: %d sessions stored, limit %d" % (result["hammered_sessions"], result["limit"]))
+    click.echo("Other athletes: %d of %d reached their limit of %d" % (
+        sum(count == result["other_limit"] for count in result["other_sessions"]),
+        len(result["other_sessions"]), result["other_limit"]))
+    click.echo("%d database errors, %.1f check-ins per second" % (result["errors"], result["check_ins_per_second"]))
+    click.echo("%d commits, %.1f commits per second" % (result["commits"], result["commits_per_second"]))
+    click.echo("Check-in latency: hammered athlete %.1f ms median, %.1f ms max; others %.1f ms median, %.1f ms max" % (
+        result["hammered_latency"]["median_ms"], result["hammered_latency"]["max_ms"],
+        result["other_latency"]["median_ms"], result["other_latency"]["max_ms"]))
+    click.echo("%d check-ins of other athletes completed while the hammered athlete was contended" % (
+        result["overlapping"]))
+
+    if not result["passed"]:
+        raise click.ClickException("The weekly limit did not hold under concurrent check-ins, "
+                                   "or the other athletes were held up by the hammered one.")
+    click.echo("Passed")
+
+
+@app.cli.command("class-booking-stress-test")
+@click.option("--threads", default=200, help="Number of simultaneous bookings.")
+@click.option("--capacity", default=20, help="Number of places in the class.")
+@click.option("--database-uri", help="Scratch database to run against, emptied first. Defaults to a new SQLite database.")
+def class_booking_stress_test(threads, capacity, database_uri):
+    """
+    Books hundreds of athletes into one class at once and checks the class is never overbooked.
+    """
+
+    result = run_booking_stress_test(threads, capacity, database_uri=database_uri)
+    click.echo("Database: %s" % result["dialect"])
+    click.echo("Class: %d of %d places booked, %d bookings and %d training sessions stored" % (
+        result["booked"], result["capacity"], result["bookings"], result["training_sessions"]))
+    click.echo("Results: %s" % ", ".join("%s %d" % item for item in sorted(result["results"].items())))
+    click.echo("%d database errors, %.1f bookings per second" % (result["errors"], result["bookings_per_second"]))
+
+    if not result["passed"]:
+        raise click.ClickException("The class capacity did not hold under simultaneous bookings.")
+    click.echo("Passed")
+
+
+@app.cli.command("load-test-seed")
+@click.option("--athletes", default=2000, help="Number of athletes.")
+@click.option("--weeks", default=52, help="Weeks of session history.")
+@click.option("--branch", default=None, help="Seed the database of this branch instead of the main database.")
+@click.option("--seed", default=0, help="Seed of the random generator.")
+def load_test_seed(athletes, weeks, branch, seed):
+    """
+    Fills an empty database with production-scale data for load testing.
+    """
+
+    g.branch = branch
+    try:
+        counts = seed_load_test_data(athletes, weeks, seed)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    for table, count in counts.items():
+        click.echo("%s: %d rows" % (table, count))
+
+
+@app.cli.command("load-test")
+@click.option("--url", default="http://127.0.0.1:5000", help="Base URL of the running instance.")
+@click.option("--concurrency", default=16, help="Number of simultaneous users.")
+@click.option("--duration", default=60.0, help="Length of the test in seconds.")
+@click.option("--branch", default=None, help="Branch to log in to.")
+@click.option("--seed", default=0, help="Seed of the request sequence.")
+@click.option("--baseline", default=None, help="JSON baseline to compare the results with.")
+@click.option("--save", default=None, help="Save the results as a JSON baseline to this path.")
+@click.option("--tolerance", default=0.2, help="Allowed relative change against the baseline.")
+def load_test(url, concurrency, duration, branch, seed, baseline, save, tolerance):
+    """
+    Replays a peak-hour mix of front-desk traffic and reports latency percentiles per route.
+    """
+
+    try:
+        result = run_load_test(url, concurrency, duration, branch, seed)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    click.echo("%-36s %9s %7s %9s %9s %9s %9s" % ("Route", "Requests", "Errors", "Req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for name, summary in sorted(result["routes"].items()) + [("total", result["total"])]:
+        click.echo("%-36s %9d %7d %9.1f %9.1f %9.1f %9.1f" % (
+            name, summary["requests"], summary["errors"], summary["throughput"],
+            summary["p50"], summary["p95"], summary["p99"]))
+
+    if save:
+        save_load_test_result(result, save)
+        click.echo("Results saved to %s" % save)
+
+    if baseline:
+        regressions = compare_with_baseline(result, load_load_test_result(baseline), tolerance)
+        for regression in regressions:
+            click.echo("Regression in %s %s: %.1f -> %.1f" % (
+                regression["route"], regression["metric"], regression["baseline"], regression["current"]))
+        if regressions:
+            raise click.ClickException("%d regressions against %s" % (len(regressions), baseline))
+        click.echo("No regressions against %s" % baseline)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+from models import *
+from queries import *
+
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def ensure_weigh_ins(conn=None):
+    """
+    Creates the weigh-ins table in the current database if it does not exist yet.
+
+    When the table is created, the current weight of every athlete is recorded as their first
+    weigh-in, so every athlete has a history from then on.
+
+    Parameters:
+        conn (Connection, optional): The connection of an open transaction to create the table in.
+                                     Defaults to a new transaction.
+
+    Returns:
+        None
+    """
+
+    ensure_tables(WeighIn, conn=conn, populate=lambda conn: run_query(
+        conn, "backfill_weigh_ins", {"now": datetime.now().strftime(TIMESTAMP_FORMAT)}))
+
+
+def record_weigh_in(athlete_id, weight, weighed_at=None):
+    """
+    Appends a weigh-in to the history of an athlete.
+
+    The current weight of the athlete is updated in the same transaction, unless a later weigh-in
+    is already recorded, so entering an older weigh-in afterwards does not change the current weight.
+    The caller commits the transaction.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+        weight (float): The weight in KG.
+        weighed_at (datetime, optional): When the athlete was weighed. Defaults to now.
+
+    Returns:
+        None
+    """
+
+    ensure_weigh_ins(db.session.connection())
+    params = {
+        "athlete_id": athlete_id,
+        "new_weight": weight,
+        "weighed_at": (weighed_at or datetime.now()).strftime(TIMESTAMP_FORMAT)
+    }
+
+    run_query(db.session, "record_weigh_in", params)
+    run_query(db.session, "update_current_weight", params)
+
+
+def get_current_weight(athlete_id):
+    """
+    Returns the current weight of an athlete.
+
+    The current weight is kept on the athlete row, so this is a single primary key lookup
+    however long the weigh-in history is.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+
+    Returns:
+        float or None: The weight in KG, or None if the athlete does not exist.
+    """
+
+    with db.read_engine.connect() as conn:
+        return run_query(conn, "current_weight", {"athlete_id": athlete_id}).scalar()
+
+
+def get_weight_series(athlete_id, start=None, end=None, points=60):
+    """
+    Returns the weigh-ins of an athlete in a period, downsampled for a chart.
+
+    The period is split into `points` equal buckets and every bucket with weigh-ins becomes one
+    point with the average, lowest and highest weight of the bucket. The grouping is done by the
+    database, so at most `points` rows are returned however many weigh-ins the period has.
+
+    Parameters:
+        athlete_id (int): The ID of the athlete.
+        start (datetime, optional): The start of the period. Defaults to 90 days before `end`.
+        end (datetime, optional): The end of the period. Defaults to now.
+        points (int): The maximum number of points to return.
+
+    Returns:
+        list: One dictionary per point with the keys "weighed_at" (the time of the first weigh-in
+              of the bucket), "weight" (the average), "min", "max" and "count".
+    """
+
+    ensure_weigh_ins()
+    end = end or datetime.now()
+    start = start or end - timedelta(days=90)
+    points = max(int(points), 1)
+
+    with db.read_engine.connect() as conn:
+        rows = run_query(conn, "weight_series", {
+            "athlete_id": athlete_id,
+            "start": start.strftime(TIMESTAMP_FORMAT),
+            "end": end.strftime(TIMESTAMP_FORMAT),
+            "points": points
+        }).fetchall()
+
+    return [{
+        "weighed_at": str(row.weighed_at)[:16],
+        "weight": round(row.weight, 2),
+        "min": row.min,
+        "max": row.max,
+        "count": row.count
+    } for row in rows]